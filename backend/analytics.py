@@ -0,0 +1,280 @@
+"""
+Spending analytics backed by per-month rollups.
+
+``spending_rollups`` holds, for every (group, user, month), how much the user
+paid, how much they owed through splits, and how many expenses they paid for
+or shared in. Expense writes add to these rows with atomic increments in the
+same transaction and lock order as the balance ledger, so the stats
+endpoints read a few rows per member and month regardless of how long a
+group's history is. Archiving moves expenses out of the hot tables but
+leaves the rollups in place.
+
+Run ``python analytics.py`` to rebuild every rollup from the expense history,
+e.g. once after upgrading an existing database.
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.orm import Session, selectinload
+
+from models import (
+    User, Group, Expense, ExpenseArchive, MembershipSnapshot, SpendingRollup
+)
+from database import SessionLocal
+import schemas
+
+REBUILD_BATCH_SIZE = 1000
+
+PERIOD_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+def rollup_period(created_at: Optional[datetime] = None) -> str:
+    """Rollup month of an expense as YYYY-MM, in UTC"""
+    created_at = created_at or datetime.now(timezone.utc)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.strftime("%Y-%m")
+
+def validate_period(value: Optional[str], name: str) -> Optional[str]:
+    if value is not None and not PERIOD_PATTERN.match(value):
+        raise ValueError(f"{name} must be a month in YYYY-MM format")
+    return value
+
+def expense_rollup_deltas(expense) -> Dict[int, List]:
+    """Per-user [paid, owed, expenses_paid, expenses_shared] contributed by one expense"""
+    deltas = defaultdict(lambda: [0.0, 0.0, 0, 0])
+    deltas[expense.paid_by][0] += expense.amount
+    deltas[expense.paid_by][2] += 1
+    for split in expense.splits:
+        deltas[split.user_id][1] += split.amount
+        deltas[split.user_id][3] += 1
+    return deltas
+
+def apply_expense(db: Session, expense: Expense, period: Optional[str] = None):
+    """Add a new expense to its group's rollups; call after the ledger update, before commit
+
+    The period comes from the flushed row's ``created_at``, the timestamp the
+    rebuild and the audit group it by.
+    """
+    period = period or rollup_period(expense.created_at)
+    rollups = {(user_id, period): values for user_id, values in expense_rollup_deltas(expense).items()}
+    apply_rollups(db, expense.group_id, rollups)
+
+def apply_rollups(db: Session, group_id: int, rollups: Dict[Tuple[int, str], List]):
+    """Add [paid, owed, expenses_paid, expenses_shared] per (user_id, period) to a group's rollups"""
+    changes = sorted((key, values) for key, values in rollups.items() if key[0] is not None)
+    if not changes:
+        return
+    table = SpendingRollup.__table__
+    
+    # Lock the rows that already exist in ascending (user id, period) order, the
+    # same order as the ledger's balance rows, so concurrent writers can't
+    # deadlock or delete them before the increments below
+    existing = set(db.execute(
+        select(table.c.user_id, table.c.period)
+        .where(table.c.group_id == group_id, table.c.period.in_(sorted({period for (_, period), _ in changes})))
+        .order_by(table.c.user_id, table.c.period)
+        .with_for_update()
+    ).all())
+    
+    increments = []
+    new_rows = []
+    for (user_id, period), (paid, owed, expenses_paid, expenses_shared) in changes:
+        if (user_id, period) in existing:
+            increments.append({
+                "b_user_id": user_id, "b_period": period, "b_paid": paid, "b_owed": owed,
+                "b_expenses_paid": expenses_paid, "b_expenses_shared": expenses_shared,
+            })
+        else:
+            new_rows.append({
+                "group_id": group_id, "user_id": user_id, "period": period, "paid": paid, "owed": owed,
+                "expenses_paid": expenses_paid, "expenses_shared": expenses_shared,
+            })
+    
+    if increments:
+        db.execute(
+            update(table)
+            .where(
+                table.c.group_id == group_id,
+                table.c.user_id == bindparam("b_user_id"),
+                table.c.period == bindparam("b_period")
+            )
+            .values(
+                paid=table.c.paid + bindparam("b_paid"),
+                owed=table.c.owed + bindparam("b_owed"),
+                expenses_paid=table.c.expenses_paid + bindparam("b_expenses_paid"),
+                expenses_shared=table.c.expenses_shared + bindparam("b_expenses_shared")
+            ),
+            increments
+        )
+    if new_rows:
+        # A concurrent insert of the same row raises IntegrityError and the
+        # transaction is retried by ledger.run_with_retry
+        db.execute(insert(table), new_rows)
+
+def _accumulate(rollups: Dict[Tuple[int, str], List], query):
+    for expense in query.yield_per(REBUILD_BATCH_SIZE):
+        period = rollup_period(expense.created_at)
+        for user_id, values in expense_rollup_deltas(expense).items():
+            if user_id is None:
+                continue
+            totals = rollups[(user_id, period)]
+            for index, value in enumerate(values):
+                totals[index] += value
+
+def rebuild_group_rollups(db: Session, group_id: int):
+    """Recompute a group's rollups from its hot and archived expenses"""
+    rollups = defaultdict(lambda: [0.0, 0.0, 0, 0])
+    for model in (ExpenseArchive, Expense):
+        query = db.query(model).filter(model.group_id == group_id).options(
+            selectinload(model.split_rows),
+            selectinload(model.membership_snapshot).selectinload(MembershipSnapshot.members)
+        ).order_by(model.id)
+        _accumulate(rollups, query)
+
+    db.query(SpendingRollup).filter(SpendingRollup.group_id == group_id).delete(synchronize_session=False)
+    rows = [
+        {"group_id": group_id, "user_id": user_id, "period": period, "paid": paid, "owed": owed,
+         "expenses_paid": expenses_paid, "expenses_shared": expenses_shared}
+        for (user_id, period), (paid, owed, expenses_paid, expenses_shared) in sorted(rollups.items())
+    ]
+    if rows:
+        db.execute(insert(SpendingRollup), rows)
+
+def rebuild_rollups(db: Session, group_ids: Iterable[int]):
+    """Rebuild the rollups of several groups after bulk changes to their expenses"""
+    db.flush()
+    for group_id in sorted(set(group_ids)):
+        rebuild_group_rollups(db, group_id)
+
+def delete_group_rollups(db: Session, group_id: int):
+    db.query(SpendingRollup).filter(SpendingRollup.group_id == group_id).delete(synchronize_session=False)
+
+def _in_range(query, start: Optional[str], end: Optional[str]):
+    if start is not None:
+        query = query.filter(SpendingRollup.period >= start)
+    if end is not None:
+        query = query.filter(SpendingRollup.period <= end)
+    return query
+
+def _monthly(query) -> List[schemas.MonthlySpending]:
+    # Rollups hold base-currency amounts, so months are split by the groups' currencies
+    rows = query.with_entities(
+        SpendingRollup.period,
+        Group.base_currency,
+        func.sum(SpendingRollup.paid),
+        func.sum(SpendingRollup.owed),
+        func.sum(SpendingRollup.expenses_paid)
+    ).join(Group, Group.id == SpendingRollup.group_id).group_by(
+        SpendingRollup.period, Group.base_currency
+    ).order_by(SpendingRollup.period, Group.base_currency).all()
+    return [
+        schemas.MonthlySpending(
+            period=period, currency=currency, paid=paid or 0, owed=owed or 0, expense_count=count or 0
+        )
+        for period, currency, paid, owed, count in rows
+    ]
+
+def get_group_stats(db: Session, group: Group, start: Optional[str] = None, end: Optional[str] = None) -> schemas.GroupStats:
+    """Per-member and per-month spending of a group, read from its rollups"""
+    rollups = _in_range(db.query(SpendingRollup).filter(SpendingRollup.group_id == group.id), start, end)
+
+    member_rows = rollups.with_entities(
+        SpendingRollup.user_id,
+        User.name,
+        func.sum(SpendingRollup.paid),
+        func.sum(SpendingRollup.owed),
+        func.sum(SpendingRollup.expenses_paid),
+        func.sum(SpendingRollup.expenses_shared)
+    ).join(User, User.id == SpendingRollup.user_id).group_by(SpendingRollup.user_id, User.name).all()
+
+    members = [
+        schemas.MemberSpending(
+            user_id=user_id, user_name=name, paid=paid or 0, owed=owed or 0,
+            expenses_paid=expenses_paid or 0, expenses_shared=expenses_shared or 0
+        )
+        for user_id, name, paid, owed, expenses_paid, expenses_shared in member_rows
+    ]
+    # Biggest spender first
+    members.sort(key=lambda member: (-member.paid, member.user_id))
+    months = _monthly(rollups)
+
+    return schemas.GroupStats(
+        group_id=group.id,
+        group_name=group.name,
+        start=start,
+        end=end,
+        total_expenses=sum(month.paid for month in months),
+        expense_count=sum(month.expense_count for month in months),
+        members=members,
+        months=months
+    )
+
+def get_user_stats(db: Session, user: User, start: Optional[str] = None, end: Optional[str] = None) -> schemas.UserStats:
+    """A user's spending per group and per month across all groups, read from the rollups"""
+    rollups = _in_range(db.query(SpendingRollup).filter(SpendingRollup.user_id == user.id), start, end)
+
+    group_rows = rollups.with_entities(
+        SpendingRollup.group_id,
+        Group.name,
+        Group.base_currency,
+        func.sum(SpendingRollup.paid),
+        func.sum(SpendingRollup.owed),
+        func.sum(SpendingRollup.expenses_paid),
+        func.sum(SpendingRollup.expenses_shared)
+    ).join(Group, Group.id == SpendingRollup.group_id).group_by(
+        SpendingRollup.group_id, Group.name, Group.base_currency
+    ).order_by(SpendingRollup.group_id).all()
+
+    groups = [
+        schemas.GroupSpending(
+            group_id=group_id, group_name=name, currency=currency, paid=paid or 0, owed=owed or 0,
+            expenses_paid=expenses_paid or 0, expenses_shared=expenses_shared or 0
+        )
+        for group_id, name, currency, paid, owed, expenses_paid, expenses_shared in group_rows
+    ]
+    months = _monthly(rollups)
+
+    # Each group's amounts are in its base currency, so totals are kept per currency
+    total_paid = defaultdict(float)
+    total_owed = defaultdict(float)
+    for group in groups:
+        total_paid[group.currency] += group.paid
+        total_owed[group.currency] += group.owed
+
+    return schemas.UserStats(
+        user_id=user.id,
+        user_name=user.name,
+        start=start,
+        end=end,
+        total_paid=dict(total_paid),
+        total_owed=dict(total_owed),
+        expenses_paid=sum(group.expenses_paid for group in groups),
+        groups=groups,
+        months=months
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the spending analytics rollups from expense history")
+    parser.add_argument("--group-id", type=int, help="only rebuild this group")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.group_id is not None:
+            group_ids = [args.group_id]
+        else:
+            group_ids = [row[0] for row in db.query(Group.id).order_by(Group.id).all()]
+        for group_id in group_ids:
+            rebuild_group_rollups(db, group_id)
+            db.commit()
+        print(f"Rebuilt spending rollups for {len(group_ids)} groups")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
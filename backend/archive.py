@@ -0,0 +1,308 @@
+"""
+Archival of settled group history.
+
+Balance queries read a group's history from its first expense. Once a group
+has settled up (every balance is effectively zero), or when history is older
+than the retention window, the expenses, splits and settlements are moved to
+the ``*_archive`` tables and replaced by a ``GroupCheckpoint``. The per-user
+nets of the archived rows are kept as ``CheckpointBalance`` rows, so balances
+stay exact while the hot tables and their indexes only hold recent activity.
+
+A group's ledger is locked while its history moves, the same lock
+``netting.settle_all`` takes, so no write to the group lands between reading
+the rows and writing the checkpoint; ``archive_if_settled`` takes the lock
+before it checks that the group is settled. On PostgreSQL the archive tables
+are partitioned by month; the partitions a run needs are created up front,
+each in its own short transaction.
+
+Run ``python archive.py --older-than-days 90`` from cron to archive on a
+schedule.
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+import os
+from typing import Optional
+
+from sqlalchemy import func, insert, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.orm import Session
+
+from models import (
+    Group, Expense, ExpenseSplit, Settlement, ExpenseArchive, ExpenseSplitArchive,
+    SettlementArchive, GroupCheckpoint, CheckpointBalance
+)
+from database import SessionLocal
+import crud
+import ledger
+
+# Minimum number of hot expenses before a settled group is archived
+ARCHIVE_MIN_EXPENSES = int(os.getenv("ARCHIVE_MIN_EXPENSES", "50"))
+ARCHIVE_CHUNK_SIZE = 5000
+PARTITION_CREATE_ATTEMPTS = 3
+
+# Raised when another job creates the same partition at the same time
+# (duplicate_table, or unique_violation on the table's catalog row)
+DUPLICATE_TABLE_PGCODES = {"42P07", "23505"}
+
+ARCHIVE_TABLES = {
+    ExpenseArchive: "expenses_archive",
+    ExpenseSplitArchive: "expense_splits_archive",
+    SettlementArchive: "settlements_archive",
+}
+
+def archive_period(created_at: Optional[datetime]) -> str:
+    """Archive partition key for a row: its creation month as YYYY-MM"""
+    return (created_at or datetime.now(timezone.utc)).strftime("%Y-%m")
+
+# Periods whose partitions this process already created
+_created_partitions = set()
+
+def ensure_partitions(bind: Engine, periods):
+    """Create the monthly partitions of the archive tables (PostgreSQL only)
+
+    CREATE TABLE ... PARTITION OF locks the parent table, so each partition is
+    created in its own transaction before any row moves. A job racing another
+    one to the same partition gets a duplicate error and retries, and
+    IF NOT EXISTS then finds the table.
+    """
+    if bind.dialect.name != "postgresql":
+        return
+    for period in sorted(set(periods) - _created_partitions):
+        suffix = period.replace("-", "_")
+        for table_name in ARCHIVE_TABLES.values():
+            statement = text(
+                f"CREATE TABLE IF NOT EXISTS {table_name}_p{suffix} "
+                f"PARTITION OF {table_name} FOR VALUES IN ('{period}')"
+            )
+            for attempt in range(1, PARTITION_CREATE_ATTEMPTS + 1):
+                try:
+                    with bind.begin() as connection:
+                        connection.execute(statement)
+                    break
+                except (IntegrityError, ProgrammingError) as error:
+                    duplicate = getattr(error.orig, "pgcode", None) in DUPLICATE_TABLE_PGCODES
+                    if not duplicate or attempt == PARTITION_CREATE_ATTEMPTS:
+                        raise
+        _created_partitions.add(period)
+
+def history_periods(db: Session, group_id: int, before: Optional[datetime] = None):
+    """Archive periods of every month a group's history to archive falls in"""
+    bounds = []
+    for model in (Expense, Settlement):
+        query = db.query(func.min(model.created_at), func.max(model.created_at)).filter(model.group_id == group_id)
+        if before is not None:
+            query = query.filter(model.created_at < before)
+        bounds.extend(value for value in query.one() if value is not None)
+    # Rows without a creation time are filed under the current month
+    bounds.append(datetime.now(timezone.utc))
+    first, last = min(bounds, key=_sort_key), max(bounds, key=_sort_key)
+    periods = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        periods.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+def group_is_settled(db: Session, group_id: int) -> bool:
+    balances = crud.calculate_group_balances(db, group_id=group_id)
+    return all(crud.is_effectively_zero(balance.net_balance) for balance in balances)
+
+def archive_group_history(db: Session, group_id: int, before: Optional[datetime] = None) -> Optional[GroupCheckpoint]:
+    """Move a group's history (optionally only rows created before a cutoff) to the archive
+
+    Runs in a single transaction holding the group's ledger lock. Returns the
+    new checkpoint, or None when there was nothing to archive.
+    """
+    ledger.lock_groups(db, [group_id])
+    bind = db.get_bind()
+    if bind.dialect.name == "postgresql":
+        ensure_partitions(bind, history_periods(db, group_id, before))
+
+    expense_query = db.query(Expense).filter(Expense.group_id == group_id)
+    settlement_query = db.query(Settlement).filter(Settlement.group_id == group_id)
+    if before is not None:
+        expense_query = expense_query.filter(Expense.created_at < before)
+        settlement_query = settlement_query.filter(Settlement.created_at < before)
+
+    net_balances = defaultdict(float)
+    expense_count = 0
+    settlement_count = 0
+    total_expenses = 0.0
+    archived_through = None
+
+    # Expenses and their splits, a chunk at a time
+    while True:
+        expenses = expense_query.order_by(Expense.id).limit(ARCHIVE_CHUNK_SIZE).all()
+        if not expenses:
+            break
+        expense_ids = [expense.id for expense in expenses]
+        periods = {expense.id: archive_period(expense.created_at) for expense in expenses}
+
+        crud.accumulate_net_balances(net_balances, expenses, [])
+        split_rows = db.query(ExpenseSplit).filter(ExpenseSplit.expense_id.in_(expense_ids)).all()
+        db.execute(insert(ExpenseArchive), [{
+            "id": expense.id,
+            "archive_period": periods[expense.id],
+            "description": expense.description,
+            "amount": expense.amount,
+            "currency": expense.currency,
+            "original_amount": expense.original_amount,
+            "fx_rate": expense.fx_rate,
+            "group_id": expense.group_id,
+            "paid_by": expense.paid_by,
+            "split_type": expense.split_type,
+            "membership_snapshot_id": expense.membership_snapshot_id,
+            "remainder_rule": expense.remainder_rule,
+            "recurring_expense_id": expense.recurring_expense_id,
+            "occurrence_at": expense.occurrence_at,
+            "created_at": expense.created_at,
+        } for expense in expenses])
+        if split_rows:
+            db.execute(insert(ExpenseSplitArchive), [{
+                "id": split.id,
+                "archive_period": periods[split.expense_id],
+                "expense_id": split.expense_id,
+                "user_id": split.user_id,
+                "amount": split.amount,
+                "percentage": split.percentage,
+            } for split in split_rows])
+
+        db.query(ExpenseSplit).filter(ExpenseSplit.expense_id.in_(expense_ids)).delete(synchronize_session=False)
+        db.query(Expense).filter(Expense.id.in_(expense_ids)).delete(synchronize_session=False)
+
+        expense_count += len(expenses)
+        total_expenses += sum(expense.amount for expense in expenses)
+        archived_through = max([archived_through] + [e.created_at for e in expenses if e.created_at], key=_sort_key)
+        _expunge(db, expenses + split_rows)
+
+    # Settlements
+    while True:
+        settlements = settlement_query.order_by(Settlement.id).limit(ARCHIVE_CHUNK_SIZE).all()
+        if not settlements:
+            break
+        periods = {settlement.id: archive_period(settlement.created_at) for settlement in settlements}
+
+        crud.accumulate_net_balances(net_balances, [], settlements)
+        db.execute(insert(SettlementArchive), [{
+            "id": settlement.id,
+            "archive_period": periods[settlement.id],
+            "from_user_id": settlement.from_user_id,
+            "to_user_id": settlement.to_user_id,
+            "amount": settlement.amount,
+            "currency": settlement.currency,
+            "original_amount": settlement.original_amount,
+            "fx_rate": settlement.fx_rate,
+            "group_id": settlement.group_id,
+            "description": settlement.description,
+            "created_at": settlement.created_at,
+        } for settlement in settlements])
+        db.query(Settlement).filter(
+            Settlement.id.in_([settlement.id for settlement in settlements])
+        ).delete(synchronize_session=False)
+
+        settlement_count += len(settlements)
+        archived_through = max([archived_through] + [s.created_at for s in settlements if s.created_at], key=_sort_key)
+        _expunge(db, settlements)
+
+    if expense_count == 0 and settlement_count == 0:
+        db.rollback()
+        return None
+
+    checkpoint = GroupCheckpoint(
+        group_id=group_id,
+        archived_through=before or archived_through,
+        expense_count=expense_count,
+        settlement_count=settlement_count,
+        total_expenses=crud.round_currency(total_expenses)
+    )
+    db.add(checkpoint)
+    db.flush()
+    for user_id, amount in net_balances.items():
+        amount = crud.round_currency(amount)
+        if user_id is not None and amount != 0:
+            db.add(CheckpointBalance(checkpoint_id=checkpoint.id, group_id=group_id, user_id=user_id, amount=amount))
+
+    db.commit()
+    return checkpoint
+
+def _expunge(db: Session, objects):
+    """Drop archived rows from the session so memory stays bounded per chunk"""
+    for obj in objects:
+        if obj in db:
+            db.expunge(obj)
+
+def _sort_key(value):
+    if value is None:
+        return (0, datetime.min)
+    # SQLite returns naive datetimes; compare on wall-clock values
+    return (1, value.replace(tzinfo=None))
+
+def _hot_expenses(db: Session, group_id: int, limit: int) -> int:
+    return db.query(Expense.id).filter(Expense.group_id == group_id).limit(limit).count()
+
+def archive_if_settled(db: Session, group_id: int, min_expenses: Optional[int] = None) -> Optional[GroupCheckpoint]:
+    """Archive a group's whole history once all of its balances are zero
+
+    Settlement is checked while holding the group's ledger lock, so no write
+    can unsettle the group between the check and the move.
+    """
+    if min_expenses is None:
+        min_expenses = ARCHIVE_MIN_EXPENSES
+    # Cheap unlocked pre-check; the count is read again under the lock
+    if _hot_expenses(db, group_id, min_expenses) < min_expenses:
+        return None
+
+    def transaction():
+        ledger.lock_groups(db, [group_id])
+        if _hot_expenses(db, group_id, min_expenses) < min_expenses or not group_is_settled(db, group_id):
+            # Keeps a ledger lock_groups had to build, and releases the lock
+            db.commit()
+            return None
+        return archive_group_history(db, group_id)
+
+    return ledger.run_with_retry(db, transaction)
+
+def archive_if_settled_job(group_id: int):
+    """Post-commit job: archive a group that a settlement may have settled"""
+    db = SessionLocal()
+    try:
+        archive_if_settled(db, group_id)
+    finally:
+        db.close()
+
+def archive_stale_history(db: Session, older_than_days: int):
+    """Archive every group's history older than the retention window"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    checkpoints = []
+    for (group_id,) in db.query(Group.id).order_by(Group.id).all():
+        checkpoint = ledger.run_with_retry(db, lambda: archive_group_history(db, group_id, before=cutoff))
+        if checkpoint is not None:
+            checkpoints.append(checkpoint)
+    return checkpoints
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old group history into the archive tables")
+    parser.add_argument("--older-than-days", type=int, default=90, help="archive rows created before this many days ago")
+    parser.add_argument("--group-id", type=int, help="only archive this group")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.group_id is not None:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=args.older_than_days)
+            checkpoint = archive_group_history(db, args.group_id, before=cutoff)
+            checkpoints = [checkpoint] if checkpoint else []
+        else:
+            checkpoints = archive_stale_history(db, args.older_than_days)
+        for checkpoint in checkpoints:
+            print(f"Archived group {checkpoint.group_id}: {checkpoint.expense_count} expenses, "
+                  f"{checkpoint.settlement_count} settlements")
+        print(f"Created {len(checkpoints)} checkpoints")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+"""
+Parallel consistency audit of the ledger.
+
+Amounts are floats rounded to cents, equal splits give the rounding remainder
+to the first member and ``delete_user`` removes rows from other users'
+history, so stored data can drift from what the balance engines assume. This
+job recomputes everything from the raw rows and reports every group where:
+
+* ``split_sum`` - an expense's splits do not add up to its amount
+* ``no_participants`` - an equal split's membership snapshot has no members
+* ``net_not_zero`` - the members' net balances do not sum to zero
+* ``ledger_balance`` / ``ledger_total`` - ``group_balances`` / ``group_totals``
+  differ from the recomputed balances and totals
+* ``checkpoint_balance`` / ``checkpoint_total`` - a group's checkpoints differ
+  from the archived rows they summarize
+* ``rollup`` - ``spending_rollups`` differ from the expense history
+
+Groups are audited in id ranges across a process pool. Every range is checked
+with a handful of aggregate queries inside one repeatable-read transaction,
+so concurrent writes cannot cause false alarms and millions of rows are
+scanned in minutes.
+
+Run ``python audit.py --workers 8 --output audit.json``; the exit status is 1
+when any issue was found.
+"""
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import json
+import math
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, literal_column, select
+
+from models import (
+    Group, Expense, ExpenseSplit, Settlement, ExpenseArchive, ExpenseSplitArchive, SettlementArchive,
+    MembershipSnapshot, GroupBalance, GroupTotal, GroupCheckpoint, CheckpointBalance, SpendingRollup,
+    membership_snapshot_members, REMAINDER_FIRST_MEMBER
+)
+import database
+import money
+
+DEFAULT_TOLERANCE = 0.01  # largest acceptable difference, in currency units
+TASKS_PER_WORKER = 4  # group ranges per worker process, to even out large groups
+MAX_ISSUES_PER_GROUP = 100
+
+CHECKS = (
+    "split_sum", "no_participants", "net_not_zero", "ledger_balance", "ledger_total",
+    "checkpoint_balance", "checkpoint_total", "rollup",
+)
+
+def to_cents(amount: Optional[float]) -> int:
+    return int(round((amount or 0) * 100))
+
+def period_of(column, dialect: str):
+    """SQL expression for a timestamp's rollup month, matching analytics.rollup_period"""
+    if dialect == "sqlite":
+        # SQLite stores UTC timestamps as text
+        return func.strftime("%Y-%m", column)
+    return func.to_char(column.op("AT TIME ZONE")(literal_column("'UTC'")), "YYYY-MM")
+
+class RangeAudit:
+    """Checks of every group with an id in [low, high]"""
+
+    def __init__(self, db, low: int, high: int, tolerance: float):
+        self.db = db
+        self.low = low
+        self.high = high
+        self.tolerance_cents = to_cents(tolerance)
+        self.dialect = db.get_bind().dialect.name
+        self.issues = defaultdict(list)
+        self.rows = defaultdict(int)
+
+    def in_range(self, column):
+        return column.between(self.low, self.high)
+
+    def report(self, group_id: int, check: str, **details):
+        self.issues[group_id].append({"check": check, **details})
+
+    def differs(self, expected: int, actual: int) -> bool:
+        return abs(expected - actual) > self.tolerance_cents
+
+    def run(self) -> Dict:
+        snapshot_members = self.load_snapshot_members()
+
+        hot = self.expense_aggregates(Expense, ExpenseSplit, snapshot_members)
+        archived = self.expense_aggregates(ExpenseArchive, ExpenseSplitArchive, snapshot_members)
+        hot_nets = self.nets(hot, Settlement)
+        archived_nets = self.nets(archived, SettlementArchive)
+
+        self.check_splits(Expense, ExpenseSplit, archived=False)
+        self.check_splits(ExpenseArchive, ExpenseSplitArchive, archived=True)
+        self.check_participants(Expense)
+        self.check_participants(ExpenseArchive)
+        carried = self.check_checkpoints(archived, archived_nets)
+
+        # Current balances are the hot rows plus what checkpoints carried forward
+        nets = defaultdict(int, hot_nets)
+        for key, cents in carried.items():
+            nets[key] += cents
+        self.check_nets(nets)
+        self.check_ledger(nets, hot)
+        self.check_rollups(hot, archived)
+
+        return {
+            "rows": dict(self.rows),
+            "issues": {group_id: issues for group_id, issues in self.issues.items()},
+        }
+
+    def load_snapshot_members(self) -> Dict[int, List[int]]:
+        """Member ids of every membership snapshot of the range, in position order"""
+        members = defaultdict(list)
+        rows = self.db.execute(
+            select(membership_snapshot_members.c.snapshot_id, membership_snapshot_members.c.user_id)
+            .join(MembershipSnapshot, MembershipSnapshot.id == membership_snapshot_members.c.snapshot_id)
+            .where(self.in_range(MembershipSnapshot.group_id))
+            .order_by(membership_snapshot_members.c.snapshot_id, membership_snapshot_members.c.position)
+        )
+        for snapshot_id, user_id in rows:
+            members[snapshot_id].append(user_id)
+        return members
+
+    def expense_aggregates(self, expense_model, split_model, snapshot_members):
+        """(group, user, period) -> [paid cents, owed cents, expenses paid, expenses shared]"""
+        totals = defaultdict(lambda: [0, 0, 0, 0])
+        period = period_of(expense_model.created_at, self.dialect)
+
+        for group_id, user_id, month, paid, count in self.db.execute(
+            select(expense_model.group_id, expense_model.paid_by, period, func.sum(expense_model.amount), func.count())
+            .where(self.in_range(expense_model.group_id))
+            .group_by(expense_model.group_id, expense_model.paid_by, period)
+        ):
+            totals[(group_id, user_id, month)][0] += to_cents(paid)
+            totals[(group_id, user_id, month)][2] += count
+            self.rows[expense_model.__tablename__] += count
+
+        for group_id, user_id, month, owed, count in self.db.execute(
+            select(expense_model.group_id, split_model.user_id, period, func.sum(split_model.amount), func.count())
+            .join(expense_model, split_model.expense_id == expense_model.id)
+            .where(self.in_range(expense_model.group_id))
+            .group_by(expense_model.group_id, split_model.user_id, period)
+        ):
+            totals[(group_id, user_id, month)][1] += to_cents(owed)
+            totals[(group_id, user_id, month)][3] += count
+            self.rows[split_model.__tablename__] += count
+
+        # Equal splits: derive the shares once per distinct (snapshot, amount, month)
+        for group_id, snapshot_id, amount, rule, month, count in self.db.execute(
+            select(
+                expense_model.group_id, expense_model.membership_snapshot_id, expense_model.amount,
+                expense_model.remainder_rule, period, func.count()
+            )
+            .where(self.in_range(expense_model.group_id), expense_model.membership_snapshot_id.isnot(None))
+            .group_by(
+                expense_model.group_id, expense_model.membership_snapshot_id, expense_model.amount,
+                expense_model.remainder_rule, period
+            )
+        ):
+            members = snapshot_members.get(snapshot_id, [])
+            shares = money.equal_split_amounts(amount, len(members), rule or REMAINDER_FIRST_MEMBER)
+            for user_id, share in zip(members, shares):
+                totals[(group_id, user_id, month)][1] += to_cents(share) * count
+                totals[(group_id, user_id, month)][3] += count
+        return totals
+
+    def nets(self, aggregates, settlement_model) -> Dict:
+        """(group, user) -> net cents from expense aggregates and settlements"""
+        nets = defaultdict(int)
+        for (group_id, user_id, _), (paid, owed, _, _) in aggregates.items():
+            nets[(group_id, user_id)] += paid - owed
+        for user_column, sign in ((settlement_model.from_user_id, 1), (settlement_model.to_user_id, -1)):
+            for group_id, user_id, amount, count in self.db.execute(
+                select(settlement_model.group_id, user_column, func.sum(settlement_model.amount), func.count())
+                .where(self.in_range(settlement_model.group_id))
+                .group_by(settlement_model.group_id, user_column)
+            ):
+                nets[(group_id, user_id)] += sign * to_cents(amount)
+                if sign > 0:
+                    self.rows[settlement_model.__tablename__] += count
+        return nets
+
+    def check_splits(self, expense_model, split_model, archived: bool):
+        # Sum the splits per expense first; joining every expense to its
+        # splits would need an index on expense_id the hot table doesn't have
+        split_totals = {
+            expense_id: (total, count)
+            for expense_id, total, count in self.db.execute(
+                select(split_model.expense_id, func.sum(split_model.amount), func.count())
+                .join(expense_model, split_model.expense_id == expense_model.id)
+                .where(self.in_range(expense_model.group_id), expense_model.membership_snapshot_id.is_(None))
+                .group_by(split_model.expense_id)
+            )
+        }
+        rows = self.db.execute(
+            select(expense_model.group_id, expense_model.id, expense_model.amount)
+            .where(self.in_range(expense_model.group_id), expense_model.membership_snapshot_id.is_(None))
+        )
+        for group_id, expense_id, amount in rows:
+            total, count = split_totals.get(expense_id, (0, 0))
+            if self.differs(to_cents(amount), to_cents(total)):
+                self.report(
+                    group_id, "split_sum", expense_id=expense_id, archived=archived,
+                    amount=amount, split_total=money.round_currency(total), splits=count
+                )
+
+    def check_participants(self, expense_model):
+        rows = self.db.execute(
+            select(expense_model.group_id, expense_model.id, expense_model.membership_snapshot_id)
+            .where(
+                self.in_range(expense_model.group_id),
+                expense_model.membership_snapshot_id.isnot(None),
+                expense_model.membership_snapshot_id.not_in(select(membership_snapshot_members.c.snapshot_id))
+            )
+        )
+        for group_id, expense_id, snapshot_id in rows:
+            self.report(
+                group_id, "no_participants", expense_id=expense_id, snapshot_id=snapshot_id,
+                archived=expense_model is ExpenseArchive
+            )
+
+    def check_checkpoints(self, archived, archived_nets) -> Dict:
+        """Compare checkpoints with the archived rows; returns the carried (group, user) cents"""
+        carried = defaultdict(int)
+        for group_id, user_id, amount in self.db.execute(
+            select(CheckpointBalance.group_id, CheckpointBalance.user_id, func.sum(CheckpointBalance.amount))
+            .where(self.in_range(CheckpointBalance.group_id))
+            .group_by(CheckpointBalance.group_id, CheckpointBalance.user_id)
+        ):
+            carried[(group_id, user_id)] += to_cents(amount)
+
+        for key in sorted(set(carried) | {key for key, cents in archived_nets.items() if cents}):
+            if self.differs(archived_nets.get(key, 0), carried.get(key, 0)):
+                self.report(
+                    key[0], "checkpoint_balance", user_id=key[1],
+                    archived=archived_nets.get(key, 0) / 100, checkpoint=carried.get(key, 0) / 100
+                )
+
+        archived_totals = defaultdict(lambda: [0, 0])
+        for (group_id, _, _), (paid, _, count, _) in archived.items():
+            archived_totals[group_id][0] += paid
+            archived_totals[group_id][1] += count
+        for group_id, total, count in self.db.execute(
+            select(GroupCheckpoint.group_id, func.sum(GroupCheckpoint.total_expenses), func.sum(GroupCheckpoint.expense_count))
+            .where(self.in_range(GroupCheckpoint.group_id))
+            .group_by(GroupCheckpoint.group_id)
+        ):
+            archived_total, archived_count = archived_totals.get(group_id, (0, 0))
+            if self.differs(archived_total, to_cents(total)) or archived_count != count:
+                self.report(
+                    group_id, "checkpoint_total",
+                    archived_total=archived_total / 100, checkpoint_total=money.round_currency(total),
+                    archived_expenses=archived_count, checkpoint_expenses=count
+                )
+        return carried
+
+    def check_nets(self, nets):
+        group_sums = defaultdict(int)
+        for (group_id, _), cents in nets.items():
+            group_sums[group_id] += cents
+        for group_id, cents in sorted(group_sums.items()):
+            if self.differs(0, cents):
+                self.report(group_id, "net_not_zero", total=cents / 100)
+
+    def check_ledger(self, nets, hot):
+        ledger_nets = {
+            (group_id, user_id): to_cents(net)
+            for group_id, user_id, net in self.db.execute(
+                select(GroupBalance.group_id, GroupBalance.user_id, GroupBalance.net)
+                .where(self.in_range(GroupBalance.group_id))
+            )
+        }
+        ledger_groups = {group_id for group_id, _ in ledger_nets}
+        ledger_totals = {
+            group_id: (to_cents(total), expense_count, settlement_count)
+            for group_id, total, expense_count, settlement_count in self.db.execute(
+                select(GroupTotal.group_id, GroupTotal.total_expenses, GroupTotal.expense_count, GroupTotal.settlement_count)
+                .where(self.in_range(GroupTotal.group_id))
+            )
+        }
+        # Groups created before the ledger existed have no rows and nothing to compare
+        ledger_groups |= set(ledger_totals)
+
+        for key in sorted(set(ledger_nets) | set(nets)):
+            if key[0] not in ledger_groups or key[1] is None:
+                continue
+            expected, actual = nets.get(key, 0), ledger_nets.get(key, 0)
+            if self.differs(expected, actual):
+                self.report(key[0], "ledger_balance", user_id=key[1], expected=expected / 100, ledger=actual / 100)
+
+        expected_totals = defaultdict(lambda: [0, 0, 0])
+        for (group_id, _, _), (paid, _, count, _) in hot.items():
+            expected_totals[group_id][0] += paid
+            expected_totals[group_id][1] += count
+        for group_id, count in self.db.execute(
+            select(Settlement.group_id, func.count()).where(self.in_range(Settlement.group_id)).group_by(Settlement.group_id)
+        ):
+            expected_totals[group_id][2] += count
+        for group_id, total, expense_count, settlement_count in self.db.execute(
+            select(
+                GroupCheckpoint.group_id, func.sum(GroupCheckpoint.total_expenses),
+                func.sum(GroupCheckpoint.expense_count), func.sum(GroupCheckpoint.settlement_count)
+            ).where(self.in_range(GroupCheckpoint.group_id)).group_by(GroupCheckpoint.group_id)
+        ):
+            expected_totals[group_id][0] += to_cents(total)
+            expected_totals[group_id][1] += expense_count or 0
+            expected_totals[group_id][2] += settlement_count or 0
+
+        for group_id, (total, expense_count, settlement_count) in sorted(ledger_totals.items()):
+            expected = expected_totals.get(group_id, [0, 0, 0])
+            if self.differs(expected[0], total) or expected[1] != expense_count or expected[2] != settlement_count:
+                self.report(
+                    group_id, "ledger_total",
+                    expected={"total_expenses": expected[0] / 100, "expense_count": expected[1], "settlement_count": expected[2]},
+                    ledger={"total_expenses": total / 100, "expense_count": expense_count, "settlement_count": settlement_count}
+                )
+
+    def check_rollups(self, hot, archived):
+        expected = defaultdict(lambda: [0, 0, 0, 0])
+        for aggregates in (hot, archived):
+            for key, values in aggregates.items():
+                if key[1] is None:
+                    continue
+                for index, value in enumerate(values):
+                    expected[key][index] += value
+        actual = {
+            (group_id, user_id, period): [to_cents(paid), to_cents(owed), expenses_paid, expenses_shared]
+            for group_id, user_id, period, paid, owed, expenses_paid, expenses_shared in self.db.execute(
+                select(
+                    SpendingRollup.group_id, SpendingRollup.user_id, SpendingRollup.period, SpendingRollup.paid,
+                    SpendingRollup.owed, SpendingRollup.expenses_paid, SpendingRollup.expenses_shared
+                ).where(self.in_range(SpendingRollup.group_id))
+            )
+        }
+        for key in sorted(set(expected) | set(actual)):
+            want = expected.get(key, [0, 0, 0, 0])
+            have = actual.get(key, [0, 0, 0, 0])
+            if self.differs(want[0], have[0]) or self.differs(want[1], have[1]) or want[2:] != have[2:]:
+                self.report(
+                    key[0], "rollup", user_id=key[1], period=key[2],
+                    expected={"paid": want[0] / 100, "owed": want[1] / 100, "expenses_paid": want[2], "expenses_shared": want[3]},
+                    rollup={"paid": have[0] / 100, "owed": have[1] / 100, "expenses_paid": have[2], "expenses_shared": have[3]}
+                )
+
+def _init_worker():
+    # Connections inherited from the parent process must not be shared
+    database.engine.dispose(close=False)
+    database.replica_engine.dispose(close=False)
+
+def audit_range(low: int, high: int, tolerance: float = DEFAULT_TOLERANCE, use_primary: bool = False) -> Dict:
+    """Audit the groups with ids in [low, high] from one consistent snapshot
+
+    Reads the replica unless ``use_primary`` is set, e.g. to check writes
+    that were just made.
+    """
+    db = database.SessionLocal() if use_primary else database.ReplicaSessionLocal()
+    try:
+        if db.get_bind().dialect.name == "postgresql":
+            db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        return RangeAudit(db, low, high, tolerance).run()
+    finally:
+        db.rollback()
+        db.close()
+
+def group_ranges(group_ids: List[int], batch_size: int):
+    group_ids = sorted(group_ids)
+    for start in range(0, len(group_ids), batch_size):
+        batch = group_ids[start:start + batch_size]
+        yield batch[0], batch[-1]
+
+def run_audit(workers: Optional[int] = None, batch_size: Optional[int] = None,
+              tolerance: float = DEFAULT_TOLERANCE, group_ids: Optional[List[int]] = None) -> Dict:
+    """Audit every group (or the given ones) in parallel and build the report"""
+    started_at = datetime.now(timezone.utc)
+    start_time = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+
+    db = database.ReplicaSessionLocal()
+    try:
+        if group_ids is None:
+            group_ids = [row[0] for row in db.execute(select(Group.id))]
+    finally:
+        db.close()
+    selected = set(group_ids)
+    # Each range scans the expense tables once, so use a few large ranges per
+    # worker rather than many small ones
+    batch_size = batch_size or max(1, math.ceil(len(selected) / (workers * TASKS_PER_WORKER)))
+
+    rows = defaultdict(int)
+    issues = {}
+    ranges = list(group_ranges(selected, batch_size))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(audit_range, low, high, tolerance) for low, high in ranges]
+        for future in futures:
+            result = future.result()
+            for table, count in result["rows"].items():
+                rows[table] += count
+            for group_id, group_issues in result["issues"].items():
+                if group_id in selected:
+                    issues[group_id] = group_issues
+
+    issues_by_check = {check: 0 for check in CHECKS}
+    groups = []
+    for group_id in sorted(issues):
+        group_issues = issues[group_id]
+        for issue in group_issues:
+            issues_by_check[issue["check"]] += 1
+        groups.append({
+            "group_id": group_id,
+            "issue_count": len(group_issues),
+            "issues": group_issues[:MAX_ISSUES_PER_GROUP],
+        })
+
+    return {
+        "started_at": started_at.isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "duration_seconds": round(time.monotonic() - start_time, 3),
+        "workers": workers,
+        "tolerance": tolerance,
+        "groups_checked": len(selected),
+        "groups_with_issues": len(groups),
+        "rows_checked": dict(rows),
+        "issues_by_check": issues_by_check,
+        "groups": groups,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Check ledger consistency of every group in parallel")
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, help="groups per task (default: spread over the workers)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="largest acceptable difference")
+    parser.add_argument("--group-id", type=int, action="append", help="only audit this group (repeatable)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run_audit(
+        workers=args.workers, batch_size=args.batch_size, tolerance=args.tolerance, group_ids=args.group_id
+    )
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+        print(f"Audited {report['groups_checked']} groups in {report['duration_seconds']}s: "
+              f"{report['groups_with_issues']} with issues", file=sys.stderr)
+    else:
+        print(text)
+    sys.exit(1 if report["groups_with_issues"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Vectorized group balance computation for very large groups.
+
+The scalar engine in ``crud.calculate_group_balances`` walks ORM objects one
+split at a time. Above ``VECTORIZED_BALANCE_THRESHOLD`` splits this module is
+used instead: the ``(user_id, amount)`` columns are fetched in bulk, amounts
+are converted to integer cents and reduced with ``np.bincount`` over a compact
+index of the group's members. Summing exact cents and rounding once gives the
+same figures as the scalar path, which rounds its float sums to cents.
+
+NumPy is optional; when it is not installed the scalar engine is always used.
+"""
+
+import os
+from typing import List
+
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.orm import Session
+
+from models import Group, Expense, ExpenseSplit, Settlement, CheckpointBalance, membership_snapshot_members
+import money
+import schemas
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - exercised only without numpy
+    np = None
+
+VECTORIZED_BALANCE_THRESHOLD = int(os.getenv("VECTORIZED_BALANCE_THRESHOLD", "50000"))
+
+def is_available() -> bool:
+    return np is not None
+
+def has_split_count(db: Session, group_id: int, threshold: int) -> bool:
+    """Whether a group's expenses have at least ``threshold`` shares, stored as rows or derived from equal splits
+
+    A single probe for the threshold-th share: the database stops reading
+    there instead of counting every share of a large group.
+    """
+    if threshold <= 0:
+        return True
+    shares = union_all(
+        select(ExpenseSplit.id).join(Expense, ExpenseSplit.expense_id == Expense.id).where(Expense.group_id == group_id),
+        select(Expense.id).join(
+            membership_snapshot_members,
+            membership_snapshot_members.c.snapshot_id == Expense.membership_snapshot_id
+        ).where(Expense.group_id == group_id)
+    ).subquery()
+    probe = select(literal(1)).select_from(shares).limit(1).offset(threshold - 1)
+    return db.execute(probe).first() is not None
+
+def should_vectorize(db: Session, group_id: int) -> bool:
+    return is_available() and has_split_count(db, group_id, VECTORIZED_BALANCE_THRESHOLD)
+
+def _fetch_columns(db: Session, statement):
+    """Run a two-column query and return (ids, cents) arrays"""
+    rows = db.execute(statement).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    ids = np.fromiter((row[0] if row[0] is not None else -1 for row in rows), dtype=np.int64, count=len(rows))
+    amounts = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    return ids, to_cents(amounts)
+
+def to_cents(amounts):
+    """Convert 2-decimal monetary floats to exact integer cents"""
+    return np.rint(amounts * 100).astype(np.int64)
+
+def accumulate(net_cents, sorted_ids, order, user_ids, cents, sign: int):
+    """Add signed cents per user into ``net_cents`` (indexed by member position)"""
+    if user_ids.size == 0:
+        return
+    positions = np.searchsorted(sorted_ids, user_ids)
+    positions = np.minimum(positions, sorted_ids.size - 1)
+    is_member = sorted_ids[positions] == user_ids
+    index = order[positions[is_member]]
+    # Float weights sum exactly while totals stay below 2**53 cents
+    net_cents += sign * np.bincount(index, weights=cents[is_member], minlength=net_cents.size).astype(np.int64)
+
+def implicit_share_cents(db: Session, group_id: int):
+    """Per-user cents owed through equal splits stored as membership snapshots
+
+    Each expense's base share and remainder are computed once per distinct
+    (amount, participant count) pair with the same rounding as the scalar
+    engine, summed per snapshot, and then spread over the snapshot members.
+    """
+    expense_rows = db.execute(
+        select(Expense.membership_snapshot_id, Expense.amount)
+        .where(Expense.group_id == group_id, Expense.membership_snapshot_id.isnot(None))
+    ).all()
+    if not expense_rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    snapshot_of_expense = np.fromiter((row[0] for row in expense_rows), dtype=np.int64, count=len(expense_rows))
+    amounts = np.fromiter((row[1] for row in expense_rows), dtype=np.float64, count=len(expense_rows))
+
+    member_rows = db.execute(
+        select(
+            membership_snapshot_members.c.snapshot_id,
+            membership_snapshot_members.c.user_id,
+            membership_snapshot_members.c.position
+        ).where(membership_snapshot_members.c.snapshot_id.in_(np.unique(snapshot_of_expense).tolist()))
+    ).all()
+    member_snapshot = np.array([row[0] for row in member_rows], dtype=np.int64)
+    member_user = np.array([row[1] for row in member_rows], dtype=np.int64)
+    member_position = np.array([row[2] for row in member_rows], dtype=np.int64)
+
+    # Compact snapshot index shared by expenses and snapshot members
+    snapshot_ids, snapshot_index = np.unique(np.concatenate([snapshot_of_expense, member_snapshot]), return_inverse=True)
+    expense_snapshot_index = snapshot_index[:snapshot_of_expense.size]
+    member_snapshot_index = snapshot_index[snapshot_of_expense.size:]
+    participants = np.bincount(member_snapshot_index, minlength=snapshot_ids.size)
+    first_position = np.full(snapshot_ids.size, np.iinfo(np.int64).max)
+    np.minimum.at(first_position, member_snapshot_index, member_position)
+
+    # Base share and remainder for each distinct (amount, participant count)
+    counts = participants[expense_snapshot_index]
+    pairs, pair_index = np.unique(np.stack([to_cents(amounts), counts]), axis=1, return_inverse=True)
+    base = np.empty(pairs.shape[1], dtype=np.int64)
+    remainder = np.empty(pairs.shape[1], dtype=np.int64)
+    for i, (amount_cents, count) in enumerate(pairs.T):
+        shares = money.equal_split_amounts(int(amount_cents) / 100, int(count))
+        base[i] = round(shares[-1] * 100)
+        remainder[i] = round(shares[0] * 100) - base[i]
+    pair_index = pair_index.reshape(-1)
+
+    base_per_snapshot = np.bincount(expense_snapshot_index, weights=base[pair_index], minlength=snapshot_ids.size)
+    remainder_per_snapshot = np.bincount(expense_snapshot_index, weights=remainder[pair_index], minlength=snapshot_ids.size)
+
+    owed = base_per_snapshot[member_snapshot_index]
+    is_first = member_position == first_position[member_snapshot_index]
+    owed = owed + np.where(is_first, remainder_per_snapshot[member_snapshot_index], 0)
+    return member_user, owed.astype(np.int64)
+
+def member_net_cents(db: Session, group: Group, member_ids):
+    """Net balance in cents for each member, in the order of ``member_ids``"""
+    net_cents = np.zeros(member_ids.size, dtype=np.int64)
+    if member_ids.size == 0:
+        return net_cents
+    order = np.argsort(member_ids, kind="stable")
+    sorted_ids = member_ids[order]
+
+    payers, paid = _fetch_columns(db, select(Expense.paid_by, Expense.amount).where(Expense.group_id == group.id))
+    accumulate(net_cents, sorted_ids, order, payers, paid, 1)
+
+    debtors, owed = _fetch_columns(
+        db,
+        select(ExpenseSplit.user_id, ExpenseSplit.amount)
+        .join(Expense, ExpenseSplit.expense_id == Expense.id)
+        .where(Expense.group_id == group.id)
+    )
+    accumulate(net_cents, sorted_ids, order, debtors, owed, -1)
+
+    participants, shares = implicit_share_cents(db, group.id)
+    accumulate(net_cents, sorted_ids, order, participants, shares, -1)
+
+    senders, sent = _fetch_columns(
+        db, select(Settlement.from_user_id, Settlement.amount).where(Settlement.group_id == group.id)
+    )
+    accumulate(net_cents, sorted_ids, order, senders, sent, 1)
+
+    receivers, received = _fetch_columns(
+        db, select(Settlement.to_user_id, Settlement.amount).where(Settlement.group_id == group.id)
+    )
+    accumulate(net_cents, sorted_ids, order, receivers, received, -1)
+
+    carried_users, carried = _fetch_columns(
+        db, select(CheckpointBalance.user_id, CheckpointBalance.amount).where(CheckpointBalance.group_id == group.id)
+    )
+    accumulate(net_cents, sorted_ids, order, carried_users, carried, 1)
+    return net_cents
+
+def calculate_group_balances(db: Session, group: Group) -> List[schemas.Balance]:
+    """Vectorized equivalent of the scalar ``crud.calculate_group_balances``"""
+    members = list(group.members)
+    member_ids = np.array([member.id for member in members], dtype=np.int64)
+    net_cents = member_net_cents(db, group, member_ids)
+
+    # Every debtor is pointed at the largest creditor and every creditor at the
+    # largest debtor; argmax/argmin return the first member on ties, matching
+    # the stable sort used by the scalar engine
+    top_creditor = int(np.argmax(net_cents)) if net_cents.size and net_cents.max() > 0 else None
+    top_debtor = int(np.argmin(net_cents)) if net_cents.size and net_cents.min() < 0 else None
+
+    # Balances within the 0.02 tolerance of is_effectively_zero are reported as settled
+    reported_cents = np.where(np.abs(net_cents) < 2, 0, net_cents)
+
+    balances = []
+    for index, member in enumerate(members):
+        user_balance = int(reported_cents[index]) / 100
+        owes_to = []
+        owed_by = []
+
+        if user_balance < 0 and top_creditor is not None:
+            owes_to.append({
+                "user_id": members[top_creditor].id,
+                "user_name": members[top_creditor].name,
+                "amount": abs(user_balance)
+            })
+        elif user_balance > 0 and top_debtor is not None:
+            owed_by.append({
+                "user_id": members[top_debtor].id,
+                "user_name": members[top_debtor].name,
+                "amount": user_balance
+            })
+
+        balances.append(schemas.Balance(
+            user_id=member.id,
+            user_name=member.name,
+            group_id=group.id,
+            group_name=group.name,
+            owes_to=owes_to,
+            owed_by=owed_by,
+            net_balance=user_balance
+        ))
+
+    return balances
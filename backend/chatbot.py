@@ -0,0 +1,413 @@
+"""
+Local natural-language queries over the ledger.
+
+``POST /query`` answers the common chatbot questions without calling an
+external model. A question is normalized and matched against a fixed list of
+templates; the user and group names it mentions are resolved through an
+in-memory ``NameIndex`` with fuzzy prefix matching ("goa" or "goa trp" find
+"Goa Trip"), and the answer comes from the same balance, expense and
+analytics queries as the REST endpoints. Answers are deterministic and take
+milliseconds.
+
+"I", "me" and "my" refer to the ``user_id`` sent with the question. Amounts
+are written in the base currency of the group they belong to; totals over
+several groups are given per currency.
+"""
+
+from collections import defaultdict
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, joinedload
+
+from models import User, Group, Expense, group_members, DEFAULT_CURRENCY
+import analytics
+import crud
+import money
+import schemas
+
+# Seconds before the name index is rebuilt even without local changes, so
+# renames made through other server processes are picked up
+NAME_INDEX_TTL = float(os.getenv("NAME_INDEX_TTL", "60"))
+
+DEFAULT_EXPENSE_COUNT = 5
+MAX_EXPENSE_COUNT = 50
+
+SELF_REFERENCES = {"i", "me", "my", "mine", "myself"}
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+
+# Currencies written with their symbol; others are written as their ISO code
+CURRENCY_SYMBOLS = {"INR": "₹", "USD": "$", "EUR": "€", "GBP": "£", "JPY": "¥"}
+
+USER = "user"
+GROUP = "group"
+
+class QueryError(Exception):
+    """A question that matched a template but cannot be answered as asked"""
+
+def normalize(text: str) -> str:
+    text = text.lower().replace("’", "'")
+    text = re.sub(r"'s\b", "", text)
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+def format_amount(amount: float, currency: str = DEFAULT_CURRENCY) -> str:
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    if symbol is not None:
+        return f"{symbol}{abs(amount):.2f}"
+    return f"{currency} {abs(amount):.2f}"
+
+def format_totals(totals: Dict[str, float]) -> str:
+    """Amounts in several currencies, e.g. ₹120.00 and $15.00"""
+    return " and ".join(format_amount(amount, currency) for currency, amount in sorted(totals.items()))
+
+def group_currencies(db: Session, group_ids) -> Dict[int, str]:
+    """Base currency of each group"""
+    group_ids = set(group_ids)
+    if not group_ids:
+        return {}
+    return dict(db.query(Group.id, Group.base_currency).filter(Group.id.in_(group_ids)))
+
+def _within_one_edit(a: str, b: str) -> bool:
+    """Whether two strings differ by at most one insertion, deletion or substitution"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = j = edits = 0
+    while i < len(a) and j < len(b):
+        if a[i] != b[j]:
+            edits += 1
+            if edits > 1:
+                return False
+            if len(a) == len(b):
+                i += 1
+        else:
+            i += 1
+        j += 1
+    return edits + (len(b) - j) <= 1
+
+def _token_match(query_token: str, name_token: str) -> Optional[bool]:
+    """True for a prefix match, False for a prefix match with one typo, None otherwise"""
+    if name_token.startswith(query_token):
+        return True
+    if len(query_token) >= 3:
+        for length in (len(query_token) - 1, len(query_token), len(query_token) + 1):
+            if _within_one_edit(query_token, name_token[:length]):
+                return False
+    return None
+
+def match_score(query_tokens: List[str], name_tokens: List[str]) -> int:
+    """How well a phrase names an entity; 0 means it does not match"""
+    if query_tokens == name_tokens:
+        return 100
+    best = 0
+    for start in range(len(name_tokens) - len(query_tokens) + 1):
+        exact = True
+        for offset, query_token in enumerate(query_tokens):
+            matched = _token_match(query_token, name_tokens[start + offset])
+            if matched is None:
+                break
+            exact = exact and matched
+        else:
+            # Matches from the first word beat matches inside the name, and
+            # names with fewer unmatched words beat longer ones
+            score = (80 if start == 0 else 60) - (0 if exact else 30)
+            score -= len(name_tokens) - len(query_tokens)
+            best = max(best, score)
+    return best
+
+class NameIndex:
+    """In-memory index of user and group names for fuzzy prefix lookups"""
+
+    def __init__(self, ttl: float = NAME_INDEX_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._names: Dict[str, Dict[int, Tuple[str, List[str]]]] = {USER: {}, GROUP: {}}
+        self._by_initial: Dict[str, Dict[str, set]] = {USER: defaultdict(set), GROUP: defaultdict(set)}
+        self._built_at: Optional[float] = None
+
+    def invalidate(self):
+        """Force a rebuild on the next lookup, e.g. after a user or group was renamed"""
+        with self._lock:
+            self._built_at = None
+
+    def ensure_fresh(self, db: Session):
+        with self._lock:
+            if self._built_at is not None and time.monotonic() - self._built_at < self._ttl:
+                return
+        self.rebuild(db)
+
+    def rebuild(self, db: Session):
+        names = {USER: {}, GROUP: {}}
+        by_initial = {USER: defaultdict(set), GROUP: defaultdict(set)}
+        for kind, model in ((USER, User), (GROUP, Group)):
+            for entity_id, name in db.query(model.id, model.name):
+                tokens = normalize(name).split()
+                names[kind][entity_id] = (name, tokens)
+                for token in tokens:
+                    by_initial[kind][token[0]].add(entity_id)
+        with self._lock:
+            self._names = names
+            self._by_initial = by_initial
+            self._built_at = time.monotonic()
+
+    def lookup(self, kind: str, phrase: str) -> List[Tuple[int, str]]:
+        """Best matching (id, name) pairs for a phrase; more than one means it is ambiguous"""
+        query_tokens = normalize(phrase).split()
+        if not query_tokens:
+            return []
+        with self._lock:
+            names = self._names[kind]
+            candidates = self._by_initial[kind].get(query_tokens[0][0], set())
+            scored = [
+                (match_score(query_tokens, names[entity_id][1]), entity_id)
+                for entity_id in candidates
+            ]
+            best = max((score for score, _ in scored), default=0)
+            if best == 0:
+                return []
+            return sorted((entity_id, names[entity_id][0]) for score, entity_id in scored if score == best)
+
+name_index = NameIndex()
+
+class Question:
+    """Entities and values extracted from a question by its template"""
+
+    def __init__(self, db: Session, match: re.Match, user_id: Optional[int]):
+        self.db = db
+        self.match = match
+        self.user_id = user_id
+
+    def _phrase(self, name: str) -> Optional[str]:
+        value = self.match.groupdict().get(name)
+        if value is None:
+            return None
+        # Drop filler words around a name, e.g. "the group goa trip"
+        value = re.sub(r"^(?:the )?(?:group |user )?", "", value.strip())
+        return value or None
+
+    def user(self, required: bool = True) -> Optional[User]:
+        phrase = self._phrase("user")
+        if phrase is None:
+            if required:
+                raise QueryError("Which user do you mean?")
+            return None
+        if phrase in SELF_REFERENCES:
+            if self.user_id is None:
+                raise QueryError("Send your user_id with the question so I know who \"I\" and \"my\" refer to.")
+            user = crud.get_user(self.db, user_id=self.user_id)
+            if user is None:
+                raise QueryError(f"User {self.user_id} does not exist.")
+            return user
+        return self.db.query(User).filter(User.id == self._resolve(USER, phrase)).first()
+
+    def group(self, required: bool = True) -> Optional[Group]:
+        phrase = self._phrase("group")
+        if phrase is None:
+            if required:
+                raise QueryError("Which group do you mean?")
+            return None
+        return self.db.query(Group).filter(Group.id == self._resolve(GROUP, phrase)).first()
+
+    def _resolve(self, kind: str, phrase: str) -> int:
+        matches = name_index.lookup(kind, phrase)
+        if not matches:
+            raise QueryError(f"I couldn't find a {kind} called \"{phrase}\".")
+        if len(matches) > 1:
+            options = ", ".join(name for _, name in matches[:5])
+            raise QueryError(f"\"{phrase}\" could mean several {kind}s: {options}. Which one?")
+        return matches[0][0]
+
+    def count(self) -> int:
+        value = self.match.groupdict().get("count")
+        if value is None:
+            return DEFAULT_EXPENSE_COUNT
+        value = value.strip()
+        count = int(value) if value.isdigit() else NUMBER_WORDS.get(value, DEFAULT_EXPENSE_COUNT)
+        return max(1, min(count, MAX_EXPENSE_COUNT))
+
+# Reusable pattern pieces
+IN_GROUP = r"(?: (?:in|for|within|on) (?P<group>.+))?"
+IN_GROUP_REQUIRED = r" (?:in|for|within|on|of) (?P<group>.+)"
+
+def answer_user_balance(question: Question):
+    user = question.user()
+    group = question.group(required=False)
+    if group is not None:
+        balances = crud.calculate_group_balances(question.db, group_id=group.id)
+        balance = next((b for b in balances if b.user_id == user.id), None)
+        if balance is None:
+            raise QueryError(f"{user.name} is not a member of {group.name}.")
+        return describe_balance(balance, f" in {group.name}", group.base_currency), [balance]
+
+    balances = crud.calculate_user_balances(question.db, user_id=user.id)
+    open_balances = [balance for balance in balances if not crud.is_effectively_zero(balance.net_balance)]
+    if not open_balances:
+        return f"{user.name} is settled up in every group.", balances
+    currencies = group_currencies(question.db, (balance.group_id for balance in balances))
+    lines = [
+        describe_balance(balance, f" in {balance.group_name}", currencies.get(balance.group_id, DEFAULT_CURRENCY))
+        for balance in open_balances
+    ]
+    # Overall figures per currency, where more than one group adds up
+    by_currency = defaultdict(list)
+    for balance in open_balances:
+        by_currency[currencies.get(balance.group_id, DEFAULT_CURRENCY)].append(balance.net_balance)
+    for currency, nets in sorted(by_currency.items()):
+        net = money.round_currency(sum(nets))
+        if len(nets) < 2:
+            continue
+        if net < 0:
+            lines.append(f"Overall {user.name} owes {format_amount(net, currency)}.")
+        elif net > 0:
+            lines.append(f"Overall {user.name} is owed {format_amount(net, currency)}.")
+    return " ".join(lines), balances
+
+def describe_balance(balance: schemas.Balance, where: str, currency: str) -> str:
+    if crud.is_effectively_zero(balance.net_balance):
+        return f"{balance.user_name} is settled up{where}."
+    if balance.net_balance < 0:
+        to = "".join(f" to {entry['user_name']}" for entry in balance.owes_to)
+        return f"{balance.user_name} owes {format_amount(balance.net_balance, currency)}{to}{where}."
+    by = "".join(f" by {entry['user_name']}" for entry in balance.owed_by)
+    return f"{balance.user_name} is owed {format_amount(balance.net_balance, currency)}{by}{where}."
+
+def answer_group_balances(question: Question):
+    group = question.group()
+    balances = crud.calculate_group_balances(question.db, group_id=group.id)
+    open_balances = [balance for balance in balances if balance.net_balance < 0]
+    if not open_balances:
+        return f"Everyone in {group.name} is settled up.", balances
+    return " ".join(describe_balance(balance, "", group.base_currency) for balance in open_balances), balances
+
+def answer_top_payer(question: Question):
+    group = question.group()
+    stats = analytics.get_group_stats(question.db, group)
+    if not stats.members or stats.members[0].paid <= 0:
+        return f"Nobody has paid for anything in {group.name} yet.", stats
+    top = stats.members[0]
+    return (
+        f"{top.user_name} paid the most in {group.name}: {format_amount(top.paid, group.base_currency)} "
+        f"across {top.expenses_paid} expense{'s' if top.expenses_paid != 1 else ''}."
+    ), stats
+
+def answer_user_spending(question: Question):
+    user = question.user()
+    group = question.group(required=False)
+    stats = analytics.get_user_stats(question.db, user)
+    if group is not None:
+        spending = next((entry for entry in stats.groups if entry.group_id == group.id), None)
+        paid = spending.paid if spending else 0
+        owed = spending.owed if spending else 0
+        return (
+            f"{user.name} paid {format_amount(paid, group.base_currency)} in {group.name}; "
+            f"their share of the group's expenses is {format_amount(owed, group.base_currency)}."
+        ), spending
+    paid = stats.total_paid or {DEFAULT_CURRENCY: 0.0}
+    owed = stats.total_owed or {DEFAULT_CURRENCY: 0.0}
+    return (
+        f"{user.name} paid {format_totals(paid)} across all groups; "
+        f"their share of expenses is {format_totals(owed)}."
+    ), stats
+
+def answer_group_total(question: Question):
+    group = question.group()
+    total = crud.get_group_total_expenses(question.db, group_id=group.id)
+    return f"{group.name} has {format_amount(total, group.base_currency)} in total expenses.", {"group_id": group.id, "total_expenses": total}
+
+def answer_recent_expenses(question: Question):
+    user = question.user(required=False)
+    group = question.group(required=False)
+    count = question.count()
+    if user is None and group is None:
+        raise QueryError("Whose expenses, or which group's? For example \"my latest 3 expenses\".")
+
+    query = question.db.query(Expense).options(joinedload(Expense.paid_by_user), joinedload(Expense.group))
+    if group is not None:
+        query = query.filter(Expense.group_id == group.id)
+    if user is not None:
+        # Expenses in the user's groups, as on their dashboard
+        query = query.join(group_members, group_members.c.group_id == Expense.group_id).filter(
+            group_members.c.user_id == user.id
+        )
+    expenses = query.order_by(Expense.created_at.desc(), Expense.id.desc()).limit(count).all()
+
+    scope = " ".join(filter(None, [f"for {user.name}" if user else None, f"in {group.name}" if group else None]))
+    if not expenses:
+        return f"There are no expenses {scope}.", []
+    items = [
+        schemas.DashboardExpense(
+            id=expense.id,
+            description=expense.description,
+            amount=expense.amount,
+            split_type=expense.split_type,
+            group_id=expense.group_id,
+            group_name=expense.group.name,
+            paid_by=expense.paid_by,
+            paid_by_name=expense.paid_by_user.name,
+            created_at=expense.created_at
+        )
+        for expense in expenses
+    ]
+    currencies = {expense.id: expense.group.base_currency for expense in expenses}
+    listing = "; ".join(
+        f"{item.description} ({format_amount(item.amount, currencies[item.id])}, paid by {item.paid_by_name}"
+        f"{'' if group else ' in ' + item.group_name})"
+        for item in items
+    )
+    return f"Latest {len(items)} expense{'s' if len(items) != 1 else ''} {scope}: {listing}.", items
+
+# (intent, pattern, handler), tried in order against the normalized question
+TEMPLATES: List[Tuple[str, re.Pattern, Callable]] = [
+    ("top_payer", re.compile(rf"^who (?:has )?(?:paid|spent|pays|spends) (?:the )?most{IN_GROUP_REQUIRED}$"), answer_top_payer),
+    ("group_balances", re.compile(
+        rf"^(?:who owes (?:whom|who|what)|(?:show|list|what are|get)(?: me)? (?:the )?balances){IN_GROUP_REQUIRED}$"
+    ), answer_group_balances),
+    ("user_balance", re.compile(rf"^how much (?:does|do|did) (?P<user>.+?) owe{IN_GROUP}$"), answer_user_balance),
+    ("user_balance", re.compile(rf"^how much (?:is|are|am) (?P<user>.+?) owed{IN_GROUP}$"), answer_user_balance),
+    ("user_balance", re.compile(
+        rf"^(?:what(?: is)?|whats|show|get)(?: me)? (?P<user>.+?) balances?{IN_GROUP}$"
+    ), answer_user_balance),
+    ("user_spending", re.compile(
+        rf"^how much (?:did|has|have|does|do) (?P<user>.+?) (?:pay|paid|spend|spent){IN_GROUP}$"
+    ), answer_user_spending),
+    ("group_total", re.compile(
+        rf"^(?:what(?: is)? |whats )?(?:the )?total (?:expenses?|spent|spending|spend|cost){IN_GROUP_REQUIRED}$"
+    ), answer_group_total),
+    ("group_total", re.compile(rf"^how much (?:was|has been|have we|did we) spen[dt]{IN_GROUP_REQUIRED}$"), answer_group_total),
+    ("recent_expenses", re.compile(
+        r"^(?:show|list|get|what are|give)(?: me)?(?: the| (?P<user>.+?))? (?:latest|last|recent|most recent|newest)"
+        rf"(?: (?P<count>\d+|{'|'.join(NUMBER_WORDS)}))? expenses?{IN_GROUP}$"
+    ), answer_recent_expenses),
+]
+
+EXAMPLES = [
+    "How much does Alice owe in group Goa Trip?",
+    "Show me my latest 3 expenses.",
+    "Who paid the most in Weekend Trip?",
+]
+
+def answer(db: Session, question: str, user_id: Optional[int] = None) -> schemas.QueryResponse:
+    """Answer a question from the first template that matches it"""
+    text = normalize(question)
+    name_index.ensure_fresh(db)
+    for intent, pattern, handler in TEMPLATES:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        try:
+            reply, data = handler(Question(db, match, user_id))
+        except QueryError as e:
+            return schemas.QueryResponse(question=question, intent=intent, answer=str(e))
+        return schemas.QueryResponse(question=question, intent=intent, answer=reply, data=data)
+    return schemas.QueryResponse(
+        question=question,
+        answer="Sorry, I can't answer that yet. Try questions like: " + " ".join(f"\"{e}\"" for e in EXAMPLES)
+    )
@@ -1,7 +1,20 @@
-from sqlalchemy.orm import Session
-from models import User, Group, Expense, ExpenseSplit, Settlement
+from sqlalchemy.orm import Session, aliased, joinedload
+from sqlalchemy import insert, func, case
+from models import (
+    User, Group, Expense, ExpenseSplit, Settlement, MembershipSnapshot,
+    ExpenseArchive, ExpenseSplitArchive, SettlementArchive, GroupCheckpoint, CheckpointBalance, RecurringExpense,
+    group_members, membership_snapshot_members, REMAINDER_FIRST_MEMBER, DEFAULT_CURRENCY
+)
+from idempotency import IdempotentRequest
+import analytics
+import balance_kernel
+import fx
+import ledger
+import money
 import schemas
-from typing import List, Dict
+from typing import List, Dict, Optional
+import csv
+import io
 from collections import defaultdict
 from decimal import Decimal, ROUND_HALF_UP
 import math
@@ -31,7 +44,7 @@ def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(User).offset(skip).limit(limit).all()
 
 def create_group(db: Session, group: schemas.GroupCreate):
-    db_group = Group(name=group.name, description=group.description)
+    db_group = Group(name=group.name, description=group.description, base_currency=group.base_currency or DEFAULT_CURRENCY)
     
     # Add members
     for user_id in group.user_ids:
@@ -40,6 +53,8 @@ def create_group(db: Session, group: schemas.GroupCreate):
             db_group.members.append(user)
     
     db.add(db_group)
+    db.flush()
+    ledger.initialize_group_ledger(db, db_group.id)
     db.commit()
     db.refresh(db_group)
     return db_group
@@ -50,50 +65,59 @@ def get_group(db: Session, group_id: int):
 def get_groups(db: Session, skip: int = 0, limit: int = 100):
     return db.query(Group).offset(skip).limit(limit).all()
 
-def create_expense(db: Session, group_id: int, expense: schemas.ExpenseCreate):
+def create_expense(db: Session, group_id: int, expense: schemas.ExpenseCreate, idempotent: Optional[IdempotentRequest] = None):
     # Validate mathematical consistency
     if not validate_expense_mathematical_consistency(db, group_id, expense.amount, expense.splits):
         raise ValueError("Expense splits do not add up to total amount or percentages do not equal 100%")
     
-    # Round the main expense amount
-    expense.amount = round_currency(expense.amount)
+    # Round the main expense amount and store it in the group's base currency;
+    # everything below works on the converted amount
+    group = get_group(db, group_id)
+    conversion = fx.to_base(db, round_currency(expense.amount), expense.currency, group.base_currency)
+    expense.amount = conversion.amount
+    
+    # Many clients may post to the same group at once; the ledger update can
+    # hit a deadlock or serialization failure, in which case the whole
+    # transaction is re-run
+    return ledger.run_with_retry(db, lambda: _insert_expense(db, group_id, expense, conversion, idempotent))
+
+def _insert_expense(
+    db: Session,
+    group_id: int,
+    expense: schemas.ExpenseCreate,
+    conversion: fx.Conversion,
+    idempotent: Optional[IdempotentRequest] = None
+) -> Expense:
+    if idempotent is not None:
+        idempotent.claim(db)
     
     db_expense = Expense(
         description=expense.description,
         amount=expense.amount,
+        currency=conversion.currency,
+        original_amount=conversion.original_amount,
+        fx_rate=conversion.fx_rate,
         group_id=group_id,
         paid_by=expense.paid_by,
         split_type=expense.split_type
     )
     
-    db.add(db_expense)
-    db.commit()
-    db.refresh(db_expense)
-      # Create expense splits
     if expense.split_type == "equal":
-        # Equal split among all group members
+        # Equal split among all group members. Instead of one split row per
+        # member, the expense references a snapshot of the member list and
+        # each share is derived from the amount (remainder to the first member)
         group = db.query(Group).filter(Group.id == group_id).first()
-        num_members = len(group.members)
-        base_amount = round_currency(expense.amount / num_members)
-        
-        # Calculate total to see if there's a remainder due to rounding
-        total_base = base_amount * num_members
-        remainder = round_currency(expense.amount - total_base)
-        
-        for i, member in enumerate(group.members):
-            # Give the remainder to the first member to ensure exact total
-            amount = base_amount
-            if i == 0:
-                amount = round_currency(base_amount + remainder)
-            
-            split = ExpenseSplit(
-                expense_id=db_expense.id,
-                user_id=member.id,
-                amount=amount
-            )
-            db.add(split)
+        if not group.members:
+            raise ValueError("Cannot split an expense equally in a group with no members")
+        snapshot = get_or_create_membership_snapshot(db, group)
+        db_expense.membership_snapshot_id = snapshot.id
+        db_expense.remainder_rule = REMAINDER_FIRST_MEMBER
     
-    elif expense.split_type == "percentage":
+    db.add(db_expense)
+    db.flush()
+    
+    # Create expense splits
+    if expense.split_type == "percentage":
         # Percentage-based split
         for split_data in expense.splits:
             amount = round_currency((split_data.percentage / 100) * expense.amount)
@@ -105,22 +129,110 @@ def create_expense(db: Session, group_id: int, expense: schemas.ExpenseCreate):
             )
             db.add(split)
     
+    db.flush()
+    ledger.apply_deltas(
+        db, group_id, ledger.expense_deltas(db_expense), expense_amount=db_expense.amount, expense_count=1
+    )
+    analytics.apply_expense(db, db_expense)
+    if idempotent is not None:
+        idempotent.store(db, schemas.Expense.model_validate(db_expense))
     db.commit()
     db.refresh(db_expense)
     return db_expense
 
-def get_group_expenses(db: Session, group_id: int):
-    return db.query(Expense).filter(Expense.group_id == group_id).all()
+def get_or_create_membership_snapshot(db: Session, group: Group) -> MembershipSnapshot:
+    """Return the group's latest membership snapshot, creating one if membership changed
 
-def calculate_group_balances(db: Session, group_id: int) -> List[schemas.Balance]:
-    """Calculate who owes whom in a group"""
-    expenses = db.query(Expense).filter(Expense.group_id == group_id).all()
-    settlements = db.query(Settlement).filter(Settlement.group_id == group_id).all()
-    group = db.query(Group).filter(Group.id == group_id).first()
+    Members are taken in id order, the order ``Group.members`` loads them in,
+    so callers zipping the members with the snapshot's shares line up.
+    """
+    member_ids = sorted(member.id for member in group.members)
+    latest = db.query(MembershipSnapshot).filter(
+        MembershipSnapshot.group_id == group.id
+    ).order_by(MembershipSnapshot.id.desc()).first()
     
-    # Track net balances using precise decimal arithmetic
-    net_balances = defaultdict(float)
+    if latest and [member.id for member in latest.members] == member_ids:
+        return latest
+    
+    snapshot = MembershipSnapshot(group_id=group.id)
+    db.add(snapshot)
+    db.flush()
+    db.execute(insert(membership_snapshot_members), [
+        {"snapshot_id": snapshot.id, "user_id": user_id, "position": position}
+        for position, user_id in enumerate(member_ids)
+    ])
+    return snapshot
+
+def materialize_equal_splits(db: Session, snapshot_ids: List[int]):
+    """Convert equal-split expenses using these snapshots back into explicit split rows"""
+    if not snapshot_ids:
+        return
+    expenses = db.query(Expense).filter(Expense.membership_snapshot_id.in_(snapshot_ids)).all()
+    split_rows = [
+        {"expense_id": expense.id, "user_id": split.user_id, "amount": split.amount}
+        for expense in expenses
+        for split in expense.splits
+    ]
+    if split_rows:
+        db.execute(insert(ExpenseSplit), split_rows)
+    db.query(Expense).filter(Expense.membership_snapshot_id.in_(snapshot_ids)).update(
+        {Expense.membership_snapshot_id: None, Expense.remainder_rule: None},
+        synchronize_session=False
+    )
     
+    # Archived expenses keep their shares as archived split rows
+    archived = db.query(ExpenseArchive).filter(ExpenseArchive.membership_snapshot_id.in_(snapshot_ids)).all()
+    # Negative ids never collide with split ids archived from the hot table
+    next_split_id = min(db.query(func.min(ExpenseSplitArchive.id)).scalar() or 0, 0) - 1
+    archived_split_rows = []
+    for expense in archived:
+        for split in expense.splits:
+            archived_split_rows.append({
+                "id": next_split_id,
+                "archive_period": expense.archive_period,
+                "expense_id": expense.id,
+                "user_id": split.user_id,
+                "amount": split.amount,
+            })
+            next_split_id -= 1
+    if archived_split_rows:
+        db.execute(insert(ExpenseSplitArchive), archived_split_rows)
+    db.query(ExpenseArchive).filter(ExpenseArchive.membership_snapshot_id.in_(snapshot_ids)).update(
+        {ExpenseArchive.membership_snapshot_id: None, ExpenseArchive.remainder_rule: None},
+        synchronize_session=False
+    )
+    db.execute(
+        membership_snapshot_members.delete().where(membership_snapshot_members.c.snapshot_id.in_(snapshot_ids))
+    )
+    db.query(MembershipSnapshot).filter(MembershipSnapshot.id.in_(snapshot_ids)).delete(synchronize_session=False)
+
+def get_group_expenses(db: Session, group_id: int, include_archived: bool = False):
+    expenses = db.query(Expense).filter(Expense.group_id == group_id).all()
+    if include_archived:
+        archived = db.query(ExpenseArchive).filter(ExpenseArchive.group_id == group_id).order_by(ExpenseArchive.id).all()
+        expenses = archived + expenses
+    return expenses
+
+def get_group_total_expenses(db: Session, group_id: int) -> float:
+    """Total of a group's expenses, including history folded into checkpoints"""
+    ledger_total = ledger.get_group_totals(db, [group_id]).get(group_id)
+    if ledger_total is not None:
+        return round_currency(ledger_total)
+    
+    hot_total = db.query(func.sum(Expense.amount)).filter(Expense.group_id == group_id).scalar() or 0
+    archived_total = db.query(func.sum(GroupCheckpoint.total_expenses)).filter(
+        GroupCheckpoint.group_id == group_id
+    ).scalar() or 0
+    return round_currency(hot_total + archived_total)
+
+def get_checkpoint_balances(db: Session, group_id: int):
+    """Per-user nets carried forward from a group's archived history"""
+    return db.query(CheckpointBalance.user_id, func.sum(CheckpointBalance.amount)).filter(
+        CheckpointBalance.group_id == group_id
+    ).group_by(CheckpointBalance.user_id).all()
+
+def accumulate_net_balances(net_balances: Dict[int, float], expenses, settlements):
+    """Add the effect of expenses and settlements to per-user net balances"""
     # Add expenses
     for expense in expenses:
         # Person who paid has positive balance
@@ -138,6 +250,25 @@ def calculate_group_balances(db: Session, group_id: int) -> List[schemas.Balance
         # The person receiving payment has their credit reduced
         # so we subtract from their balance (making it less positive)
         net_balances[settlement.to_user_id] -= settlement.amount
+
+def calculate_group_balances(db: Session, group_id: int) -> List[schemas.Balance]:
+    """Calculate who owes whom in a group"""
+    # Very large groups use the vectorized kernel, which gives identical results
+    if balance_kernel.should_vectorize(db, group_id):
+        group = db.query(Group).filter(Group.id == group_id).first()
+        return balance_kernel.calculate_group_balances(db, group)
+    
+    expenses = db.query(Expense).filter(Expense.group_id == group_id).all()
+    settlements = db.query(Settlement).filter(Settlement.group_id == group_id).all()
+    group = db.query(Group).filter(Group.id == group_id).first()
+    
+    # Track net balances using precise decimal arithmetic
+    net_balances = defaultdict(float)
+    accumulate_net_balances(net_balances, expenses, settlements)
+    
+    # Carry forward balances from archived history
+    for user_id, amount in get_checkpoint_balances(db, group_id):
+        net_balances[user_id] += amount
     
     # Calculate simplified debts between users
     balances = []
@@ -212,20 +343,200 @@ def calculate_user_balances(db: Session, user_id: int) -> List[schemas.Balance]:
     
     return all_balances
 
-def create_settlement(db: Session, settlement: schemas.SettlementCreate):
+def get_user_dashboard(db: Session, user_id: int, recent_limit: int = 10):
+    """Everything a user's home screen needs, built from a fixed number of batched queries"""
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        return None
+    
+    # The user's groups with their member counts
+    members = aliased(group_members)
+    group_rows = db.query(Group, func.count(members.c.user_id)).join(
+        group_members, (group_members.c.group_id == Group.id) & (group_members.c.user_id == user_id)
+    ).join(members, members.c.group_id == Group.id).group_by(Group.id).order_by(Group.id).all()
+    group_ids = [group.id for group, _ in group_rows]
+    
+    net_by_group = defaultdict(float)
+    total_by_group = defaultdict(float)
+    recent_expenses = []
+    
+    if group_ids:
+        # Groups with a balance ledger are answered from it directly
+        total_by_group.update(ledger.get_group_totals(db, group_ids))
+        net_by_group.update(ledger.get_user_nets(db, user_id, total_by_group.keys()))
+    legacy_ids = [group_id for group_id in group_ids if group_id not in total_by_group]
+    
+    if legacy_ids:
+        # Groups created before the ledger existed are aggregated from their rows,
+        # starting with group totals and what the user paid, per group
+        for group_id, total, paid in db.query(
+            Expense.group_id,
+            func.sum(Expense.amount),
+            func.sum(case((Expense.paid_by == user_id, Expense.amount), else_=0))
+        ).filter(Expense.group_id.in_(legacy_ids)).group_by(Expense.group_id):
+            total_by_group[group_id] += total or 0
+            net_by_group[group_id] += paid or 0
+        
+        # The user's explicit split rows
+        for group_id, owed in db.query(Expense.group_id, func.sum(ExpenseSplit.amount)).join(
+            ExpenseSplit, ExpenseSplit.expense_id == Expense.id
+        ).filter(Expense.group_id.in_(legacy_ids), ExpenseSplit.user_id == user_id).group_by(Expense.group_id):
+            net_by_group[group_id] -= owed or 0
+        
+        # The user's shares of equal splits stored as membership snapshots
+        participant_counts = db.query(
+            membership_snapshot_members.c.snapshot_id.label("snapshot_id"),
+            func.count().label("participants"),
+            func.min(membership_snapshot_members.c.position).label("first_position")
+        ).group_by(membership_snapshot_members.c.snapshot_id).subquery()
+        for group_id, amount, remainder_rule, participants, is_first in db.query(
+            Expense.group_id,
+            Expense.amount,
+            Expense.remainder_rule,
+            participant_counts.c.participants,
+            membership_snapshot_members.c.position == participant_counts.c.first_position
+        ).join(
+            membership_snapshot_members, membership_snapshot_members.c.snapshot_id == Expense.membership_snapshot_id
+        ).join(
+            participant_counts, participant_counts.c.snapshot_id == Expense.membership_snapshot_id
+        ).filter(Expense.group_id.in_(legacy_ids), membership_snapshot_members.c.user_id == user_id):
+            shares = money.equal_split_amounts(amount, participants, remainder_rule)
+            net_by_group[group_id] -= shares[0] if is_first else shares[-1]
+        
+        # Balances carried forward from archived history
+        for group_id, total in db.query(GroupCheckpoint.group_id, func.sum(GroupCheckpoint.total_expenses)).filter(
+            GroupCheckpoint.group_id.in_(legacy_ids)
+        ).group_by(GroupCheckpoint.group_id):
+            total_by_group[group_id] += total or 0
+        for group_id, carried in db.query(CheckpointBalance.group_id, func.sum(CheckpointBalance.amount)).filter(
+            CheckpointBalance.group_id.in_(legacy_ids), CheckpointBalance.user_id == user_id
+        ).group_by(CheckpointBalance.group_id):
+            net_by_group[group_id] += carried or 0
+        
+        # Settlements paid and received by the user
+        for group_id, sent, received in db.query(
+            Settlement.group_id,
+            func.sum(case((Settlement.from_user_id == user_id, Settlement.amount), else_=0)),
+            func.sum(case((Settlement.to_user_id == user_id, Settlement.amount), else_=0))
+        ).filter(
+            Settlement.group_id.in_(legacy_ids),
+            (Settlement.from_user_id == user_id) | (Settlement.to_user_id == user_id)
+        ).group_by(Settlement.group_id):
+            net_by_group[group_id] += (sent or 0) - (received or 0)
+    
+    if group_ids:
+        recent_expenses = db.query(Expense).options(
+            joinedload(Expense.paid_by_user), joinedload(Expense.group)
+        ).filter(Expense.group_id.in_(group_ids)).order_by(
+            Expense.created_at.desc(), Expense.id.desc()
+        ).limit(recent_limit).all()
+    
+    groups = []
+    # Groups keep their amounts in their own base currency, so the overall net is per currency
+    net_by_currency = defaultdict(float)
+    for group, member_count in group_rows:
+        net_balance = round_currency(net_by_group[group.id])
+        if is_effectively_zero(net_balance):
+            net_balance = 0.0
+        groups.append(schemas.DashboardGroup(
+            id=group.id,
+            name=group.name,
+            description=group.description,
+            base_currency=group.base_currency,
+            created_at=group.created_at,
+            member_count=member_count,
+            total_expenses=round_currency(total_by_group[group.id]),
+            net_balance=net_balance
+        ))
+        net_by_currency[group.base_currency or DEFAULT_CURRENCY] += net_balance
+    
+    return schemas.UserDashboard(
+        user=user,
+        groups=groups,
+        net_balance=dict(net_by_currency),
+        recent_expenses=[
+            schemas.DashboardExpense(
+                id=expense.id,
+                description=expense.description,
+                amount=expense.amount,
+                split_type=expense.split_type,
+                group_id=expense.group_id,
+                group_name=expense.group.name,
+                paid_by=expense.paid_by,
+                paid_by_name=expense.paid_by_user.name,
+                created_at=expense.created_at
+            )
+            for expense in recent_expenses
+        ]
+    )
+
+def create_settlement(db: Session, settlement: schemas.SettlementCreate, idempotent: Optional[IdempotentRequest] = None):
     """Create a new settlement between users"""
-    # Round the settlement amount
-    settlement.amount = round_currency(settlement.amount)
+    # Round the settlement amount and convert it to the group's base currency
+    group = get_group(db, settlement.group_id)
+    conversion = fx.to_base(db, round_currency(settlement.amount), settlement.currency, group.base_currency)
     
-    db_settlement = Settlement(**settlement.dict())
-    db.add(db_settlement)
-    db.commit()
-    db.refresh(db_settlement)
-    return db_settlement
+    def transaction():
+        if idempotent is not None:
+            idempotent.claim(db)
+        db_settlement = Settlement(
+            **settlement.dict(exclude={"amount", "currency"}),
+            amount=conversion.amount,
+            currency=conversion.currency,
+            original_amount=conversion.original_amount,
+            fx_rate=conversion.fx_rate
+        )
+        db.add(db_settlement)
+        db.flush()
+        ledger.apply_deltas(db, settlement.group_id, ledger.settlement_deltas(db_settlement), settlement_count=1)
+        if idempotent is not None:
+            idempotent.store(db, schemas.Settlement.model_validate(db_settlement))
+        db.commit()
+        db.refresh(db_settlement)
+        return db_settlement
+    
+    return ledger.run_with_retry(db, transaction)
 
-def get_group_settlements(db: Session, group_id: int):
+def get_group_settlements(db: Session, group_id: int, include_archived: bool = False):
     """Get all settlements for a group"""
-    return db.query(Settlement).filter(Settlement.group_id == group_id).all()
+    settlements = db.query(Settlement).filter(Settlement.group_id == group_id).all()
+    if include_archived:
+        archived = db.query(SettlementArchive).filter(SettlementArchive.group_id == group_id).order_by(SettlementArchive.id).all()
+        settlements = archived + settlements
+    return settlements
+
+def export_group_history(db: Session, group_id: int, batch_size: int = 1000):
+    """Yield a group's expenses and settlements, archived ones included, as CSV lines"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+    
+    # amount is in the group's base currency; currency and original_amount are as entered
+    writer.writerow(["type", "id", "created_at", "description", "amount", "paid_by", "to_user_id", "split_type", "archived",
+                     "currency", "original_amount"])
+    yield flush()
+    
+    sources = [
+        ("expense", ExpenseArchive, True),
+        ("expense", Expense, False),
+        ("settlement", SettlementArchive, True),
+        ("settlement", Settlement, False),
+    ]
+    for row_type, model, archived in sources:
+        query = db.query(model).filter(model.group_id == group_id).order_by(model.id)
+        for row in query.yield_per(batch_size):
+            if row_type == "expense":
+                writer.writerow([row_type, row.id, row.created_at, row.description, row.amount,
+                                 row.paid_by, "", row.split_type, archived, row.currency, row.original_amount])
+            else:
+                writer.writerow([row_type, row.id, row.created_at, row.description, row.amount,
+                                 row.from_user_id, row.to_user_id, "", archived, row.currency, row.original_amount])
+            yield flush()
 
 # Group management functions
 def update_group(db: Session, group_id: int, group_update: schemas.GroupUpdate):
@@ -272,6 +583,29 @@ def delete_group(db: Session, group_id: int):
         # Delete settlements
         db.query(Settlement).filter(Settlement.group_id == group_id).delete(synchronize_session=False)
         
+        # Stop recurring expenses
+        db.query(RecurringExpense).filter(RecurringExpense.group_id == group_id).delete(synchronize_session=False)
+        
+        # Delete archived history and checkpoints
+        archived_ids = [row[0] for row in db.query(ExpenseArchive.id).filter(ExpenseArchive.group_id == group_id).all()]
+        if archived_ids:
+            db.query(ExpenseSplitArchive).filter(ExpenseSplitArchive.expense_id.in_(archived_ids)).delete(synchronize_session=False)
+        db.query(ExpenseArchive).filter(ExpenseArchive.group_id == group_id).delete(synchronize_session=False)
+        db.query(SettlementArchive).filter(SettlementArchive.group_id == group_id).delete(synchronize_session=False)
+        db.query(CheckpointBalance).filter(CheckpointBalance.group_id == group_id).delete(synchronize_session=False)
+        db.query(GroupCheckpoint).filter(GroupCheckpoint.group_id == group_id).delete(synchronize_session=False)
+        
+        # Delete membership snapshots used by equal splits
+        snapshot_ids = [row[0] for row in db.query(MembershipSnapshot.id).filter(MembershipSnapshot.group_id == group_id).all()]
+        if snapshot_ids:
+            db.execute(
+                membership_snapshot_members.delete().where(membership_snapshot_members.c.snapshot_id.in_(snapshot_ids))
+            )
+            db.query(MembershipSnapshot).filter(MembershipSnapshot.id.in_(snapshot_ids)).delete(synchronize_session=False)
+        
+        ledger.delete_group_ledger(db, group_id)
+        analytics.delete_group_rollups(db, group_id)
+        
         # Finally delete the group
         db.delete(db_group)
         db.commit()
@@ -328,8 +662,29 @@ def delete_user(db: Session, user_id: int):
         for group in db_user.groups:
             group.members.remove(db_user)
         
+        # Groups whose balances change when this user's rows are removed
+        affected_group_ids = {row[0] for row in db.query(Expense.group_id).filter(Expense.paid_by == user_id)}
+        affected_group_ids |= {row[0] for row in db.query(Expense.group_id).join(
+            ExpenseSplit, ExpenseSplit.expense_id == Expense.id
+        ).filter(ExpenseSplit.user_id == user_id)}
+        affected_group_ids |= {row[0] for row in db.query(MembershipSnapshot.group_id).join(
+            membership_snapshot_members, membership_snapshot_members.c.snapshot_id == MembershipSnapshot.id
+        ).filter(membership_snapshot_members.c.user_id == user_id)}
+        affected_group_ids |= {row[0] for row in db.query(Settlement.group_id).filter(
+            (Settlement.from_user_id == user_id) | (Settlement.to_user_id == user_id)
+        )}
+        affected_group_ids |= {row[0] for row in db.query(CheckpointBalance.group_id).filter(
+            CheckpointBalance.user_id == user_id
+        )}
+        
         # Delete related records in the correct order to respect foreign key constraints
         
+        # Equal splits involving this user become explicit rows so their share can be removed below
+        snapshot_ids = [row[0] for row in db.query(membership_snapshot_members.c.snapshot_id).filter(
+            membership_snapshot_members.c.user_id == user_id
+        ).all()]
+        materialize_equal_splits(db, snapshot_ids)
+        
         # First, delete expense splits for this user
         db.query(ExpenseSplit).filter(ExpenseSplit.user_id == user_id).delete(synchronize_session=False)
         
@@ -342,12 +697,31 @@ def delete_user(db: Session, user_id: int):
         
         # Then delete expenses paid by this user
         db.query(Expense).filter(Expense.paid_by == user_id).delete(synchronize_session=False)
+        db.query(RecurringExpense).filter(RecurringExpense.paid_by == user_id).delete(synchronize_session=False)
         
         # Delete settlements involving this user
         db.query(Settlement).filter(
             (Settlement.from_user_id == user_id) | (Settlement.to_user_id == user_id)
         ).delete(synchronize_session=False)
         
+        # Apply the same removals to the archived history
+        db.query(ExpenseSplitArchive).filter(ExpenseSplitArchive.user_id == user_id).delete(synchronize_session=False)
+        archived_ids = [row[0] for row in db.query(ExpenseArchive.id).filter(ExpenseArchive.paid_by == user_id).all()]
+        if archived_ids:
+            db.query(ExpenseSplitArchive).filter(ExpenseSplitArchive.expense_id.in_(archived_ids)).delete(synchronize_session=False)
+        db.query(ExpenseArchive).filter(ExpenseArchive.paid_by == user_id).delete(synchronize_session=False)
+        db.query(SettlementArchive).filter(
+            (SettlementArchive.from_user_id == user_id) | (SettlementArchive.to_user_id == user_id)
+        ).delete(synchronize_session=False)
+        
+        # Delete balances carried forward from archived history
+        db.query(CheckpointBalance).filter(CheckpointBalance.user_id == user_id).delete(synchronize_session=False)
+        
+        db.flush()
+        affected_group_ids.discard(None)
+        ledger.rebuild_ledgers(db, affected_group_ids)
+        analytics.rebuild_rollups(db, affected_group_ids)
+        
         # Finally delete the user
         db.delete(db_user)
         db.commit()
@@ -0,0 +1,166 @@
+"""
+In-process change feed for groups, exposed to clients as Server-Sent Events.
+
+Write endpoints publish a compact delta after their transaction commits and
+every open ``/groups/{group_id}/events`` stream receives it, so the frontend
+only re-fetches the resources that actually changed instead of polling.
+
+The broker lives in the API process and there is no cross-process fan-out:
+a stream only receives the writes handled by the worker serving it, so the
+API must run as a single worker (``uvicorn --workers 1``) for live updates
+to be complete. ``resync`` asks a client to refetch everything: it follows
+bulk writes (imports, recurring postings) and is sent when the client's
+position is no longer in the history or its queue backed up.
+
+Events are published inline, right after the writing transaction commits,
+rather than from the work queue's thread pool, where two jobs for the same
+group could run in either order.
+"""
+
+import asyncio
+import json
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+import database
+
+HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments
+HISTORY_SIZE = 100  # events kept per group for Last-Event-ID replay
+SUBSCRIBER_QUEUE_SIZE = 100  # pending events per client before forcing a resync
+
+# Event types published by the write endpoints
+EXPENSE_CREATED = "expense_created"
+SETTLEMENT_CREATED = "settlement_created"
+MEMBERS_CHANGED = "members_changed"
+GROUP_UPDATED = "group_updated"
+GROUP_DELETED = "group_deleted"
+RESYNC = "resync"
+READY = "ready"
+
+class GroupEventBroker:
+    """Fan out group change events to subscribed event-loop queues"""
+
+    def __init__(self, history_size: int = HISTORY_SIZE, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self._lock = threading.Lock()
+        self._history_size = history_size
+        self._queue_size = queue_size
+        self._versions: Dict[int, int] = defaultdict(int)
+        self._history: Dict[int, deque] = defaultdict(lambda: deque(maxlen=self._history_size))
+        self._subscribers: Dict[int, set] = defaultdict(set)
+
+    def current_version(self, group_id: int) -> int:
+        with self._lock:
+            return self._versions[group_id]
+
+    def subscribe(self, group_id: int, last_event_id: Optional[int] = None):
+        """Register a queue for a group and return it with any events to replay.
+
+        Must be called from the event loop that will consume the queue. The
+        replay list is ``None`` when the requested position is no longer in
+        the history, in which case the client has to resync.
+        """
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        subscriber = (asyncio.get_running_loop(), queue)
+
+        with self._lock:
+            self._subscribers[group_id].add(subscriber)
+            version = self._versions[group_id]
+            replay = []
+            if last_event_id is not None and last_event_id > version:
+                # The stream was reset (e.g. a server restart) since the client's last event
+                replay = None
+            elif last_event_id is not None and last_event_id < version:
+                history = self._history[group_id]
+                if not history or history[0]["version"] > last_event_id + 1:
+                    replay = None
+                else:
+                    replay = [event for event in history if event["version"] > last_event_id]
+
+        return subscriber, replay, version
+
+    def unsubscribe(self, group_id: int, subscriber):
+        with self._lock:
+            self._subscribers[group_id].discard(subscriber)
+            if not self._subscribers[group_id]:
+                del self._subscribers[group_id]
+
+    def publish(self, group_id: int, event_type: str, **data):
+        """Record an event for a group and hand it to every subscriber.
+
+        Safe to call from the threadpool that runs the sync endpoints.
+        """
+        with self._lock:
+            self._versions[group_id] += 1
+            event = {
+                "version": self._versions[group_id],
+                "type": event_type,
+                "group_id": group_id,
+                **data
+            }
+            self._history[group_id].append(event)
+            subscribers = list(self._subscribers.get(group_id, ()))
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, event)
+            except RuntimeError:
+                # The subscriber's loop has already shut down
+                pass
+        return event
+
+def _offer(queue: asyncio.Queue, event: dict):
+    """Enqueue an event, collapsing a backed-up queue into a single resync"""
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"version": event["version"], "type": RESYNC, "group_id": event["group_id"]})
+
+def format_sse(event: dict) -> str:
+    """Serialize an event in the text/event-stream wire format"""
+    return f"id: {event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+async def stream_group_events(group_id: int, request, last_event_id: Optional[int] = None):
+    """Async generator yielding SSE frames for a group until the client disconnects"""
+    subscriber, replay, version = broker.subscribe(group_id, last_event_id)
+    try:
+        yield "retry: 3000\n\n"
+        if replay is None:
+            yield format_sse({"version": version, "type": RESYNC, "group_id": group_id})
+        else:
+            for event in replay:
+                yield format_sse(event)
+        yield format_sse({"version": version, "type": READY, "group_id": group_id})
+
+        _, queue = subscriber
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_sse(event)
+            if event["type"] == GROUP_DELETED:
+                break
+    finally:
+        broker.unsubscribe(group_id, subscriber)
+
+broker = GroupEventBroker()
+
+def publish_after_commit(group_id: int, event_type: str, **data):
+    """Publish an event once the caller's transaction has committed.
+
+    Publishing only takes the broker lock and schedules queue puts on the
+    subscribers' loops, so it runs inline: a thread pool without a per-group
+    key could deliver one group's events out of order. With a read replica
+    the event carries the primary's commit position, which clients send back
+    as ``X-Min-Position`` when they refetch so the read includes this write.
+    """
+    position = database.commit_position()
+    if position is not None:
+        data["position"] = position
+    return broker.publish(group_id, event_type, **data)
@@ -0,0 +1,171 @@
+"""
+Sparse fieldsets for the listing endpoints.
+
+``GET /users/``, ``/groups/`` and ``/groups/{id}/expenses`` accept two
+optional comma-separated query parameters:
+
+* ``fields`` - top-level attributes to return (``id`` is always included),
+* ``include`` - nested sub-objects to return, e.g. ``members`` or
+  ``paid_by_user,splits``.
+
+Without either parameter the endpoints return their full documents. When one
+is given, only the requested columns are selected: a plain column query when
+no sub-object is requested, otherwise ``load_only`` entities with the
+requested relationships batch-loaded by ``selectinload``. Omitted
+relationships are never loaded. ``fields`` alone returns no sub-objects and
+``include`` alone returns every top-level attribute.
+"""
+
+from typing import Dict, List, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.orm import Session, load_only, selectinload
+
+from models import (
+    User, Group, Expense, ExpenseSplit, ExpenseArchive, ExpenseSplitArchive, MembershipSnapshot
+)
+import crud
+import ledger
+import money
+import schemas
+
+USER_FIELDS = ("id", "name", "email", "created_at")
+GROUP_FIELDS = ("id", "name", "description", "base_currency", "created_at", "total_expenses")
+GROUP_INCLUDES = ("members",)
+EXPENSE_FIELDS = (
+    "id", "description", "amount", "currency", "original_amount", "fx_rate", "split_type", "group_id", "paid_by",
+    "created_at"
+)
+EXPENSE_INCLUDES = ("paid_by_user", "splits")
+
+# Monetary fields are rounded the same way as in the full schemas
+CURRENCY_FIELDS = {"amount", "original_amount", "total_expenses"}
+
+# Columns the Expense.splits property reads to derive equal-split shares
+SPLIT_SOURCE_COLUMNS = ("amount", "membership_snapshot_id", "remainder_rule")
+
+USER_COLUMNS = [getattr(User, name) for name in USER_FIELDS]
+
+class Fieldset:
+    """Requested top-level fields and nested sub-objects of a listing"""
+
+    def __init__(self, fields: List[str], include: Set[str]):
+        self.fields = fields
+        self.include = include
+
+def _split(value: str) -> List[str]:
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+def parse(fields: Optional[str], include: Optional[str], allowed_fields, allowed_includes=()) -> Optional[Fieldset]:
+    """Validate the query parameters; returns None when the full document was requested"""
+    if fields is None and include is None:
+        return None
+
+    requested_fields = list(allowed_fields) if fields is None else _split(fields)
+    unknown = [name for name in requested_fields if name not in allowed_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(allowed_fields)}")
+    if "id" not in requested_fields:
+        requested_fields.insert(0, "id")
+
+    requested_includes = set() if include is None else set(_split(include))
+    unknown = sorted(requested_includes - set(allowed_includes))
+    if unknown:
+        available = ", ".join(allowed_includes) or "none"
+        raise ValueError(f"Unknown include: {', '.join(unknown)}. Available: {available}")
+
+    # Keep the declared order so responses are stable
+    ordered_fields = [name for name in allowed_fields if name in requested_fields]
+    return Fieldset(ordered_fields, requested_includes)
+
+def _encode(values: Dict) -> Dict:
+    for name in CURRENCY_FIELDS & values.keys():
+        values[name] = money.round_currency(values[name])
+    return jsonable_encoder(values)
+
+def _encode_user(user) -> Dict:
+    return schemas.User.model_validate(user).model_dump(mode="json")
+
+def list_users(db: Session, fieldset: Fieldset, skip: int = 0, limit: int = 100) -> List[Dict]:
+    columns = [getattr(User, name) for name in fieldset.fields]
+    rows = db.query(*columns).offset(skip).limit(limit).all()
+    return [_encode(dict(row._mapping)) for row in rows]
+
+def list_groups(db: Session, fieldset: Fieldset, skip: int = 0, limit: int = 100) -> List[Dict]:
+    column_names = [name for name in fieldset.fields if name != "total_expenses"]
+    columns = [getattr(Group, name) for name in column_names]
+
+    if "members" in fieldset.include:
+        groups = db.query(Group).options(
+            load_only(*columns),
+            selectinload(Group.members).load_only(*USER_COLUMNS)
+        ).offset(skip).limit(limit).all()
+        results = [
+            {**{name: getattr(group, name) for name in column_names},
+             "members": [_encode_user(member) for member in group.members]}
+            for group in groups
+        ]
+    else:
+        results = [dict(row._mapping) for row in db.query(*columns).offset(skip).limit(limit).all()]
+
+    if "total_expenses" in fieldset.fields:
+        # One ledger query for the page instead of one total per group
+        group_ids = [result["id"] for result in results]
+        totals = ledger.get_group_totals(db, group_ids)
+        for result in results:
+            total = totals.get(result["id"])
+            if total is None:
+                total = crud.get_group_total_expenses(db, group_id=result["id"])
+            result["total_expenses"] = total
+
+    return [_encode(result) for result in results]
+
+def _expense_options(model, split_model, fieldset: Fieldset):
+    column_names = list(fieldset.fields)
+    if "splits" in fieldset.include:
+        column_names += [name for name in SPLIT_SOURCE_COLUMNS if name not in column_names]
+    if "paid_by_user" in fieldset.include and "paid_by" not in column_names:
+        column_names.append("paid_by")
+
+    options = [load_only(*[getattr(model, name) for name in column_names])]
+    if "paid_by_user" in fieldset.include:
+        options.append(selectinload(model.paid_by_user).load_only(*USER_COLUMNS))
+    if "splits" in fieldset.include:
+        options.append(selectinload(model.split_rows).selectinload(split_model.user).load_only(*USER_COLUMNS))
+        options.append(
+            selectinload(model.membership_snapshot).selectinload(MembershipSnapshot.members).load_only(*USER_COLUMNS)
+        )
+    return options
+
+def _query_expenses(db: Session, model, split_model, group_id: int, fieldset: Fieldset, order_by=None) -> List[Dict]:
+    if not fieldset.include:
+        columns = [getattr(model, name) for name in fieldset.fields]
+        query = db.query(*columns).filter(model.group_id == group_id)
+        if order_by is not None:
+            query = query.order_by(order_by)
+        return [_encode(dict(row._mapping)) for row in query.all()]
+
+    query = db.query(model).options(*_expense_options(model, split_model, fieldset)).filter(model.group_id == group_id)
+    if order_by is not None:
+        query = query.order_by(order_by)
+
+    results = []
+    for expense in query.all():
+        result = {name: getattr(expense, name) for name in fieldset.fields}
+        if "paid_by_user" in fieldset.include:
+            result["paid_by_user"] = _encode_user(expense.paid_by_user)
+        if "splits" in fieldset.include:
+            result["splits"] = [
+                schemas.ExpenseSplit.model_validate(split).model_dump(mode="json") for split in expense.splits
+            ]
+        results.append(_encode(result))
+    return results
+
+def list_group_expenses(db: Session, group_id: int, fieldset: Fieldset, include_archived: bool = False) -> List[Dict]:
+    expenses = _query_expenses(db, Expense, ExpenseSplit, group_id, fieldset)
+    if include_archived:
+        archived = _query_expenses(
+            db, ExpenseArchive, ExpenseSplitArchive, group_id, fieldset, order_by=ExpenseArchive.id
+        )
+        expenses = archived + expenses
+    return expenses
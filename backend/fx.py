@@ -0,0 +1,127 @@
+"""
+Currencies and exchange rates.
+
+Every group keeps its books in a base currency. Expenses and settlements may
+be entered in any currency; at write time the amount is converted with the
+rate effective on the row's date and stored as ``amount`` in the base
+currency, next to the ``currency``, ``original_amount`` and ``fx_rate`` it
+came from. Balances, the ledger, rollups and every other read path only ever
+see base amounts and never convert per row.
+
+``fx_rates`` holds one rate per (currency, base currency, effective date): one
+unit of ``currency`` costs ``rate`` units of ``base_currency`` from that date
+until the next one. When only the opposite pair is known its inverse is
+used. Each pair's rates are cached in-process for ``FX_RATE_CACHE_TTL``
+seconds, and dropped as soon as rates are written through this process, so
+creating an expense doesn't query the rate table every time.
+"""
+
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from models import FxRate
+import money
+import schemas
+
+FX_RATE_CACHE_TTL = float(os.getenv("FX_RATE_CACHE_TTL", "300"))
+
+class RateNotFoundError(ValueError):
+    """No rate converts between two currencies on a date"""
+
+def rate_date(created_at: Optional[datetime] = None) -> date:
+    """UTC date whose rate applies to a row created at created_at (default: now)"""
+    created_at = created_at or datetime.now(timezone.utc)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date()
+
+class RateCache:
+    """Rate history of each currency pair, loaded on first use and kept for a TTL"""
+
+    def __init__(self, ttl: float = FX_RATE_CACHE_TTL):
+        self.ttl = ttl
+        self._pairs: Dict[Tuple[str, str], Tuple[float, List[date], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._pairs.clear()
+
+    def _history(self, db: Session, currency: str, base_currency: str) -> Tuple[List[date], List[float]]:
+        key = (currency, base_currency)
+        with self._lock:
+            cached = self._pairs.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1], cached[2]
+
+        rows = db.query(FxRate.effective_date, FxRate.rate).filter(
+            FxRate.currency == currency, FxRate.base_currency == base_currency
+        ).order_by(FxRate.effective_date).all()
+        dates = [effective_date for effective_date, _ in rows]
+        rates = [rate for _, rate in rows]
+        with self._lock:
+            self._pairs[key] = (time.monotonic(), dates, rates)
+        return dates, rates
+
+    def _effective(self, db: Session, currency: str, base_currency: str, on: date) -> Optional[float]:
+        dates, rates = self._history(db, currency, base_currency)
+        index = bisect_right(dates, on)
+        return rates[index - 1] if index else None
+
+    def rate(self, db: Session, currency: str, base_currency: str, on: date) -> float:
+        """Units of base_currency per unit of currency on a date"""
+        if currency == base_currency:
+            return 1.0
+        rate = self._effective(db, currency, base_currency, on)
+        if rate is not None:
+            return rate
+        inverse = self._effective(db, base_currency, currency, on)
+        if inverse:
+            return 1 / inverse
+        raise RateNotFoundError(f"No exchange rate from {currency} to {base_currency} on {on.isoformat()}")
+
+rate_cache = RateCache()
+
+class Conversion(NamedTuple):
+    amount: float  # in the base currency
+    currency: str
+    original_amount: float
+    fx_rate: float
+
+def to_base(
+    db: Session, amount: float, currency: Optional[str], base_currency: str, created_at: Optional[datetime] = None
+) -> Conversion:
+    """Convert an amount entered in currency (default: the base currency) at the rate of its date"""
+    currency = currency or base_currency
+    rate = rate_cache.rate(db, currency, base_currency, rate_date(created_at))
+    return Conversion(money.round_currency(amount * rate), currency, amount, rate)
+
+def set_rates(db: Session, rates: List[schemas.FxRateCreate]) -> List[FxRate]:
+    """Insert or replace rates, keyed by (currency, base currency, effective date)"""
+    saved = []
+    for item in rates:
+        row = db.get(FxRate, (item.currency, item.base_currency, item.effective_date))
+        if row is None:
+            row = FxRate(currency=item.currency, base_currency=item.base_currency, effective_date=item.effective_date)
+            db.add(row)
+        row.rate = item.rate
+        saved.append(row)
+    db.commit()
+    rate_cache.invalidate()
+    for row in saved:
+        db.refresh(row)
+    return saved
+
+def get_rates(db: Session, currency: Optional[str] = None, base_currency: Optional[str] = None) -> List[FxRate]:
+    query = db.query(FxRate)
+    if currency is not None:
+        query = query.filter(FxRate.currency == currency)
+    if base_currency is not None:
+        query = query.filter(FxRate.base_currency == base_currency)
+    return query.order_by(FxRate.currency, FxRate.base_currency, FxRate.effective_date).all()
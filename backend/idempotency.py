@@ -0,0 +1,129 @@
+"""
+Idempotency keys for retried writes.
+
+Clients that time out retry ``POST /groups/{id}/expenses`` and
+``POST /settlements/``; without a key every retry is a new row. A request
+sent with an ``Idempotency-Key`` header claims the key in the same
+transaction as its write and stores its response there before committing,
+so:
+
+* a retry of a completed request gets the stored response back without the
+  write being validated or run again,
+* a concurrent duplicate blocks on the key's primary key until the first
+  request commits, then fails its insert and replays that response instead
+  of writing a second row,
+* a request that fails leaves no key behind and may simply be retried.
+
+Reusing a key for a different payload is an error. Keys expire after
+``IDEMPOTENCY_KEY_TTL`` seconds and expired rows are purged in the
+background.
+"""
+
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import IdempotencyKey
+from database import SessionLocal
+import tasks
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+MAX_KEY_LENGTH = 255
+PURGE_INTERVAL = 300  # seconds between purges of expired keys
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+class KeyReusedError(ValueError):
+    """The key was already used for a request with a different payload"""
+
+class IdempotentRequest:
+    """A write made under an idempotency key"""
+
+    def __init__(self, key: str, method: str, path: str, payload: BaseModel):
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise ValueError(f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+        self.key = key
+        self.scope = f"{method} {path}"
+        # Hash the payload as received, before the write normalizes it
+        body = json.dumps(payload.dict(), sort_keys=True, default=str)
+        self.request_hash = hashlib.sha256(f"{self.scope}\n{body}".encode()).hexdigest()
+        self.row = None
+
+    def lookup(self, db: Session) -> Optional[IdempotencyKey]:
+        """The stored response of an earlier request with this key, if it is still valid"""
+        row = db.get(IdempotencyKey, (self.key, self.scope))
+        if row is None:
+            return None
+        if _as_utc(row.expires_at) <= datetime.now(timezone.utc):
+            # Expired but not purged yet; free the key for this request
+            db.delete(row)
+            db.commit()
+            return None
+        if row.request_hash != self.request_hash:
+            raise KeyReusedError("Idempotency-Key was already used for a different request")
+        return row
+
+    def claim(self, db: Session):
+        """Insert the key at the start of the write transaction"""
+        now = datetime.now(timezone.utc)
+        self.row = IdempotencyKey(
+            key=self.key,
+            scope=self.scope,
+            request_hash=self.request_hash,
+            expires_at=now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+        )
+        db.add(self.row)
+        db.flush()
+
+    def store(self, db: Session, response: BaseModel, status_code: int = 200):
+        """Save the response with the key; call right before the write commits"""
+        self.row.status_code = status_code
+        self.row.response_body = response.model_dump_json()
+        db.flush()
+        schedule_purge()
+
+def is_key_conflict(error: IntegrityError) -> bool:
+    """Whether a write failed because a concurrent request claimed the same key"""
+    return IdempotencyKey.__tablename__ in str(error.orig)
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite returns naive datetimes
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+def purge_expired(db: Session) -> int:
+    deleted = db.query(IdempotencyKey).filter(
+        IdempotencyKey.expires_at <= datetime.now(timezone.utc)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def purge_expired_job():
+    db = SessionLocal()
+    try:
+        deleted = purge_expired(db)
+        if deleted:
+            logger.info("Purged %d expired idempotency keys", deleted)
+    finally:
+        db.close()
+
+def schedule_purge():
+    """Queue a purge of expired keys at most once per PURGE_INTERVAL"""
+    global _last_purge
+    with _purge_lock:
+        now = time.monotonic()
+        if now - _last_purge < PURGE_INTERVAL:
+            return
+        _last_purge = now
+    tasks.defer(purge_expired_job, key=("idempotency_purge",))
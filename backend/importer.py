@@ -0,0 +1,608 @@
+"""
+Streaming bulk import of users, groups, expenses and settlements.
+
+A ledger file is CSV (with a header row) or NDJSON, one record per row, and
+the ``type`` column says what the row is:
+
+* ``user`` - ``name``, ``email``; users whose email already exists are skipped
+* ``group`` - ``group`` (name), ``description``, ``members`` (emails separated
+  by ``;``), optional base ``currency``
+* ``expense`` - ``group``, ``description``, ``amount``, ``paid_by`` (email),
+  ``split_type`` (``equal`` or ``percentage``), ``splits``
+  (``email:percentage`` pairs separated by ``;``), optional ``date`` and
+  ``currency``
+* ``settlement`` - ``group``, ``from``, ``to`` (emails), ``amount``, optional
+  ``description``, ``date`` and ``currency``
+
+Amounts in another currency than the group's base currency are converted
+with the rate effective on the row's date.
+
+``group`` refers to a group declared earlier in the file, an existing group
+with that (unique) name, or an existing group id. A group declared twice is
+reported as long as its first declaration is among the last
+``LOOKUP_CACHE_SIZE`` the import made. Rows are read
+incrementally and written ``IMPORT_CHUNK_SIZE`` at a time, each chunk in one
+transaction with bulk inserts and one ledger and rollup update per group.
+Emails are resolved with batched ``IN`` lookups against the unique email
+index; a user another writer creates in the meantime is read back and the
+chunk written again. Invalid rows are reported with their line number and skipped, so
+memory stays constant however large the file is.
+
+Run ``python importer.py ledger.csv`` to import from the command line.
+"""
+
+import argparse
+from collections import OrderedDict, defaultdict
+import csv
+from datetime import datetime, timezone
+import io
+import json
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import (
+    User, Group, Expense, ExpenseSplit, Settlement, group_members, REMAINDER_FIRST_MEMBER, DEFAULT_CURRENCY
+)
+from database import SessionLocal
+import analytics
+import crud
+import fx
+import ledger
+import money
+import schemas
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+LOOKUP_BATCH_SIZE = 500  # emails or ids per IN (...) lookup
+LOOKUP_CACHE_SIZE = 100000  # resolved emails and group names kept between chunks
+MAX_REPORTED_ERRORS = 1000
+USER_CONFLICT_ATTEMPTS = 3
+
+RECORD_TYPES = ("user", "group", "expense", "settlement")
+FORMATS = ("csv", "ndjson")
+
+class ImportRowError(ValueError):
+    """A row that cannot be imported; it is reported and skipped"""
+
+class LookupCache:
+    """Bounded least-recently-used mapping"""
+
+    def __init__(self, size: int = LOOKUP_CACHE_SIZE):
+        self._size = size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+
+def detect_format(filename: Optional[str]) -> str:
+    if filename and filename.lower().endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    return "csv"
+
+def read_records(stream, fmt: str) -> Iterator[Tuple[int, Dict]]:
+    """Yield (line number, record) pairs from a binary stream without reading it all"""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                record = {"type": None, "_error": f"Invalid JSON: {e.msg}"}
+            if not isinstance(record, dict):
+                record = {"type": None, "_error": "Each line must be a JSON object"}
+            yield line_number, record
+    else:
+        raise ValueError(f"Unknown import format: {fmt}. Use one of: {', '.join(FORMATS)}")
+
+def _text(record: Dict, name: str, required: bool = True) -> Optional[str]:
+    value = record.get(name)
+    if value is not None and not isinstance(value, str):
+        value = str(value)
+    value = value.strip() if value else None
+    if required and not value:
+        raise ImportRowError(f"Missing {name}")
+    return value
+
+def _email(record: Dict, name: str) -> str:
+    return _text(record, name)
+
+def _amount(record: Dict) -> float:
+    try:
+        amount = float(record.get("amount"))
+    except (TypeError, ValueError):
+        raise ImportRowError("amount must be a number")
+    amount = crud.round_currency(amount)
+    if amount <= 0:
+        raise ImportRowError("amount must be positive")
+    return amount
+
+def _currency(record: Dict) -> Optional[str]:
+    value = _text(record, "currency", required=False)
+    if value is None:
+        return None
+    try:
+        return schemas.normalize_currency(value)
+    except ValueError as e:
+        raise ImportRowError(str(e))
+
+def _date(record: Dict) -> datetime:
+    value = _text(record, "date", required=False)
+    if value is None:
+        return datetime.now(timezone.utc)
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise ImportRowError(f"Invalid date: {value}")
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+def _members(record: Dict) -> List[str]:
+    value = record.get("members") or []
+    if isinstance(value, str):
+        value = value.split(";")
+    return [email.strip() for email in value if email and email.strip()]
+
+def _splits(record: Dict) -> List[Tuple[str, float]]:
+    value = record.get("splits") or []
+    if isinstance(value, dict):
+        items = list(value.items())
+    elif isinstance(value, str):
+        items = [part.rsplit(":", 1) for part in value.split(";") if part.strip()]
+    else:
+        raise ImportRowError("splits must be \"email:percentage\" pairs separated by ;")
+    splits = []
+    for item in items:
+        if len(item) != 2:
+            raise ImportRowError("splits must be \"email:percentage\" pairs separated by ;")
+        try:
+            splits.append((item[0].strip(), float(item[1])))
+        except (TypeError, ValueError):
+            raise ImportRowError(f"Invalid percentage for {item[0]}")
+    return splits
+
+def parse_record(record: Dict) -> Dict:
+    """Validate the shape of a record; references are resolved later in bulk"""
+    if "_error" in record:
+        raise ImportRowError(record["_error"])
+    record_type = _text(record, "type").lower()
+    if record_type == "user":
+        return {"type": "user", "name": _text(record, "name"), "email": _email(record, "email")}
+    if record_type == "group":
+        return {
+            "type": "group",
+            "name": _text(record, "group"),
+            "description": _text(record, "description", required=False),
+            "members": _members(record),
+            "base_currency": _currency(record),
+        }
+    if record_type == "expense":
+        split_type = (_text(record, "split_type", required=False) or "equal").lower()
+        if split_type not in ("equal", "percentage"):
+            raise ImportRowError("split_type must be equal or percentage")
+        parsed = {
+            "type": "expense",
+            "group": _text(record, "group"),
+            "description": _text(record, "description"),
+            "amount": _amount(record),
+            "paid_by": _email(record, "paid_by"),
+            "split_type": split_type,
+            "splits": _splits(record) if split_type == "percentage" else [],
+            "created_at": _date(record),
+            "currency": _currency(record),
+        }
+        if split_type == "percentage" and not parsed["splits"]:
+            raise ImportRowError("percentage expenses need splits")
+        return parsed
+    if record_type == "settlement":
+        parsed = {
+            "type": "settlement",
+            "group": _text(record, "group"),
+            "from": _email(record, "from"),
+            "to": _email(record, "to"),
+            "amount": _amount(record),
+            "description": _text(record, "description", required=False) or "Settlement",
+            "created_at": _date(record),
+            "currency": _currency(record),
+        }
+        if parsed["from"] == parsed["to"]:
+            raise ImportRowError("from and to must be different users")
+        return parsed
+    raise ImportRowError(f"Unknown type: {record_type}. Use one of: {', '.join(RECORD_TYPES)}")
+
+def is_user_conflict(error: IntegrityError) -> bool:
+    """Whether an insert failed on the unique email of users"""
+    message = str(error.orig)
+    return "users" in message and "email" in message
+
+def _batches(values: List, size: int = LOOKUP_BATCH_SIZE) -> Iterator[List]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+class LedgerImporter:
+    """Imports a stream of records in chunked transactions, yielding progress reports"""
+
+    def __init__(self, db: Session, chunk_size: int = IMPORT_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.user_ids = LookupCache()  # email -> user id
+        self.group_ids = LookupCache()  # name or "#id" -> group id
+        self.declared_groups = LookupCache()  # names of groups created by this import
+        self.touched_group_ids = set()
+        self.counts = {
+            "rows": 0, "users": 0, "existing_users": 0, "groups": 0,
+            "expenses": 0, "settlements": 0, "errors": 0,
+        }
+
+    def run(self, records: Iterable[Tuple[int, Dict]]) -> Iterator[Dict]:
+        """Import all records; yields error, progress and a final summary report"""
+        chunk = []
+        for line_number, record in records:
+            chunk.append((line_number, record))
+            if len(chunk) >= self.chunk_size:
+                yield from self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._import_chunk(chunk)
+        yield {"event": "done", **self.counts}
+
+    def _error(self, line_number: int, message: str) -> Optional[Dict]:
+        self.counts["errors"] += 1
+        if self.counts["errors"] <= MAX_REPORTED_ERRORS:
+            return {"event": "error", "line": line_number, "message": message}
+        return None
+
+    def _import_chunk(self, chunk: List[Tuple[int, Dict]]) -> Iterator[Dict]:
+        self.counts["rows"] += len(chunk)
+        rows = []
+        errors = []
+        for line_number, record in chunk:
+            try:
+                rows.append((line_number, parse_record(record)))
+            except ImportRowError as e:
+                errors.append((line_number, str(e)))
+
+        self._resolve_users(rows)
+        self._resolve_groups(rows)
+
+        # The chunk is one transaction; it is re-run from scratch on conflicts
+        for attempt in range(1, USER_CONFLICT_ATTEMPTS + 1):
+            try:
+                result = ledger.run_with_retry(self.db, lambda: self._write_chunk(rows))
+                break
+            except IntegrityError as e:
+                # Another writer created one of the chunk's new users since they
+                # were looked up; read them back so they count as existing
+                if attempt == USER_CONFLICT_ATTEMPTS or not is_user_conflict(e):
+                    raise
+                self._resolve_users(rows)
+        errors.extend(result["errors"])
+
+        for email, user_id in result["user_ids"].items():
+            self.user_ids.put(email, user_id)
+        for name, group_id in result["group_ids"].items():
+            self.group_ids.put(name, group_id)
+            self.declared_groups.put(name, True)
+        self.touched_group_ids.update(result["touched"])
+        for key in ("users", "existing_users", "groups", "expenses", "settlements"):
+            self.counts[key] += result[key]
+
+        for line_number, message in sorted(errors):
+            report = self._error(line_number, message)
+            if report is not None:
+                yield report
+        yield {"event": "progress", **self.counts}
+
+    def _resolve_users(self, rows):
+        """Look up every email the chunk mentions that is not cached yet"""
+        emails = set()
+        for _, row in rows:
+            if row["type"] == "user":
+                emails.add(row["email"])
+            elif row["type"] == "group":
+                emails.update(row["members"])
+            elif row["type"] == "expense":
+                emails.add(row["paid_by"])
+                emails.update(email for email, _ in row["splits"])
+            elif row["type"] == "settlement":
+                emails.update((row["from"], row["to"]))
+        missing = sorted(email for email in emails if email not in self.user_ids)
+        for batch in _batches(missing):
+            for user_id, email in self.db.query(User.id, User.email).filter(User.email.in_(batch)):
+                self.user_ids.put(email, user_id)
+
+    def _resolve_groups(self, rows):
+        """Look up existing groups referenced by id or name"""
+        references = {row["group"] for _, row in rows if row["type"] in ("expense", "settlement")}
+        references -= {reference for reference in references if reference in self.group_ids}
+        ids = sorted(int(reference) for reference in references if reference.isdigit())
+        for batch in _batches(ids):
+            for (group_id,) in self.db.query(Group.id).filter(Group.id.in_(batch)):
+                self.group_ids.put(str(group_id), group_id)
+        names = sorted(reference for reference in references if not reference.isdigit())
+        for batch in _batches(names):
+            found = defaultdict(list)
+            for group_id, name in self.db.query(Group.id, Group.name).filter(Group.name.in_(batch)):
+                found[name].append(group_id)
+            for name, group_ids in found.items():
+                # Names are not unique; ambiguous ones must be referenced by id
+                if len(group_ids) == 1:
+                    self.group_ids.put(name, group_ids[0])
+
+    def _write_chunk(self, rows) -> Dict:
+        db = self.db
+        errors = []
+        new_user_ids = {}
+        new_group_ids = {}
+        result = {"users": 0, "existing_users": 0, "groups": 0, "expenses": 0, "settlements": 0}
+
+        def user_id_of(email):
+            user_id = new_user_ids.get(email) or self.user_ids.get(email)
+            if user_id is None:
+                raise ImportRowError(f"Unknown user: {email}")
+            return user_id
+
+        def group_id_of(reference):
+            group_id = new_group_ids.get(reference) or self.group_ids.get(reference)
+            if group_id is None:
+                raise ImportRowError(f"Unknown or ambiguous group: {reference}")
+            return group_id
+
+        # Users
+        user_rows = []
+        for line_number, row in rows:
+            if row["type"] != "user":
+                continue
+            if row["email"] in self.user_ids or row["email"] in new_user_ids:
+                result["existing_users"] += 1
+                continue
+            new_user_ids[row["email"]] = None
+            user_rows.append({"name": row["name"], "email": row["email"]})
+        if user_rows:
+            created = db.scalars(insert(User).returning(User.id, sort_by_parameter_order=True), user_rows).all()
+            for user_row, user_id in zip(user_rows, created):
+                new_user_ids[user_row["email"]] = user_id
+            result["users"] = len(created)
+
+        # Groups and their members
+        group_rows = []
+        for line_number, row in rows:
+            if row["type"] != "group":
+                continue
+            try:
+                if row["name"] in self.declared_groups or row["name"] in new_group_ids:
+                    raise ImportRowError(f"Group {row['name']} is declared more than once")
+                member_ids = list(dict.fromkeys(user_id_of(email) for email in row["members"]))
+            except ImportRowError as e:
+                errors.append((line_number, str(e)))
+                continue
+            new_group_ids[row["name"]] = None
+            group_rows.append((row, member_ids))
+        if group_rows:
+            created = db.scalars(
+                insert(Group).returning(Group.id, sort_by_parameter_order=True),
+                [
+                    {"name": row["name"], "description": row["description"],
+                     "base_currency": row["base_currency"] or DEFAULT_CURRENCY}
+                    for row, _ in group_rows
+                ]
+            ).all()
+            membership = []
+            for (row, member_ids), group_id in zip(group_rows, created):
+                new_group_ids[row["name"]] = group_id
+                membership.extend({"group_id": group_id, "user_id": user_id} for user_id in member_ids)
+                ledger.initialize_group_ledger(db, group_id)
+            if membership:
+                db.execute(insert(group_members), membership)
+            result["groups"] = len(created)
+
+        # Resolve the groups of expenses and settlements and load their members
+        activity = []
+        for line_number, row in rows:
+            if row["type"] not in ("expense", "settlement"):
+                continue
+            try:
+                activity.append((line_number, row, group_id_of(row["group"])))
+            except ImportRowError as e:
+                errors.append((line_number, str(e)))
+        members_by_group, base_currencies = self._load_groups({group_id for _, _, group_id in activity})
+
+        ledger_deltas = defaultdict(lambda: defaultdict(float))
+        ledger_counts = defaultdict(lambda: [0.0, 0, 0])  # expense total, expenses, settlements
+        rollups = defaultdict(lambda: defaultdict(lambda: [0.0, 0.0, 0, 0]))
+        snapshots = {}
+        expense_rows = []
+        expense_shares = []
+        settlement_rows = []
+
+        for line_number, row, group_id in activity:
+            members = members_by_group.get(group_id, [])
+            try:
+                # Everything below works on the amount in the group's base currency
+                conversion = self._to_base(db, row, base_currencies.get(group_id, DEFAULT_CURRENCY))
+                row = dict(row, amount=conversion.amount)
+                if row["type"] == "expense":
+                    paid_by = user_id_of(row["paid_by"])
+                    if paid_by not in members:
+                        raise ImportRowError("User who paid is not in the group")
+                    expense_row, shares = self._expense(
+                        db, row, conversion, group_id, paid_by, members, snapshots, user_id_of
+                    )
+                    expense_rows.append(expense_row)
+                    expense_shares.append(shares)
+                    period = analytics.rollup_period(row["created_at"])
+                    ledger_deltas[group_id][paid_by] += row["amount"]
+                    ledger_counts[group_id][0] += row["amount"]
+                    ledger_counts[group_id][1] += 1
+                    rollups[group_id][(paid_by, period)][0] += row["amount"]
+                    rollups[group_id][(paid_by, period)][2] += 1
+                    for user_id, amount, _ in shares:
+                        ledger_deltas[group_id][user_id] -= amount
+                        rollups[group_id][(user_id, period)][1] += amount
+                        rollups[group_id][(user_id, period)][3] += 1
+                else:
+                    from_user_id = user_id_of(row["from"])
+                    to_user_id = user_id_of(row["to"])
+                    settlement_rows.append({
+                        "from_user_id": from_user_id,
+                        "to_user_id": to_user_id,
+                        "amount": row["amount"],
+                        "currency": conversion.currency,
+                        "original_amount": conversion.original_amount,
+                        "fx_rate": conversion.fx_rate,
+                        "group_id": group_id,
+                        "description": row["description"],
+                        "created_at": row["created_at"],
+                    })
+                    ledger_deltas[group_id][from_user_id] += row["amount"]
+                    ledger_deltas[group_id][to_user_id] -= row["amount"]
+                    ledger_counts[group_id][2] += 1
+            except ImportRowError as e:
+                errors.append((line_number, str(e)))
+
+        if expense_rows:
+            expense_ids = db.scalars(
+                insert(Expense).returning(Expense.id, sort_by_parameter_order=True), expense_rows
+            ).all()
+            split_rows = [
+                {"expense_id": expense_id, "user_id": user_id, "amount": amount, "percentage": percentage}
+                for expense_id, shares, expense_row in zip(expense_ids, expense_shares, expense_rows)
+                if expense_row["split_type"] == "percentage"
+                for user_id, amount, percentage in shares
+            ]
+            if split_rows:
+                db.execute(insert(ExpenseSplit), split_rows)
+            result["expenses"] = len(expense_ids)
+        if settlement_rows:
+            db.execute(insert(Settlement), settlement_rows)
+            result["settlements"] = len(settlement_rows)
+
+        # One ledger and rollup update per group, in ascending group order
+        for group_id in sorted(ledger_counts):
+            expense_total, expense_count, settlement_count = ledger_counts[group_id]
+            ledger.apply_deltas(
+                db, group_id, ledger_deltas[group_id], expense_amount=expense_total,
+                expense_count=expense_count, settlement_count=settlement_count
+            )
+            if rollups[group_id]:
+                analytics.apply_rollups(db, group_id, rollups[group_id])
+
+        db.commit()
+        result.update(
+            errors=errors,
+            user_ids={email: user_id for email, user_id in new_user_ids.items() if user_id is not None},
+            group_ids={name: group_id for name, group_id in new_group_ids.items() if group_id is not None},
+            touched=set(new_group_ids.values()) | set(ledger_counts),
+        )
+        return result
+
+    def _load_groups(self, group_ids) -> Tuple[Dict[int, List[int]], Dict[int, str]]:
+        """Member ids of each group, in the order used for equal-split snapshots, and base currencies"""
+        groups = []
+        for batch in _batches(sorted(group_ids)):
+            groups.extend(self.db.query(Group).filter(Group.id.in_(batch)).all())
+        members = {group.id: [member.id for member in group.members] for group in groups}
+        return members, {group.id: group.base_currency for group in groups}
+
+    def _to_base(self, db: Session, row, base_currency: str) -> fx.Conversion:
+        try:
+            return fx.to_base(db, row["amount"], row["currency"], base_currency, row["created_at"])
+        except fx.RateNotFoundError as e:
+            raise ImportRowError(str(e))
+
+    def _expense(
+        self, db: Session, row, conversion: fx.Conversion, group_id: int, paid_by: int, members: List[int],
+        snapshots, user_id_of
+    ):
+        """Expense insert values and its (user_id, amount, percentage) shares"""
+        expense_row = {
+            "description": row["description"],
+            "amount": row["amount"],
+            "currency": conversion.currency,
+            "original_amount": conversion.original_amount,
+            "fx_rate": conversion.fx_rate,
+            "group_id": group_id,
+            "paid_by": paid_by,
+            "split_type": row["split_type"],
+            "membership_snapshot_id": None,
+            "remainder_rule": None,
+            "created_at": row["created_at"],
+        }
+        if row["split_type"] == "equal":
+            if not members:
+                raise ImportRowError("Cannot split an expense equally in a group with no members")
+            if group_id not in snapshots:
+                group = db.query(Group).filter(Group.id == group_id).first()
+                snapshots[group_id] = crud.get_or_create_membership_snapshot(db, group).id
+            expense_row["membership_snapshot_id"] = snapshots[group_id]
+            expense_row["remainder_rule"] = REMAINDER_FIRST_MEMBER
+            amounts = money.equal_split_amounts(row["amount"], len(members), REMAINDER_FIRST_MEMBER)
+            return expense_row, [(user_id, amount, None) for user_id, amount in zip(members, amounts)]
+
+        splits = [
+            schemas.ExpenseSplitCreate(user_id=user_id_of(email), percentage=percentage)
+            for email, percentage in row["splits"]
+        ]
+        if not crud.validate_expense_mathematical_consistency(db, group_id, row["amount"], splits):
+            raise ImportRowError("Expense splits do not add up to total amount or percentages do not equal 100%")
+        shares = [
+            (split.user_id, crud.round_currency((split.percentage / 100) * row["amount"]), split.percentage)
+            for split in splits
+        ]
+        return expense_row, shares
+
+def import_ledger(db: Session, stream, fmt: str = "csv", chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[Dict]:
+    """Import a CSV or NDJSON ledger from a binary stream, yielding progress reports"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown import format: {fmt}. Use one of: {', '.join(FORMATS)}")
+    return LedgerImporter(db, chunk_size=chunk_size).run(read_records(stream, fmt))
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import users, groups, expenses and settlements")
+    parser.add_argument("path", help="CSV or NDJSON ledger file, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="file format (default: from the file extension)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="rows per transaction")
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.path)
+    stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    db = SessionLocal()
+    try:
+        for report in import_ledger(db, stream, fmt, chunk_size=args.chunk_size):
+            if report["event"] == "error":
+                print(f"❌ Line {report['line']}: {report['message']}", file=sys.stderr)
+            elif report["event"] == "progress":
+                print(f"📥 {report['rows']} rows: {report['users']} users, {report['groups']} groups, "
+                      f"{report['expenses']} expenses, {report['settlements']} settlements, "
+                      f"{report['errors']} errors", file=sys.stderr)
+            else:
+                print(f"✅ Imported {report['users']} users ({report['existing_users']} already existed), "
+                      f"{report['groups']} groups, {report['expenses']} expenses, "
+                      f"{report['settlements']} settlements; {report['errors']} rows failed")
+    finally:
+        db.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Contention-safe maintenance of the per-group balance ledger.
+
+``group_balances`` holds each user's net balance in a group and
+``group_totals`` the group's expense total and counts. Every expense or
+settlement changes them, so in a busy group they are the hottest rows in the
+database. Writers therefore never read-modify-write them. They:
+
+* apply ``UPDATE ... SET net = net + :delta`` so concurrent increments
+  compose instead of overwriting each other,
+* touch the group total row first and then the balance rows in ascending
+  user id order, so two transactions can never wait on each other's locks
+  in opposite orders,
+* do the aggregate updates as the last statements before commit to keep the
+  hot row locks short, and
+* retry the whole transaction on serialization failures and deadlocks.
+"""
+
+from collections import defaultdict
+import logging
+import random
+import time
+from typing import Callable, Dict, Iterable, TypeVar
+
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session
+
+from models import Expense, Settlement, GroupBalance, GroupTotal, GroupCheckpoint
+import crud
+import money
+
+logger = logging.getLogger(__name__)
+
+WRITE_RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.01  # seconds, doubled on every attempt
+
+# PostgreSQL serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+# Aggregate tables whose rows are created on first use by concurrent writers
+LEDGER_TABLES = ("group_totals", "group_balances", "spending_rollups")
+
+T = TypeVar("T")
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed transaction can safely be re-run from the start"""
+    if isinstance(error, IntegrityError):
+        # Two writers initializing the same ledger or rollup rows; the loser retries
+        return any(table in str(error.orig) for table in LEDGER_TABLES)
+    if isinstance(error, DBAPIError):
+        pgcode = getattr(error.orig, "pgcode", None)
+        if pgcode in RETRYABLE_PGCODES:
+            return True
+        return "database is locked" in str(error.orig)
+    return False
+
+def run_with_retry(db: Session, transaction: Callable[[], T], attempts: int = WRITE_RETRY_ATTEMPTS) -> T:
+    """Run a function that ends in ``db.commit()``, retrying it on transient conflicts"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return transaction()
+        except (DBAPIError, IntegrityError) as error:
+            db.rollback()
+            if attempt == attempts or not is_retryable(error):
+                raise
+            delay = RETRY_BASE_DELAY * (2 ** (attempt - 1))
+            logger.info("Retrying write after %s (attempt %d)", type(error).__name__, attempt)
+            time.sleep(delay + random.uniform(0, delay))
+
+def expense_deltas(expense: Expense) -> Dict[int, float]:
+    """Change in each user's net balance caused by an expense"""
+    deltas = defaultdict(float)
+    deltas[expense.paid_by] += expense.amount
+    for split in expense.splits:
+        deltas[split.user_id] -= split.amount
+    return deltas
+
+def settlement_deltas(settlement: Settlement) -> Dict[int, float]:
+    """Change in each user's net balance caused by a settlement"""
+    deltas = defaultdict(float)
+    deltas[settlement.from_user_id] += settlement.amount
+    deltas[settlement.to_user_id] -= settlement.amount
+    return deltas
+
+def _is_initialized(db: Session, group_id: int) -> bool:
+    return db.query(GroupTotal.group_id).filter(GroupTotal.group_id == group_id).first() is not None
+
+def apply_deltas(
+    db: Session,
+    group_id: int,
+    deltas: Dict[int, float],
+    expense_amount: float = 0,
+    expense_count: int = 0,
+    settlement_count: int = 0
+):
+    """Atomically add a write's effect to the group's ledger rows
+
+    Call after the new rows are flushed and right before commit. A group whose
+    ledger was never built is rebuilt from its rows instead, which already
+    includes the flushed write.
+    """
+    if not _is_initialized(db, group_id):
+        rebuild_group_ledger(db, group_id)
+        return
+
+    # Lock order: the group total row, then balance rows by ascending user id
+    db.execute(
+        update(GroupTotal)
+        .where(GroupTotal.group_id == group_id)
+        .values(
+            total_expenses=GroupTotal.total_expenses + expense_amount,
+            expense_count=GroupTotal.expense_count + expense_count,
+            settlement_count=GroupTotal.settlement_count + settlement_count
+        )
+    )
+    changed = sorted((user_id, delta) for user_id, delta in deltas.items() if user_id is not None and delta != 0)
+    for user_id, delta in changed:
+        result = db.execute(
+            update(GroupBalance)
+            .where(GroupBalance.group_id == group_id, GroupBalance.user_id == user_id)
+            .values(net=GroupBalance.net + delta)
+        )
+        if result.rowcount == 0:
+            # First activity for this user in the group. A concurrent insert of the
+            # same row raises IntegrityError and the transaction is retried
+            db.execute(insert(GroupBalance).values(group_id=group_id, user_id=user_id, net=delta))
+
+def lock_groups(db: Session, group_ids: Iterable[int]):
+    """Hold off other writers to several groups until commit
+
+    Takes the group total rows in ascending group order, the same first lock
+    apply_deltas takes, so a transaction that reads balances after this call
+    sees them unchanged when it writes. Groups whose ledger was never built
+    get it built first, as there would be no row to lock; a concurrent build
+    of the same ledger raises IntegrityError and ``run_with_retry`` re-runs
+    the transaction.
+    """
+    group_ids = sorted(set(group_ids))
+    locked = db.query(GroupTotal.group_id).filter(
+        GroupTotal.group_id.in_(group_ids)
+    ).order_by(GroupTotal.group_id).with_for_update().all()
+    missing = set(group_ids) - {group_id for group_id, in locked}
+    if missing:
+        for group_id in sorted(missing):
+            rebuild_group_ledger(db, group_id)
+        db.query(GroupTotal.group_id).filter(
+            GroupTotal.group_id.in_(sorted(missing))
+        ).order_by(GroupTotal.group_id).with_for_update().all()
+
+def rebuild_group_ledger(db: Session, group_id: int):
+    """Recompute a group's ledger rows from its expenses, settlements and checkpoints"""
+    net_balances = defaultdict(float)
+    expenses = db.query(Expense).filter(Expense.group_id == group_id).all()
+    settlements = db.query(Settlement).filter(Settlement.group_id == group_id).all()
+    crud.accumulate_net_balances(net_balances, expenses, settlements)
+    for user_id, amount in crud.get_checkpoint_balances(db, group_id):
+        net_balances[user_id] += amount
+
+    archived_total, archived_expenses, archived_settlements = db.query(
+        func.sum(GroupCheckpoint.total_expenses),
+        func.sum(GroupCheckpoint.expense_count),
+        func.sum(GroupCheckpoint.settlement_count)
+    ).filter(GroupCheckpoint.group_id == group_id).one()
+
+    db.query(GroupBalance).filter(GroupBalance.group_id == group_id).delete(synchronize_session=False)
+    db.query(GroupTotal).filter(GroupTotal.group_id == group_id).delete(synchronize_session=False)
+    db.execute(insert(GroupTotal).values(
+        group_id=group_id,
+        total_expenses=sum(expense.amount for expense in expenses) + (archived_total or 0),
+        expense_count=len(expenses) + (archived_expenses or 0),
+        settlement_count=len(settlements) + (archived_settlements or 0)
+    ))
+    balance_rows = [
+        {"group_id": group_id, "user_id": user_id, "net": net}
+        for user_id, net in sorted(item for item in net_balances.items() if item[0] is not None)
+    ]
+    if balance_rows:
+        db.execute(insert(GroupBalance), balance_rows)
+
+def initialize_group_ledger(db: Session, group_id: int):
+    """Create the empty ledger of a new group"""
+    db.execute(insert(GroupTotal).values(group_id=group_id, total_expenses=0, expense_count=0, settlement_count=0))
+
+def rebuild_ledgers(db: Session, group_ids: Iterable[int]):
+    """Rebuild several ledgers after bulk changes to their rows"""
+    # Bulk deletes and updates bypass the session, so reload everything from the database
+    db.flush()
+    db.expire_all()
+    for group_id in sorted(set(group_ids)):
+        rebuild_group_ledger(db, group_id)
+
+def delete_group_ledger(db: Session, group_id: int):
+    db.query(GroupBalance).filter(GroupBalance.group_id == group_id).delete(synchronize_session=False)
+    db.query(GroupTotal).filter(GroupTotal.group_id == group_id).delete(synchronize_session=False)
+
+def get_group_totals(db: Session, group_ids: Iterable[int]) -> Dict[int, float]:
+    """Ledger expense totals of the given groups; groups without a ledger are omitted"""
+    rows = db.query(GroupTotal.group_id, GroupTotal.total_expenses).filter(
+        GroupTotal.group_id.in_(list(group_ids))
+    ).all()
+    return {group_id: total for group_id, total in rows}
+
+def get_user_nets(db: Session, user_id: int, group_ids: Iterable[int]) -> Dict[int, float]:
+    """A user's ledger net balance in each of the given groups"""
+    rows = db.query(GroupBalance.group_id, GroupBalance.net).filter(
+        GroupBalance.user_id == user_id, GroupBalance.group_id.in_(list(group_ids))
+    ).all()
+    return {group_id: money.round_currency(net) for group_id, net in rows}
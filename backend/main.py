@@ -1,18 +1,60 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Header, Query, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from typing import List
+from sqlalchemy.exc import IntegrityError, OperationalError
+from typing import List, Optional
+import json
+import logging
+import os
+import secrets
+from contextlib import asynccontextmanager
 
+import analytics
+import archive
+import chatbot
 import crud
+import events
+import importer
+import fieldsets
+import fx
+import idempotency
+import migrations
 import models
+import netting
+import recurring
 import schemas
-from database import SessionLocal, engine, get_db
+import search
+import slow_queries
+import tasks
+import database
+from database import SessionLocal, engine, get_db, get_read_db
 
-# Create tables
+# Create tables, then add the columns existing tables are missing
 models.Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
-app = FastAPI(title="Splitwise Clone API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if recurring.RECURRING_SCHEDULER_ENABLED:
+        recurring.scheduler.start()
+    yield
+    recurring.scheduler.stop()
+    # Finish deferred post-commit work before the process exits
+    tasks.work_queue.drain()
+
+app = FastAPI(
+    title="Splitwise Clone API",
+    version="1.0.0",
+    lifespan=lifespan,
+    # Tags each request's statements with its route and statement timeout
+    dependencies=[Depends(database.route_context)]
+)
+
+# Required in the X-Admin-Token header of /admin routes, which are disabled when unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 # Configure CORS
 app.add_middleware(
@@ -21,47 +63,214 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Commit-Position"],
 )
 
+logger = logging.getLogger(__name__)
+
+@app.exception_handler(OperationalError)
+async def database_error(request: Request, error: OperationalError):
+    if getattr(error.orig, "pgcode", None) == "57014":
+        # Cancelled by the route's statement timeout
+        return JSONResponse({"detail": "The request took too long and was cancelled"}, status_code=503)
+    logger.error("Database error on %s %s", request.method, request.url.path, exc_info=error)
+    return JSONResponse({"detail": "Internal Server Error"}, status_code=500)
+
+# POST endpoints that only read, so they don't pin the client to the primary
+READ_ONLY_POSTS = {"/query"}
+
+@app.middleware("http")
+async def track_client_writes(request: Request, call_next):
+    # Pin the client's reads to the primary for a short window after its own writes
+    response = await call_next(request)
+    if (
+        request.method not in ("GET", "HEAD", "OPTIONS")
+        and request.url.path not in READ_ONLY_POSTS
+        and response.status_code < 400
+    ):
+        database.record_write(database.client_key(request))
+        # Lets reads through any server process ask for this write, see get_read_db
+        if database.TRACKS_COMMIT_POSITIONS:
+            position = await run_in_threadpool(database.commit_position)
+            if position:
+                response.headers["X-Commit-Position"] = position
+    return response
+
+def parse_fieldset(fields, include, allowed_fields, allowed_includes=()):
+    """Parse ?fields=/?include= for a listing endpoint, rejecting unknown names"""
+    try:
+        return fieldsets.parse(fields, include, allowed_fields, allowed_includes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def begin_idempotent(key, request: Request, payload):
+    """Wrap a write sent with an Idempotency-Key header; None without one"""
+    if key is None:
+        return None
+    try:
+        return idempotency.IdempotentRequest(key, request.method, request.url.path, payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def replay_idempotent(db: Session, idempotent):
+    """The stored response of a completed request with the same key, if any"""
+    if idempotent is None:
+        return None
+    try:
+        row = idempotent.lookup(db)
+    except idempotency.KeyReusedError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if row is None:
+        return None
+    return JSONResponse(
+        json.loads(row.response_body), status_code=row.status_code, headers={"Idempotent-Replayed": "true"}
+    )
+
+def replay_after_conflict(db: Session, idempotent, error: IntegrityError):
+    if idempotent is None or not idempotency.is_key_conflict(error):
+        raise error
+    replayed = replay_idempotent(db, idempotent)
+    if replayed is None:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    return replayed
+
+def require_admin(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin routes are disabled; set ADMIN_TOKEN to enable them")
+    if token is None or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def parse_period_range(start, end):
+    """Validate an inclusive ?start=/?end= range of YYYY-MM months"""
+    try:
+        return analytics.validate_period(start, "start"), analytics.validate_period(end, "end")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # User endpoints
 @app.post("/users/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    return crud.create_user(db=db, user=user)
+    db_user = crud.create_user(db=db, user=user)
+    chatbot.name_index.invalidate()
+    return db_user
 
 @app.get("/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_users(
+    skip: int = 0,
+    limit: int = 100,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    fieldset = parse_fieldset(fields, None, fieldsets.USER_FIELDS)
+    if fieldset is not None:
+        return JSONResponse(fieldsets.list_users(db, fieldset, skip=skip, limit=limit))
     return crud.get_users(db, skip=skip, limit=limit)
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
+def read_user(user_id: int, db: Session = Depends(get_read_db)):
     db_user = crud.get_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.get("/users/{user_id}/balances", response_model=List[schemas.Balance])
-def get_user_balances(user_id: int, db: Session = Depends(get_db)):
+def get_user_balances(user_id: int, db: Session = Depends(get_read_db)):
     return crud.calculate_user_balances(db, user_id=user_id)
 
+@app.get("/users/{user_id}/net-balances", response_model=List[schemas.PairwiseBalance])
+def get_user_net_balances(user_id: int, db: Session = Depends(get_read_db)):
+    if crud.get_user(db, user_id=user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return netting.get_net_balances(db, user_id)
+
+@app.post("/users/{user_id}/settle-all", response_model=schemas.SettleAllResult)
+def settle_all(
+    user_id: int,
+    request: Request,
+    settle: Optional[schemas.SettleAllRequest] = None,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    settle = settle or schemas.SettleAllRequest()
+    idempotent = begin_idempotent(idempotency_key, request, settle)
+    replayed = replay_idempotent(db, idempotent)
+    if replayed is not None:
+        return replayed
+    
+    if crud.get_user(db, user_id=user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if settle.counterparty_id is not None and crud.get_user(db, user_id=settle.counterparty_id) is None:
+        raise HTTPException(status_code=404, detail="Counterparty not found")
+    
+    try:
+        result = netting.settle_all(db, user_id, counterparty_id=settle.counterparty_id, idempotent=idempotent)
+    except IntegrityError as e:
+        return replay_after_conflict(db, idempotent, e)
+    
+    for settlement in result.settlements:
+        events.publish_after_commit(
+            settlement.group_id,
+            events.SETTLEMENT_CREATED,
+            settlement_id=settlement.id,
+            from_user_id=settlement.from_user_id,
+            to_user_id=settlement.to_user_id,
+            amount=settlement.amount
+        )
+    for group_id in sorted({settlement.group_id for settlement in result.settlements}):
+        tasks.defer(archive.archive_if_settled_job, group_id, key=("archive", group_id))
+    return result
+
+@app.get("/users/{user_id}/dashboard", response_model=schemas.UserDashboard)
+def get_user_dashboard(user_id: int, recent_limit: int = 10, db: Session = Depends(get_read_db)):
+    dashboard = crud.get_user_dashboard(db, user_id=user_id, recent_limit=recent_limit)
+    if dashboard is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return dashboard
+
+@app.get("/users/{user_id}/stats", response_model=schemas.UserStats)
+def get_user_stats(
+    user_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    db_user = crud.get_user(db, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    start, end = parse_period_range(start, end)
+    return analytics.get_user_stats(db, db_user, start=start, end=end)
+
 # Group endpoints
 @app.post("/groups/", response_model=schemas.Group)
 def create_group(group: schemas.GroupCreate, db: Session = Depends(get_db)):
-    return crud.create_group(db=db, group=group)
+    db_group = crud.create_group(db=db, group=group)
+    chatbot.name_index.invalidate()
+    return db_group
 
 @app.get("/groups/", response_model=List[schemas.GroupDetail])
-def read_groups(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_groups(
+    skip: int = 0,
+    limit: int = 100,
+    fields: Optional[str] = None,
+    include: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    fieldset = parse_fieldset(fields, include, fieldsets.GROUP_FIELDS, fieldsets.GROUP_INCLUDES)
+    if fieldset is not None:
+        return JSONResponse(fieldsets.list_groups(db, fieldset, skip=skip, limit=limit))
+    
     groups = crud.get_groups(db, skip=skip, limit=limit)
     group_details = []
     
     for group in groups:
         # Calculate total expenses for each group
-        expenses = crud.get_group_expenses(db, group_id=group.id)
-        total_expenses = crud.round_currency(sum(expense.amount for expense in expenses))
+        total_expenses = crud.get_group_total_expenses(db, group_id=group.id)
         
         group_detail = schemas.GroupDetail(
             id=group.id,
             name=group.name,
             description=group.description,
+            base_currency=group.base_currency,
             created_at=group.created_at,
             members=group.members,
             total_expenses=total_expenses
@@ -71,35 +280,78 @@ def read_groups(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     return group_details
 
 @app.get("/groups/{group_id}", response_model=schemas.GroupDetail)
-def read_group(group_id: int, db: Session = Depends(get_db)):
+def read_group(group_id: int, db: Session = Depends(get_read_db)):
     db_group = crud.get_group(db, group_id=group_id)
     if db_group is None:
         raise HTTPException(status_code=404, detail="Group not found")
       # Calculate total expenses
-    expenses = crud.get_group_expenses(db, group_id=group_id)
-    total_expenses = crud.round_currency(sum(expense.amount for expense in expenses))
+    total_expenses = crud.get_group_total_expenses(db, group_id=group_id)
     
     group_detail = schemas.GroupDetail(
         id=db_group.id,
         name=db_group.name,
         description=db_group.description,
+        base_currency=db_group.base_currency,
         created_at=db_group.created_at,
         members=db_group.members,
         total_expenses=total_expenses
     )
     return group_detail
 
+@app.get("/groups/{group_id}/events")
+def stream_group_events(
+    group_id: int,
+    request: Request,
+    last_event_id: Optional[str] = Header(None)
+):
+    # Use a short-lived session so the open stream does not hold a DB connection
+    db = SessionLocal()
+    try:
+        db_group = crud.get_group(db, group_id=group_id)
+    finally:
+        db.close()
+    if db_group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    resume_from = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        events.stream_group_events(group_id, request, last_event_id=resume_from),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/groups/{group_id}/balances", response_model=List[schemas.Balance])
-def get_group_balances(group_id: int, db: Session = Depends(get_db)):
+def get_group_balances(group_id: int, db: Session = Depends(get_read_db)):
     return crud.calculate_group_balances(db, group_id=group_id)
 
+@app.get("/groups/{group_id}/stats", response_model=schemas.GroupStats)
+def get_group_stats(
+    group_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    db_group = crud.get_group(db, group_id=group_id)
+    if db_group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    start, end = parse_period_range(start, end)
+    return analytics.get_group_stats(db, db_group, start=start, end=end)
+
 # Expense endpoints
 @app.post("/groups/{group_id}/expenses", response_model=schemas.Expense)
 def create_expense(
     group_id: int, 
     expense: schemas.ExpenseCreate, 
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
+    # A retry of a completed request gets the original response
+    idempotent = begin_idempotent(idempotency_key, request, expense)
+    replayed = replay_idempotent(db, idempotent)
+    if replayed is not None:
+        return replayed
+    
     # Validate group exists
     db_group = crud.get_group(db, group_id=group_id)
     if db_group is None:
@@ -109,25 +361,172 @@ def create_expense(
         raise HTTPException(status_code=400, detail="User who paid is not in the group")
     
     try:
-        return crud.create_expense(db=db, group_id=group_id, expense=expense)
+        db_expense = crud.create_expense(db=db, group_id=group_id, expense=expense, idempotent=idempotent)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except IntegrityError as e:
+        # A concurrent request with the same key committed first
+        return replay_after_conflict(db, idempotent, e)
+    
+    events.publish_after_commit(group_id, events.EXPENSE_CREATED, expense_id=db_expense.id, amount=db_expense.amount)
+    return db_expense
 
 @app.get("/groups/{group_id}/expenses", response_model=List[schemas.Expense])
-def get_group_expenses(group_id: int, db: Session = Depends(get_db)):
-    return crud.get_group_expenses(db, group_id=group_id)
+def get_group_expenses(
+    group_id: int,
+    include_archived: bool = False,
+    fields: Optional[str] = None,
+    include: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    fieldset = parse_fieldset(fields, include, fieldsets.EXPENSE_FIELDS, fieldsets.EXPENSE_INCLUDES)
+    if fieldset is not None:
+        return JSONResponse(fieldsets.list_group_expenses(db, group_id, fieldset, include_archived=include_archived))
+    return crud.get_group_expenses(db, group_id=group_id, include_archived=include_archived)
+
+@app.post("/groups/{group_id}/recurring-expenses", response_model=schemas.RecurringExpense)
+def create_recurring_expense(
+    group_id: int,
+    template: schemas.RecurringExpenseCreate,
+    db: Session = Depends(get_db)
+):
+    db_group = crud.get_group(db, group_id=group_id)
+    if db_group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    try:
+        db_template = recurring.create_template(db, db_group, template)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The scheduler may be sleeping past this template's first run
+    recurring.scheduler.wake()
+    return db_template
+
+@app.get("/groups/{group_id}/recurring-expenses", response_model=List[schemas.RecurringExpense])
+def get_recurring_expenses(group_id: int, db: Session = Depends(get_read_db)):
+    if crud.get_group(db, group_id=group_id) is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return recurring.get_group_templates(db, group_id)
+
+@app.delete("/groups/{group_id}/recurring-expenses/{recurring_id}")
+def delete_recurring_expense(group_id: int, recurring_id: int, db: Session = Depends(get_db)):
+    if not recurring.delete_template(db, group_id, recurring_id):
+        raise HTTPException(status_code=404, detail="Recurring expense not found")
+    return {"message": "Recurring expense deleted successfully"}
+
+@app.get("/groups/{group_id}/export")
+def export_group_history(group_id: int, db: Session = Depends(get_read_db)):
+    db_group = crud.get_group(db, group_id=group_id)
+    if db_group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    # Archived and current history as one CSV ledger
+    rows = crud.export_group_history(db, group_id=group_id)
+    return StreamingResponse(
+        rows,
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="group-{group_id}.csv"'}
+    )
+
+# Search endpoint
+@app.get("/expenses/search", response_model=schemas.ExpenseSearchResults)
+def search_expenses(
+    q: str,
+    group_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0,
+    db: Session = Depends(get_read_db)
+):
+    if not 1 <= limit <= search.MAX_SEARCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {search.MAX_SEARCH_LIMIT}")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must not be negative")
+    return search.search_expenses(db, q, group_id=group_id, user_id=user_id, limit=limit, offset=offset)
+
+# Bulk import endpoint
+@app.post("/import")
+def import_ledger(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Query(None, alias="format"),
+    chunk_size: int = importer.IMPORT_CHUNK_SIZE,
+    x_admin_token: Optional[str] = Header(None)
+):
+    # Creates users and writes to any group, so it is an admin operation
+    require_admin(x_admin_token)
+    fmt = file_format or importer.detect_format(file.filename)
+    if fmt not in importer.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown import format: {fmt}")
+    if chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be positive")
+    
+    def reports():
+        # Runs while the response streams, so it owns its session
+        db = SessionLocal()
+        ledger_importer = importer.LedgerImporter(db, chunk_size=chunk_size)
+        try:
+            for report in ledger_importer.run(importer.read_records(file.file, fmt)):
+                yield json.dumps(report) + "\n"
+        finally:
+            db.close()
+            # Open group pages reload everything the import touched
+            for group_id in ledger_importer.touched_group_ids:
+                events.publish_after_commit(group_id, events.RESYNC)
+    
+    # One JSON object per line: errors and progress per chunk, then a summary
+    return StreamingResponse(reports(), media_type="application/x-ndjson")
 
 # Settlement endpoints
 @app.post("/settlements/", response_model=schemas.Settlement)
 def create_settlement(
     settlement: schemas.SettlementCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
-    return crud.create_settlement(db=db, settlement=settlement)
+    idempotent = begin_idempotent(idempotency_key, request, settlement)
+    replayed = replay_idempotent(db, idempotent)
+    if replayed is not None:
+        return replayed
+    
+    if crud.get_group(db, group_id=settlement.group_id) is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    try:
+        db_settlement = crud.create_settlement(db=db, settlement=settlement, idempotent=idempotent)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IntegrityError as e:
+        return replay_after_conflict(db, idempotent, e)
+    events.publish_after_commit(
+        db_settlement.group_id,
+        events.SETTLEMENT_CREATED,
+        settlement_id=db_settlement.id,
+        from_user_id=db_settlement.from_user_id,
+        to_user_id=db_settlement.to_user_id,
+        amount=db_settlement.amount
+    )
+    
+    # Fold the group's history into a checkpoint once everyone is settled up
+    tasks.defer(archive.archive_if_settled_job, db_settlement.group_id, key=("archive", db_settlement.group_id))
+    return db_settlement
 
 @app.get("/groups/{group_id}/settlements", response_model=List[schemas.Settlement])
-def get_group_settlements(group_id: int, db: Session = Depends(get_db)):
-    return crud.get_group_settlements(db, group_id=group_id)
+def get_group_settlements(group_id: int, include_archived: bool = False, db: Session = Depends(get_read_db)):
+    return crud.get_group_settlements(db, group_id=group_id, include_archived=include_archived)
+
+# Exchange rate endpoints
+@app.post("/fx-rates", response_model=List[schemas.FxRate])
+def set_fx_rates(rates: List[schemas.FxRateCreate], db: Session = Depends(get_db)):
+    return fx.set_rates(db, rates)
+
+@app.get("/fx-rates", response_model=List[schemas.FxRate])
+def get_fx_rates(currency: Optional[str] = None, base_currency: Optional[str] = None, db: Session = Depends(get_read_db)):
+    try:
+        currency = schemas.normalize_currency(currency) if currency is not None else None
+        base_currency = schemas.normalize_currency(base_currency) if base_currency is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return fx.get_rates(db, currency=currency, base_currency=base_currency)
 
 # Group management endpoints
 @app.put("/groups/{group_id}", response_model=schemas.GroupDetail)
@@ -137,15 +536,20 @@ def update_group(group_id: int, group_update: schemas.GroupUpdate, db: Session =
         raise HTTPException(status_code=404, detail="Group not found")
     
     updated_group = crud.update_group(db=db, group_id=group_id, group_update=group_update)
+    chatbot.name_index.invalidate()
+    events.publish_after_commit(
+        group_id,
+        events.MEMBERS_CHANGED if group_update.user_ids is not None else events.GROUP_UPDATED
+    )
     
     # Calculate total expenses
-    expenses = crud.get_group_expenses(db, group_id=group_id)
-    total_expenses = crud.round_currency(sum(expense.amount for expense in expenses))
+    total_expenses = crud.get_group_total_expenses(db, group_id=group_id)
     
     group_detail = schemas.GroupDetail(
         id=updated_group.id,
         name=updated_group.name,
         description=updated_group.description,
+        base_currency=updated_group.base_currency,
         created_at=updated_group.created_at,
         members=updated_group.members,
         total_expenses=total_expenses
@@ -167,6 +571,8 @@ def delete_group(group_id: int, db: Session = Depends(get_db)):
         )
     
     crud.delete_group(db=db, group_id=group_id)
+    chatbot.name_index.invalidate()
+    events.publish_after_commit(group_id, events.GROUP_DELETED)
     return {"message": "Group deleted successfully"}
 
 @app.post("/groups/{group_id}/members", response_model=schemas.GroupDetail)
@@ -176,15 +582,16 @@ def add_member_to_group(group_id: int, request: schemas.AddMembersRequest, db: S
         raise HTTPException(status_code=404, detail="Group not found")
     
     updated_group = crud.add_members_to_group(db=db, group_id=group_id, user_ids=request.user_ids)
+    events.publish_after_commit(group_id, events.MEMBERS_CHANGED)
     
     # Calculate total expenses
-    expenses = crud.get_group_expenses(db, group_id=group_id)
-    total_expenses = crud.round_currency(sum(expense.amount for expense in expenses))
+    total_expenses = crud.get_group_total_expenses(db, group_id=group_id)
     
     group_detail = schemas.GroupDetail(
         id=updated_group.id,
         name=updated_group.name,
         description=updated_group.description,
+        base_currency=updated_group.base_currency,
         created_at=updated_group.created_at,
         members=updated_group.members,
         total_expenses=total_expenses
@@ -207,7 +614,8 @@ def remove_member_from_group(group_id: int, user_id: int, db: Session = Depends(
             detail="Cannot remove user with outstanding balances. Please settle all debts first."
         )
     
-    crud.remove_member_from_group(db=db, group_id=group_id, user_id=user_id)
+    if crud.remove_member_from_group(db=db, group_id=group_id, user_id=user_id):
+        events.publish_after_commit(group_id, events.MEMBERS_CHANGED, user_id=user_id)
     return {"message": "User removed from group successfully"}
 
 # User management endpoints
@@ -217,7 +625,9 @@ def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Dep
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return crud.update_user(db=db, user_id=user_id, user_update=user_update)
+    updated_user = crud.update_user(db=db, user_id=user_id, user_update=user_update)
+    chatbot.name_index.invalidate()
+    return updated_user
 
 @app.delete("/users/{user_id}")
 def delete_user(user_id: int, db: Session = Depends(get_db)):
@@ -235,8 +645,34 @@ def delete_user(user_id: int, db: Session = Depends(get_db)):
         )
     
     crud.delete_user(db=db, user_id=user_id)
+    chatbot.name_index.invalidate()
     return {"message": "User deleted successfully"}
 
+# Natural-language query endpoint
+@app.post("/query", response_model=schemas.QueryResponse)
+def query(request: schemas.QueryRequest, db: Session = Depends(get_read_db)):
+    return chatbot.answer(db, request.question, user_id=request.user_id)
+
+# Admin endpoints
+@app.get("/admin/slow-queries", response_model=schemas.SlowQueryLog)
+def get_slow_queries(limit: int = 100, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    log = slow_queries.slow_query_log
+    return schemas.SlowQueryLog(
+        threshold_ms=slow_queries.SLOW_QUERY_THRESHOLD_MS,
+        capacity=log.size,
+        recorded=log.recorded,
+        entries=log.entries(limit)
+    )
+
+@app.delete("/admin/slow-queries")
+def clear_slow_queries(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    slow_queries.slow_query_log.clear()
+    return {"message": "Slow query log cleared"}
+
 # Database reset endpoint (for development/testing only)
 @app.get("/")
 def read_root():
@@ -0,0 +1,150 @@
+"""
+Schema upgrades for databases created by an earlier version of the API.
+
+``create_all`` creates missing tables but never changes existing ones, so
+columns added to tables that already shipped are listed here and added with
+``ALTER TABLE ... ADD COLUMN``. The type, foreign key and default of each
+column come from its model; a NOT NULL column gets its default as a column
+DEFAULT, which fills in the existing rows, and columns listed in
+``BACKFILLS`` are filled in by an UPDATE in the same transaction as the
+ALTER. Indexes and unique constraints of those columns are created as
+indexes of the same name.
+
+Every step checks the live schema first, so the upgrade is idempotent and
+``main.py`` runs it on every start, right after ``create_all``. On PostgreSQL
+an advisory lock keeps server processes starting together from upgrading at
+the same time. ``python migrations.py`` runs it without starting the server.
+"""
+
+import logging
+from typing import List
+
+from sqlalchemy import inspect, literal, text
+from sqlalchemy.engine import Connection, Engine
+
+import models  # noqa: F401 - registers every table on Base.metadata
+from database import Base, engine
+
+logger = logging.getLogger(__name__)
+
+# Any constant shared by all processes upgrading the same database
+ADVISORY_LOCK_ID = 8102604
+
+# Columns added to existing tables, as (table, column)
+ADDED_COLUMNS = [
+    # Equal splits stored as membership snapshots
+    ("expenses", "membership_snapshot_id"),
+    ("expenses", "remainder_rule"),
+    # Multiple currencies
+    ("groups", "base_currency"),
+] + [
+    (table_name, column_name)
+    for table_name in ("expenses", "settlements", "expenses_archive", "settlements_archive")
+    for column_name in ("currency", "original_amount", "fx_rate")
+] + [
+    # Recurring expenses
+    (table_name, column_name)
+    for table_name in ("expenses", "expenses_archive")
+    for column_name in ("recurring_expense_id", "occurrence_at")
+]
+
+def _in_base_currency(table_name: str) -> str:
+    # Rows written before currencies existed were entered in the group's currency
+    return (
+        f"UPDATE {table_name} SET "
+        f"currency = (SELECT groups.base_currency FROM groups WHERE groups.id = {table_name}.group_id), "
+        "original_amount = amount, fx_rate = 1.0 WHERE currency IS NULL"
+    )
+
+# UPDATE run once a column is added, as (table, column) -> statement
+BACKFILLS = {
+    (table_name, "currency"): _in_base_currency(table_name)
+    for table_name in ("expenses", "settlements", "expenses_archive", "settlements_archive")
+}
+
+# Indexes and unique constraints of the added columns, as (table, name)
+ADDED_INDEXES = [
+    ("expenses", "ix_expenses_membership_snapshot_id"),
+    ("expenses", "uq_expenses_recurring_occurrence"),
+]
+
+def _column_ddl(connection: Connection, column) -> str:
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    ddl = f"{preparer.format_column(column)} {column.type.compile(dialect=dialect)}"
+    for foreign_key in column.foreign_keys:
+        target = foreign_key.column
+        ddl += f" REFERENCES {preparer.format_table(target.table)} ({preparer.format_column(target)})"
+    if not column.nullable:
+        default = literal(column.default.arg, column.type).compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True}
+        )
+        ddl += f" DEFAULT {default} NOT NULL"
+    return ddl
+
+def _index_definition(table, name: str):
+    """Columns and uniqueness of a model index or unique constraint"""
+    for item in list(table.indexes) + list(table.constraints):
+        if item.name == name:
+            return [column.name for column in item.columns], getattr(item, "unique", True)
+    raise KeyError(f"{table.name} has no index or constraint named {name}")
+
+def _add_column(connection: Connection, inspector, table_name: str, column_name: str) -> bool:
+    existing = {column["name"] for column in inspector.get_columns(table_name)}
+    if column_name in existing:
+        return False
+    table = Base.metadata.tables[table_name]
+    connection.execute(text(
+        f"ALTER TABLE {connection.dialect.identifier_preparer.format_table(table)} "
+        f"ADD COLUMN {_column_ddl(connection, table.c[column_name])}"
+    ))
+    return True
+
+def _add_index(connection: Connection, inspector, table_name: str, name: str) -> bool:
+    table = Base.metadata.tables[table_name]
+    columns, unique = _index_definition(table, name)
+    existing = inspector.get_indexes(table_name) + inspector.get_unique_constraints(table_name)
+    if any(
+        item["name"] == name or (unique and item.get("unique", True) and item["column_names"] == columns)
+        for item in existing
+    ):
+        return False
+    preparer = connection.dialect.identifier_preparer
+    connection.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {preparer.quote(name)} "
+        f"ON {preparer.format_table(table)} ({', '.join(preparer.quote(column) for column in columns)})"
+    ))
+    return True
+
+def upgrade(bind: Engine = engine) -> List[str]:
+    """Add the columns and indexes existing tables are missing; returns what was added"""
+    changes = []
+    with bind.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        inspector = inspect(connection)
+        tables = set(inspector.get_table_names())
+        added = []
+        for table_name, column_name in ADDED_COLUMNS:
+            if table_name in tables and _add_column(connection, inspector, table_name, column_name):
+                added.append((table_name, column_name))
+                changes.append(f"column {table_name}.{column_name}")
+        # After every column is in place, as a backfill may read several
+        for key in added:
+            if key in BACKFILLS:
+                connection.execute(text(BACKFILLS[key]))
+        # Read the indexes again, after the columns they cover exist
+        inspector = inspect(connection)
+        for table_name, name in ADDED_INDEXES:
+            if table_name in tables and _add_index(connection, inspector, table_name, name):
+                changes.append(f"index {name}")
+    for change in changes:
+        logger.info("Schema upgrade: added %s", change)
+    return changes
+
+def main():
+    changes = upgrade()
+    print("\n".join(f"Added {change}" for change in changes) or "Schema is up to date")
+
+if __name__ == "__main__":
+    main()
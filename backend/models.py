@@ -1,7 +1,12 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Table, Text
+from sqlalchemy import (
+    Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Table, Text, Index, UniqueConstraint, DDL, event
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+import json
+import os
 from database import Base
+from money import REMAINDER_FIRST_MEMBER, equal_split_amounts
 
 # Association table for group members
 group_members = Table(
@@ -11,6 +16,18 @@ group_members = Table(
     Column('user_id', Integer, ForeignKey('users.id'))
 )
 
+# Ordered member list of a membership snapshot; position 0 is the first member
+membership_snapshot_members = Table(
+    'membership_snapshot_members',
+    Base.metadata,
+    Column('snapshot_id', Integer, ForeignKey('membership_snapshots.id'), primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('position', Integer, nullable=False)
+)
+
+# Base currency of groups created without one (ISO 4217 code)
+DEFAULT_CURRENCY = os.getenv("DEFAULT_CURRENCY", "INR")
+
 class User(Base):
     __tablename__ = "users"
     
@@ -30,30 +47,98 @@ class Group(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     description = Column(Text)
+    # Currency every amount of the group is stored and balanced in
+    base_currency = Column(String(3), nullable=False, default=DEFAULT_CURRENCY)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    members = relationship("User", secondary=group_members, back_populates="groups")
+    # Ordered by id: equal-split snapshots list members in this order
+    members = relationship("User", secondary=group_members, back_populates="groups", order_by="User.id")
     expenses = relationship("Expense", back_populates="group")
 
 class Expense(Base):
     __tablename__ = "expenses"
+    __table_args__ = (
+        # A recurring template posts each occurrence at most once
+        UniqueConstraint("recurring_expense_id", "occurrence_at", name="uq_expenses_recurring_occurrence"),
+        # Ids must never be reused once rows have moved to the archive tables
+        {"sqlite_autoincrement": True},
+    )
+    # Fetch created_at with the INSERT (RETURNING): the rollups of a new
+    # expense are filed under the month the database stamped it with
+    __mapper_args__ = {"eager_defaults": True}
     
     id = Column(Integer, primary_key=True, index=True)
     description = Column(String, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Float, nullable=False)  # in the group's base currency
+    # As entered, converted to ``amount`` at write time with ``fx_rate``
+    currency = Column(String(3))
+    original_amount = Column(Float)
+    fx_rate = Column(Float)
     group_id = Column(Integer, ForeignKey("groups.id"))
     paid_by = Column(Integer, ForeignKey("users.id"))
     split_type = Column(String, nullable=False)  # 'equal' or 'percentage'
+    # Equal splits store their participants as a snapshot instead of split rows
+    membership_snapshot_id = Column(Integer, ForeignKey("membership_snapshots.id"), index=True)
+    remainder_rule = Column(String)
+    # Set on expenses posted by a recurring template; no foreign key so that
+    # deleting the template keeps its history
+    recurring_expense_id = Column(Integer)
+    occurrence_at = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
     group = relationship("Group", back_populates="expenses")
     paid_by_user = relationship("User", back_populates="paid_expenses")
-    splits = relationship("ExpenseSplit", back_populates="expense")
+    split_rows = relationship("ExpenseSplit", back_populates="expense")
+    membership_snapshot = relationship("MembershipSnapshot")
+    
+    @property
+    def splits(self):
+        """Split rows, or the shares derived from the membership snapshot for equal splits"""
+        if self.membership_snapshot_id is None:
+            return self.split_rows
+        members = self.membership_snapshot.members
+        amounts = equal_split_amounts(self.amount, len(members), self.remainder_rule)
+        return [ImplicitSplit(self.id, member, amount) for member, amount in zip(members, amounts)]
+
+# Full-text indexes of expense descriptions for /expenses/search (PostgreSQL
+# only, other backends fall back to LIKE), on the hot and archived expenses,
+# and pg_trgm trigram indexes for the typo-tolerant fallback. Existing
+# databases create them with ``python search.py``.
+EXPENSE_SEARCH_CONFIG = "english"
+EXPENSE_SEARCH_INDEX_DDL = (
+    "CREATE INDEX {concurrently}IF NOT EXISTS ix_{table}_description_fts ON {table} "
+    f"USING gin (to_tsvector('{EXPENSE_SEARCH_CONFIG}', description))"
+)
+EXPENSE_TRIGRAM_INDEX_DDL = (
+    "CREATE INDEX {concurrently}IF NOT EXISTS ix_{table}_description_trgm ON {table} "
+    "USING gin (description gin_trgm_ops)"
+)
+TRIGRAM_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+event.listen(Base.metadata, "before_create", DDL(TRIGRAM_EXTENSION_DDL).execute_if(dialect="postgresql"))
+for ddl in (EXPENSE_SEARCH_INDEX_DDL, EXPENSE_TRIGRAM_INDEX_DDL):
+    event.listen(
+        Expense.__table__,
+        "after_create",
+        DDL(ddl.format(concurrently="", table="expenses")).execute_if(dialect="postgresql")
+    )
+
+class ImplicitSplit:
+    """Read-only share of an equal-split expense, computed rather than stored"""
+    id = None
+    percentage = None
+    
+    def __init__(self, expense_id: int, user: "User", amount: float):
+        self.expense_id = expense_id
+        self.user = user
+        self.user_id = user.id
+        self.amount = amount
 
 class ExpenseSplit(Base):
     __tablename__ = "expense_splits"
+    # Ids must never be reused once rows have moved to the archive tables
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     expense_id = Column(Integer, ForeignKey("expenses.id"))
@@ -62,16 +147,66 @@ class ExpenseSplit(Base):
     percentage = Column(Float)  # Only used for percentage splits
     
     # Relationships
-    expense = relationship("Expense", back_populates="splits")
+    expense = relationship("Expense", back_populates="split_rows")
     user = relationship("User", back_populates="expense_splits")
 
+# Materialized per-group aggregates, maintained with atomic increments on every write
+class GroupBalance(Base):
+    __tablename__ = "group_balances"
+    
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    net = Column(Float, nullable=False, default=0)
+
+class GroupTotal(Base):
+    __tablename__ = "group_totals"
+    
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    total_expenses = Column(Float, nullable=False, default=0)
+    expense_count = Column(Integer, nullable=False, default=0)
+    settlement_count = Column(Integer, nullable=False, default=0)
+
+class SpendingRollup(Base):
+    """Paid and owed totals of a user in a group for one month ("YYYY-MM")"""
+    __tablename__ = "spending_rollups"
+    __table_args__ = (Index("ix_spending_rollups_user_period", "user_id", "period"),)
+    
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    period = Column(String(7), primary_key=True)
+    paid = Column(Float, nullable=False, default=0)
+    owed = Column(Float, nullable=False, default=0)
+    expenses_paid = Column(Integer, nullable=False, default=0)
+    expenses_shared = Column(Integer, nullable=False, default=0)
+
+class MembershipSnapshot(Base):
+    __tablename__ = "membership_snapshots"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Relationships
+    group = relationship("Group")
+    members = relationship(
+        "User",
+        secondary=membership_snapshot_members,
+        order_by=membership_snapshot_members.c.position,
+        viewonly=True
+    )
+
 class Settlement(Base):
     __tablename__ = "settlements"
+    # Ids must never be reused once rows have moved to the archive tables
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     from_user_id = Column(Integer, ForeignKey("users.id"))
     to_user_id = Column(Integer, ForeignKey("users.id"))
-    amount = Column(Float, nullable=False)
+    amount = Column(Float, nullable=False)  # in the group's base currency
+    currency = Column(String(3))
+    original_amount = Column(Float)
+    fx_rate = Column(Float)
     group_id = Column(Integer, ForeignKey("groups.id"))
     description = Column(String, default="Settlement")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -80,3 +215,163 @@ class Settlement(Base):
     from_user = relationship("User", foreign_keys=[from_user_id])
     to_user = relationship("User", foreign_keys=[to_user_id])
     group = relationship("Group")
+
+# Archived history. Rows keep their original ids and are moved here from the
+# hot tables once a group's history is folded into a checkpoint. On PostgreSQL
+# the archive tables are list-partitioned by month (archive_period, "YYYY-MM").
+class ExpenseArchive(Base):
+    __tablename__ = "expenses_archive"
+    __table_args__ = (
+        Index("ix_expenses_archive_group_period", "group_id", "archive_period"),
+        {"postgresql_partition_by": "LIST (archive_period)"},
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    archive_period = Column(String(7), primary_key=True)
+    description = Column(String, nullable=False)
+    amount = Column(Float, nullable=False)
+    currency = Column(String(3))
+    original_amount = Column(Float)
+    fx_rate = Column(Float)
+    group_id = Column(Integer, nullable=False)
+    paid_by = Column(Integer)
+    split_type = Column(String, nullable=False)
+    membership_snapshot_id = Column(Integer)
+    remainder_rule = Column(String)
+    recurring_expense_id = Column(Integer)
+    occurrence_at = Column(DateTime(timezone=True))
+    created_at = Column(DateTime(timezone=True))
+    
+    # Relationships
+    paid_by_user = relationship("User", primaryjoin="foreign(ExpenseArchive.paid_by) == User.id", viewonly=True)
+    split_rows = relationship(
+        "ExpenseSplitArchive",
+        primaryjoin="foreign(ExpenseSplitArchive.expense_id) == ExpenseArchive.id",
+        viewonly=True
+    )
+    membership_snapshot = relationship(
+        "MembershipSnapshot",
+        primaryjoin="foreign(ExpenseArchive.membership_snapshot_id) == MembershipSnapshot.id",
+        viewonly=True
+    )
+    
+    splits = Expense.splits
+
+for ddl in (EXPENSE_SEARCH_INDEX_DDL, EXPENSE_TRIGRAM_INDEX_DDL):
+    event.listen(
+        ExpenseArchive.__table__,
+        "after_create",
+        DDL(ddl.format(concurrently="", table="expenses_archive")).execute_if(dialect="postgresql")
+    )
+
+class ExpenseSplitArchive(Base):
+    __tablename__ = "expense_splits_archive"
+    __table_args__ = {"postgresql_partition_by": "LIST (archive_period)"}
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    archive_period = Column(String(7), primary_key=True)
+    expense_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer)
+    amount = Column(Float, nullable=False)
+    percentage = Column(Float)
+    
+    # Relationships
+    user = relationship("User", primaryjoin="foreign(ExpenseSplitArchive.user_id) == User.id", viewonly=True)
+
+class SettlementArchive(Base):
+    __tablename__ = "settlements_archive"
+    __table_args__ = (
+        Index("ix_settlements_archive_group_period", "group_id", "archive_period"),
+        {"postgresql_partition_by": "LIST (archive_period)"},
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    archive_period = Column(String(7), primary_key=True)
+    from_user_id = Column(Integer)
+    to_user_id = Column(Integer)
+    amount = Column(Float, nullable=False)
+    currency = Column(String(3))
+    original_amount = Column(Float)
+    fx_rate = Column(Float)
+    group_id = Column(Integer, nullable=False)
+    description = Column(String)
+    created_at = Column(DateTime(timezone=True))
+
+class GroupCheckpoint(Base):
+    """Summary of a group's history that was moved to the archive tables"""
+    __tablename__ = "group_checkpoints"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), index=True)
+    archived_through = Column(DateTime(timezone=True))
+    expense_count = Column(Integer, nullable=False, default=0)
+    settlement_count = Column(Integer, nullable=False, default=0)
+    total_expenses = Column(Float, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Relationships
+    balances = relationship("CheckpointBalance", back_populates="checkpoint")
+
+class CheckpointBalance(Base):
+    """Net balance a user carried out of the archived history of a group"""
+    __tablename__ = "checkpoint_balances"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    checkpoint_id = Column(Integer, ForeignKey("group_checkpoints.id"))
+    group_id = Column(Integer, ForeignKey("groups.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    amount = Column(Float, nullable=False)
+    
+    # Relationships
+    checkpoint = relationship("GroupCheckpoint", back_populates="balances")
+
+class IdempotencyKey(Base):
+    """Stored response of a write made with an ``Idempotency-Key`` header"""
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String(255), primary_key=True)
+    scope = Column(String, primary_key=True)  # method and path, e.g. "POST /settlements/"
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=False, default=200)
+    response_body = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class FxRate(Base):
+    """Units of base_currency per unit of currency, from effective_date until the next rate"""
+    __tablename__ = "fx_rates"
+    
+    currency = Column(String(3), primary_key=True)
+    base_currency = Column(String(3), primary_key=True)
+    effective_date = Column(Date, primary_key=True)
+    rate = Column(Float, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class RecurringExpense(Base):
+    """Template that posts an expense to its group on every occurrence of a cron schedule"""
+    __tablename__ = "recurring_expenses"
+    # The scheduler's due query: active templates by next run
+    __table_args__ = (Index("ix_recurring_expenses_due", "active", "next_run_at"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), index=True)
+    description = Column(String, nullable=False)
+    amount = Column(Float, nullable=False)  # in currency, converted on every occurrence
+    currency = Column(String(3))
+    paid_by = Column(Integer, ForeignKey("users.id"))
+    split_type = Column(String, nullable=False)  # 'equal' or 'percentage'
+    splits_json = Column(Text)  # [{"user_id": ..., "percentage": ...}] for percentage splits
+    schedule = Column(String, nullable=False)  # cron expression, UTC
+    next_run_at = Column(DateTime(timezone=True), nullable=False)
+    last_run_at = Column(DateTime(timezone=True))
+    active = Column(Boolean, nullable=False, default=True)
+    last_error = Column(Text)  # why the scheduler deactivated the template
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Relationships
+    group = relationship("Group")
+    paid_by_user = relationship("User")
+    
+    @property
+    def splits(self):
+        return json.loads(self.splits_json) if self.splits_json else []
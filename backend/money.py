@@ -0,0 +1,32 @@
+"""
+Rounding and equal-split arithmetic shared by the models and the schemas.
+
+Kept free of SQLAlchemy and Pydantic imports so that both layers, and the
+modules built on them, can use the same rounding without importing each
+other.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from typing import List
+
+REMAINDER_FIRST_MEMBER = "first_member"  # rounding remainder goes to the first participant
+
+def round_currency(value: float) -> float:
+    """Round a monetary value to exactly 2 decimal places"""
+    if value is None:
+        return None
+    decimal_value = Decimal(str(value))
+    rounded_decimal = decimal_value.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    return float(rounded_decimal)
+
+def equal_split_amounts(amount: float, count: int, remainder_rule: str = REMAINDER_FIRST_MEMBER) -> List[float]:
+    """Split an amount into equal shares, giving the rounding remainder to the first share"""
+    if count <= 0:
+        return []
+    if remainder_rule != REMAINDER_FIRST_MEMBER:
+        raise ValueError(f"Unknown remainder rule: {remainder_rule}")
+    base_amount = round_currency(amount / count)
+    remainder = round_currency(amount - base_amount * count)
+    amounts = [base_amount] * count
+    amounts[0] = round_currency(base_amount + remainder)
+    return amounts
@@ -0,0 +1,251 @@
+"""
+Pairwise netting of debts between two users across all the groups they share.
+
+Group balances give each member one net position. Between two particular
+users, what one owes the other in a group follows from the rows involving
+both: the other's shares of expenses one of them paid, less the settlements
+between them. Summed over all of a user's counterparties this is exactly the
+user's net balance in the group, so settling every pair clears the user's
+balance in every group.
+
+The amounts come from two aggregate queries over the hot and archived tables
+at once, grouped by group and counterparty: one for explicit split rows and
+settlements, one for equal splits stored as membership snapshots. Equal
+shares are split per distinct (amount, participant count) with the same
+rounding as balances, so repeated expenses are only split once. Groups are
+netted together per base currency.
+
+``settle_all`` records the offsetting settlements - one per group and
+counterparty - in a single transaction, after locking the groups' ledgers so
+the amounts can't change between reading and settling.
+"""
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, or_, select, union_all
+from sqlalchemy.orm import Session
+
+from models import (
+    User, Group, Expense, ExpenseSplit, Settlement, ExpenseArchive, ExpenseSplitArchive, SettlementArchive,
+    membership_snapshot_members
+)
+from idempotency import IdempotentRequest
+import crud
+import ledger
+import money
+import schemas
+
+SETTLE_ALL_DESCRIPTION = "Settle all"
+
+HISTORY = (
+    (Expense, ExpenseSplit, Settlement),
+    (ExpenseArchive, ExpenseSplitArchive, SettlementArchive),
+)
+
+def _scope(group_column, counterparty, group_ids, counterparty_id):
+    conditions = []
+    if group_ids is not None:
+        conditions.append(group_column.in_(list(group_ids)))
+    if counterparty_id is not None:
+        conditions.append(counterparty == counterparty_id)
+    return conditions
+
+def _row_amounts(user_id: int, group_ids, counterparty_id):
+    """Per-row amounts from split rows and settlements, positive when the counterparty owes user_id"""
+    selects = []
+    for expense_model, split_model, settlement_model in HISTORY:
+        user_paid = expense_model.paid_by == user_id
+        counterparty = case((user_paid, split_model.user_id), else_=expense_model.paid_by)
+        selects.append(
+            select(
+                expense_model.group_id.label("group_id"),
+                counterparty.label("counterparty_id"),
+                case((user_paid, split_model.amount), else_=-split_model.amount).label("amount")
+            )
+            .join(split_model, split_model.expense_id == expense_model.id)
+            .where(
+                or_(
+                    and_(user_paid, split_model.user_id != user_id),
+                    and_(split_model.user_id == user_id, expense_model.paid_by != user_id)
+                ),
+                *_scope(expense_model.group_id, counterparty, group_ids, counterparty_id)
+            )
+        )
+
+        user_sent = settlement_model.from_user_id == user_id
+        counterparty = case((user_sent, settlement_model.to_user_id), else_=settlement_model.from_user_id)
+        selects.append(
+            select(
+                settlement_model.group_id.label("group_id"),
+                counterparty.label("counterparty_id"),
+                case((user_sent, settlement_model.amount), else_=-settlement_model.amount).label("amount")
+            )
+            .where(
+                or_(user_sent, settlement_model.to_user_id == user_id),
+                settlement_model.from_user_id != settlement_model.to_user_id,
+                *_scope(settlement_model.group_id, counterparty, group_ids, counterparty_id)
+            )
+        )
+    return union_all(*selects).subquery()
+
+def pairwise_amounts(
+    db: Session, user_id: int, group_ids: Optional[Iterable[int]] = None, counterparty_id: Optional[int] = None
+) -> Dict[Tuple[int, int], float]:
+    """What each counterparty owes user_id (negative: is owed by them), keyed by (group_id, counterparty_id)"""
+    if group_ids is not None:
+        group_ids = list(group_ids)
+    amounts = defaultdict(float)
+
+    rows = _row_amounts(user_id, group_ids, counterparty_id)
+    for group_id, counterparty, amount in db.execute(
+        select(rows.c.group_id, rows.c.counterparty_id, func.sum(rows.c.amount))
+        .group_by(rows.c.group_id, rows.c.counterparty_id)
+    ):
+        amounts[(group_id, counterparty)] += amount or 0
+
+    # Equal splits: every participant's share of an expense the user paid,
+    # and the user's share of expenses the others paid
+    participant_counts = select(
+        membership_snapshot_members.c.snapshot_id.label("snapshot_id"),
+        func.count().label("participants"),
+        func.min(membership_snapshot_members.c.position).label("first_position")
+    ).group_by(membership_snapshot_members.c.snapshot_id).subquery()
+    selects = []
+    for expense_model, _, _ in HISTORY:
+        user_paid = expense_model.paid_by == user_id
+        member_id = membership_snapshot_members.c.user_id
+        counterparty = case((user_paid, member_id), else_=expense_model.paid_by)
+        selects.append(
+            select(
+                expense_model.group_id.label("group_id"),
+                counterparty.label("counterparty_id"),
+                user_paid.label("user_paid"),
+                expense_model.amount.label("amount"),
+                expense_model.remainder_rule.label("remainder_rule"),
+                participant_counts.c.participants.label("participants"),
+                (membership_snapshot_members.c.position == participant_counts.c.first_position).label("is_first")
+            )
+            .join(membership_snapshot_members, membership_snapshot_members.c.snapshot_id == expense_model.membership_snapshot_id)
+            .join(participant_counts, participant_counts.c.snapshot_id == expense_model.membership_snapshot_id)
+            .where(
+                or_(and_(user_paid, member_id != user_id), and_(member_id == user_id, expense_model.paid_by != user_id)),
+                *_scope(expense_model.group_id, counterparty, group_ids, counterparty_id)
+            )
+        )
+    shares = union_all(*selects).subquery()
+    share_columns = [
+        shares.c.group_id, shares.c.counterparty_id, shares.c.user_paid, shares.c.amount,
+        shares.c.remainder_rule, shares.c.participants, shares.c.is_first
+    ]
+    splits = {}  # an expense the user paid yields one row per participant
+    for group_id, counterparty, user_paid, amount, remainder_rule, participants, is_first, count in db.execute(
+        select(*share_columns, func.count()).group_by(*share_columns)
+    ):
+        split = splits.get((amount, participants, remainder_rule))
+        if split is None:
+            split = splits[(amount, participants, remainder_rule)] = money.equal_split_amounts(
+                amount, participants, remainder_rule
+            )
+        share = split[0] if is_first else split[-1]
+        amounts[(group_id, counterparty)] += share * count if user_paid else -share * count
+
+    return {
+        key: crud.round_currency(amount)
+        for key, amount in amounts.items()
+        if key[1] is not None and crud.round_currency(amount) != 0
+    }
+
+def net_balances(db: Session, user_id: int, amounts: Dict[Tuple[int, int], float]) -> List[schemas.PairwiseBalance]:
+    """Net pairwise amounts per counterparty and currency, with the per-group breakdown"""
+    if not amounts:
+        return []
+    groups = {group.id: group for group in db.query(Group).filter(Group.id.in_({key[0] for key in amounts}))}
+    names = dict(db.query(User.id, User.name).filter(User.id.in_({key[1] for key in amounts})))
+
+    by_counterparty = defaultdict(list)
+    for (group_id, counterparty), amount in sorted(amounts.items()):
+        group = groups.get(group_id)
+        if group is None or counterparty not in names:
+            continue
+        by_counterparty[(counterparty, group.base_currency)].append(
+            schemas.PairwiseGroupAmount(group_id=group_id, group_name=group.name, amount=amount)
+        )
+
+    balances = [
+        schemas.PairwiseBalance(
+            user_id=counterparty,
+            user_name=names[counterparty],
+            currency=currency,
+            amount=sum(group.amount for group in group_amounts),
+            groups=group_amounts
+        )
+        for (counterparty, currency), group_amounts in by_counterparty.items()
+    ]
+    # Largest amounts first, whichever way they go
+    balances.sort(key=lambda balance: (-abs(balance.amount), balance.user_id, balance.currency))
+    return balances
+
+def get_net_balances(db: Session, user_id: int) -> List[schemas.PairwiseBalance]:
+    """What each counterparty owes a user, netted across all groups they share"""
+    return net_balances(db, user_id, pairwise_amounts(db, user_id))
+
+def settle_all(
+    db: Session,
+    user_id: int,
+    counterparty_id: Optional[int] = None,
+    idempotent: Optional[IdempotentRequest] = None
+) -> schemas.SettleAllResult:
+    """Record the settlements that clear a user's debts with everyone (or one counterparty) in every group"""
+
+    def transaction():
+        if idempotent is not None:
+            idempotent.claim(db)
+        # Find the groups involved, lock their ledgers, then read the amounts
+        # again: no write to those groups can land in between
+        group_ids = {group_id for group_id, _ in pairwise_amounts(db, user_id, counterparty_id=counterparty_id)}
+        ledger.lock_groups(db, group_ids)
+        amounts = pairwise_amounts(db, user_id, group_ids, counterparty_id) if group_ids else {}
+        balances = net_balances(db, user_id, amounts)
+
+        settlements = []
+        for balance in balances:
+            for group_amount in balance.groups:
+                # A positive amount is owed to the user, so the counterparty pays
+                payer, payee = (balance.user_id, user_id) if group_amount.amount > 0 else (user_id, balance.user_id)
+                amount = abs(group_amount.amount)
+                settlements.append(Settlement(
+                    group_id=group_amount.group_id,
+                    from_user_id=payer,
+                    to_user_id=payee,
+                    amount=amount,
+                    currency=balance.currency,
+                    original_amount=amount,
+                    fx_rate=1.0,
+                    description=SETTLE_ALL_DESCRIPTION
+                ))
+        db.add_all(settlements)
+        db.flush()
+
+        # One ledger update per group, in ascending group order
+        by_group = defaultdict(list)
+        for settlement in settlements:
+            by_group[settlement.group_id].append(settlement)
+        for group_id in sorted(by_group):
+            deltas = defaultdict(float)
+            for settlement in by_group[group_id]:
+                for delta_user, delta in ledger.settlement_deltas(settlement).items():
+                    deltas[delta_user] += delta
+            ledger.apply_deltas(db, group_id, deltas, settlement_count=len(by_group[group_id]))
+
+        result = schemas.SettleAllResult(
+            user_id=user_id,
+            balances=balances,
+            settlements=[schemas.Settlement.model_validate(settlement) for settlement in settlements]
+        )
+        if idempotent is not None:
+            idempotent.store(db, result)
+        db.commit()
+        return result
+
+    return ledger.run_with_retry(db, transaction)
@@ -0,0 +1,434 @@
+"""
+Recurring expenses: templates that are posted on a cron schedule.
+
+A template holds an expense (amount, currency, payer, split definition) and
+a five-field cron schedule in UTC - ``minute hour day-of-month month
+day-of-week`` with ``*``, lists, ranges and ``/step``, or one of
+``@hourly``, ``@daily``, ``@weekly``, ``@monthly`` and ``@yearly``. Each
+template stores its ``next_run_at``, indexed together with ``active``, so
+the due templates are found with one index range scan however many
+templates exist.
+
+The scheduler thread wakes up when the next template is due (at the latest
+every ``RECURRING_POLL_INTERVAL`` seconds) and posts everything that is due,
+``RECURRING_BATCH_SIZE`` templates per transaction. A batch's expenses and
+splits are bulk inserted, each group's ledger and rollups are updated once,
+and the templates' ``next_run_at`` moves forward in the same transaction.
+After downtime every missed occurrence is posted with its own date. Expenses
+record their template and occurrence, and a unique constraint on the pair
+means no occurrence is ever posted twice, even with several server
+processes; on PostgreSQL they also skip templates another process has
+locked.
+
+Run ``python recurring.py`` to post due expenses once, e.g. from cron when
+the in-process scheduler is disabled.
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session, selectinload
+
+from models import Group, Expense, ExpenseSplit, RecurringExpense, REMAINDER_FIRST_MEMBER
+from database import SessionLocal
+import analytics
+import crud
+import events
+import fx
+import ledger
+import money
+import schemas
+import tasks
+
+logger = logging.getLogger(__name__)
+
+RECURRING_SCHEDULER_ENABLED = os.getenv("RECURRING_SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes")
+RECURRING_POLL_INTERVAL = float(os.getenv("RECURRING_POLL_INTERVAL", "60"))
+RECURRING_BATCH_SIZE = int(os.getenv("RECURRING_BATCH_SIZE", "500"))
+MAX_OCCURRENCES_PER_BATCH = 1000  # per template; further missed occurrences follow in the next batch
+
+SCHEDULE_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+# minute, hour, day of month, month, day of week (0 or 7 is Sunday)
+FIELD_BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+SEARCH_DAYS = 366 * 9  # long enough to reach the next 29 February
+
+def as_utc(value: datetime) -> datetime:
+    # SQLite returns naive datetimes, which are stored in UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def _parse_field(text: str, low: int, high: int) -> Set[int]:
+    values = set()
+    for part in text.split(","):
+        base, has_step, step = part.partition("/")
+        step = int(step) if has_step else 1
+        if base == "*":
+            start, end = low, high
+        elif "-" in base:
+            start, end = (int(value) for value in base.split("-", 1))
+        else:
+            start = int(base)
+            end = high if has_step else start
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(part)
+        values.update(range(start, end + 1, step))
+    return values
+
+class Schedule:
+    """A parsed cron expression"""
+
+    def __init__(self, expression: str):
+        expression = expression.strip()
+        fields = SCHEDULE_ALIASES.get(expression.lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(
+                "schedule must be a cron expression (minute hour day month weekday) or one of "
+                + ", ".join(SCHEDULE_ALIASES)
+            )
+        try:
+            minutes, hours, days, months, weekdays = (
+                _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_BOUNDS)
+            )
+        except ValueError:
+            raise ValueError(f"Invalid schedule: {expression}")
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        # As in cron, when both day fields are restricted a day matching either one runs
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    def _day_matches(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        day_matches = day.day in self.days
+        weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_weekday:
+            return day_matches
+        if self.any_day:
+            return weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, after: datetime) -> datetime:
+        """First occurrence strictly after a time"""
+        start = as_utc(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        for _ in range(SEARCH_DAYS):
+            if self._day_matches(day):
+                first_day = day == start.date()
+                for hour in self.hours:
+                    if first_day and hour < start.hour:
+                        continue
+                    for minute in self.minutes:
+                        if first_day and hour == start.hour and minute < start.minute:
+                            continue
+                        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=timezone.utc)
+            day += timedelta(days=1)
+        raise ValueError("schedule never runs")
+
+def _check_template(template, member_ids: List[int]):
+    """Raise ValueError if the template can't be posted to a group with these members"""
+    if template.paid_by not in member_ids:
+        raise ValueError("User who paid is not in the group")
+    if template.split_type == "percentage":
+        missing = [split["user_id"] for split in template.splits if split["user_id"] not in member_ids]
+        if missing:
+            raise ValueError(f"Users {', '.join(map(str, missing))} in the splits are not in the group")
+
+def create_template(db: Session, group: Group, template: schemas.RecurringExpenseCreate) -> RecurringExpense:
+    """Validate and save a recurring expense template"""
+    if template.split_type not in ("equal", "percentage"):
+        raise ValueError("split_type must be equal or percentage")
+    splits = []
+    if template.split_type == "percentage":
+        if not template.splits:
+            raise ValueError("Percentage splits need splits")
+        if not crud.validate_expense_mathematical_consistency(db, group.id, template.amount, template.splits):
+            raise ValueError("Expense splits do not add up to total amount or percentages do not equal 100%")
+        splits = [{"user_id": split.user_id, "percentage": split.percentage} for split in template.splits]
+    schedule = Schedule(template.schedule)
+    # Fail now rather than on the first run if the currency can't be converted
+    fx.to_base(db, template.amount, template.currency, group.base_currency)
+
+    db_template = RecurringExpense(
+        group_id=group.id,
+        description=template.description,
+        amount=template.amount,
+        currency=template.currency,
+        paid_by=template.paid_by,
+        split_type=template.split_type,
+        splits_json=json.dumps(splits) if splits else None,
+        schedule=template.schedule.strip(),
+        active=True
+    )
+    _check_template(db_template, [member.id for member in group.members])
+    # The first occurrence at or after start_at; an earlier start_at backfills
+    start_at = as_utc(template.start_at) if template.start_at else datetime.now(timezone.utc)
+    db_template.next_run_at = schedule.next_after(start_at - timedelta(minutes=1))
+
+    db.add(db_template)
+    db.commit()
+    db.refresh(db_template)
+    return db_template
+
+def get_group_templates(db: Session, group_id: int) -> List[RecurringExpense]:
+    return db.query(RecurringExpense).filter(RecurringExpense.group_id == group_id).order_by(RecurringExpense.id).all()
+
+def delete_template(db: Session, group_id: int, template_id: int) -> bool:
+    deleted = db.query(RecurringExpense).filter(
+        RecurringExpense.id == template_id, RecurringExpense.group_id == group_id
+    ).delete(synchronize_session=False)
+    db.commit()
+    return bool(deleted)
+
+def next_due_at(db: Session) -> Optional[datetime]:
+    """When the next active template is due"""
+    value = db.query(func.min(RecurringExpense.next_run_at)).filter(RecurringExpense.active.is_(True)).scalar()
+    return as_utc(value) if value is not None else None
+
+def _post_batch(db: Session, now: datetime, batch_size: int) -> Dict:
+    """Post the due occurrences of up to batch_size templates in one transaction"""
+    templates = db.query(RecurringExpense).filter(
+        RecurringExpense.active.is_(True), RecurringExpense.next_run_at <= now
+    ).order_by(RecurringExpense.next_run_at, RecurringExpense.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    result = {"templates": len(templates), "expenses": 0, "deactivated": 0, "group_ids": set()}
+    if not templates:
+        db.commit()
+        return result
+
+    groups = {
+        group.id: group
+        for group in db.query(Group).options(selectinload(Group.members)).filter(
+            Group.id.in_({template.group_id for template in templates})
+        )
+    }
+    # Backstop against double-posting: occurrences that already have an expense
+    posted = {
+        (template_id, as_utc(occurrence_at))
+        for template_id, occurrence_at in db.query(Expense.recurring_expense_id, Expense.occurrence_at).filter(
+            Expense.recurring_expense_id.in_([template.id for template in templates]),
+            Expense.occurrence_at >= min(template.next_run_at for template in templates)
+        )
+    }
+
+    ledger_deltas = defaultdict(lambda: defaultdict(float))
+    ledger_counts = defaultdict(lambda: [0.0, 0])  # expense total, expenses
+    rollups = defaultdict(lambda: defaultdict(lambda: [0.0, 0.0, 0, 0]))
+    snapshots = {}
+    expense_rows = []
+    expense_shares = []
+
+    for template in templates:
+        group = groups.get(template.group_id)
+        rows = []
+        try:
+            if group is None:
+                raise ValueError("Group not found")
+            member_ids = [member.id for member in group.members]
+            _check_template(template, member_ids)
+            schedule = Schedule(template.schedule)
+            occurrence = as_utc(template.next_run_at)
+            while occurrence <= now and len(rows) < MAX_OCCURRENCES_PER_BATCH:
+                if (template.id, occurrence) not in posted:
+                    conversion = fx.to_base(db, template.amount, template.currency, group.base_currency, occurrence)
+                    rows.append((occurrence, conversion))
+                occurrence = schedule.next_after(occurrence)
+        except ValueError as e:
+            # Stop posting a template that no longer fits its group
+            logger.warning("Deactivating recurring expense %s: %s", template.id, e)
+            template.active = False
+            template.last_error = str(e)
+            result["deactivated"] += 1
+            continue
+        template.next_run_at = occurrence
+        template.last_run_at = now
+
+        for occurrence, conversion in rows:
+            expense_row = {
+                "description": template.description,
+                "amount": conversion.amount,
+                "currency": conversion.currency,
+                "original_amount": conversion.original_amount,
+                "fx_rate": conversion.fx_rate,
+                "group_id": group.id,
+                "paid_by": template.paid_by,
+                "split_type": template.split_type,
+                "membership_snapshot_id": None,
+                "remainder_rule": None,
+                "recurring_expense_id": template.id,
+                "occurrence_at": occurrence,
+                "created_at": occurrence,
+            }
+            if template.split_type == "equal":
+                if group.id not in snapshots:
+                    snapshots[group.id] = crud.get_or_create_membership_snapshot(db, group).id
+                expense_row["membership_snapshot_id"] = snapshots[group.id]
+                expense_row["remainder_rule"] = REMAINDER_FIRST_MEMBER
+                amounts = money.equal_split_amounts(conversion.amount, len(member_ids), REMAINDER_FIRST_MEMBER)
+                shares = [(user_id, amount, None) for user_id, amount in zip(member_ids, amounts)]
+            else:
+                shares = [
+                    (split["user_id"], crud.round_currency((split["percentage"] / 100) * conversion.amount), split["percentage"])
+                    for split in template.splits
+                ]
+            expense_rows.append(expense_row)
+            expense_shares.append(shares)
+
+            period = analytics.rollup_period(occurrence)
+            ledger_deltas[group.id][template.paid_by] += conversion.amount
+            ledger_counts[group.id][0] += conversion.amount
+            ledger_counts[group.id][1] += 1
+            rollups[group.id][(template.paid_by, period)][0] += conversion.amount
+            rollups[group.id][(template.paid_by, period)][2] += 1
+            for user_id, amount, _ in shares:
+                ledger_deltas[group.id][user_id] -= amount
+                rollups[group.id][(user_id, period)][1] += amount
+                rollups[group.id][(user_id, period)][3] += 1
+
+    if expense_rows:
+        db.execute(insert(Expense), expense_rows)
+        # Split rows need the new ids; (template, occurrence) identifies each
+        # expense, which avoids an ordered RETURNING over a large batch
+        percentage_rows = [
+            (expense_row, shares) for expense_row, shares in zip(expense_rows, expense_shares)
+            if expense_row["split_type"] == "percentage"
+        ]
+        if percentage_rows:
+            expense_ids = {
+                (template_id, as_utc(occurrence_at)): expense_id
+                for expense_id, template_id, occurrence_at in db.query(
+                    Expense.id, Expense.recurring_expense_id, Expense.occurrence_at
+                ).filter(
+                    Expense.recurring_expense_id.in_({row["recurring_expense_id"] for row, _ in percentage_rows}),
+                    Expense.occurrence_at >= min(row["occurrence_at"] for row, _ in percentage_rows)
+                )
+            }
+            db.execute(insert(ExpenseSplit), [
+                {
+                    "expense_id": expense_ids[(expense_row["recurring_expense_id"], expense_row["occurrence_at"])],
+                    "user_id": user_id, "amount": amount, "percentage": percentage
+                }
+                for expense_row, shares in percentage_rows
+                for user_id, amount, percentage in shares
+            ])
+        result["expenses"] = len(expense_rows)
+
+    # One ledger and rollup update per group, in ascending group order
+    for group_id in sorted(ledger_counts):
+        expense_total, expense_count = ledger_counts[group_id]
+        ledger.apply_deltas(db, group_id, ledger_deltas[group_id], expense_amount=expense_total, expense_count=expense_count)
+        analytics.apply_rollups(db, group_id, rollups[group_id])
+
+    db.commit()
+    result["group_ids"] = set(ledger_counts)
+    return result
+
+def post_due_expenses(db: Session, now: Optional[datetime] = None, batch_size: int = RECURRING_BATCH_SIZE) -> Dict:
+    """Post every occurrence due by now, one batch of templates per transaction"""
+    now = as_utc(now) if now else datetime.now(timezone.utc)
+    totals = {"templates": 0, "expenses": 0, "deactivated": 0}
+    group_ids = set()
+    while True:
+        result = ledger.run_with_retry(db, lambda: _post_batch(db, now, batch_size))
+        if not result["templates"]:
+            break
+        for key in totals:
+            totals[key] += result[key]
+        group_ids |= result["group_ids"]
+
+    # Open group pages reload everything that was posted
+    for group_id in sorted(group_ids):
+        events.publish_after_commit(group_id, events.RESYNC)
+    return totals
+
+class RecurringScheduler:
+    """Background thread that posts recurring expenses as they become due"""
+
+    def __init__(self, poll_interval: float = RECURRING_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, name="recurring-expenses", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Check for due templates now, e.g. after one was created"""
+        self._wake.set()
+
+    def run_once(self) -> Optional[datetime]:
+        """Post what is due; returns when the next template is due"""
+        db = SessionLocal()
+        try:
+            totals = post_due_expenses(db)
+            if totals["expenses"] or totals["deactivated"]:
+                logger.info("Posted %d recurring expenses from %d templates (%d deactivated)",
+                            totals["expenses"], totals["templates"], totals["deactivated"])
+            return next_due_at(db)
+        except Exception:
+            logger.exception("Posting recurring expenses failed")
+            db.rollback()
+            return None
+        finally:
+            db.close()
+
+    def _run(self):
+        # The first pass catches up on everything missed while the server was down
+        while True:
+            next_due = self.run_once()
+            wait = self.poll_interval
+            if next_due is not None:
+                wait = min(wait, max((next_due - datetime.now(timezone.utc)).total_seconds(), 0) + 0.05)
+            self._wake.wait(wait)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+
+scheduler = RecurringScheduler()
+
+def main():
+    parser = argparse.ArgumentParser(description="Post the recurring expenses that are due")
+    parser.add_argument("--batch-size", type=int, default=RECURRING_BATCH_SIZE, help="templates per transaction")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        totals = post_due_expenses(db, batch_size=args.batch_size)
+    finally:
+        db.close()
+    # Let the queued change notifications run before exiting
+    tasks.work_queue.drain()
+    print(f"Posted {totals['expenses']} expenses from {totals['templates']} templates, "
+          f"deactivated {totals['deactivated']}")
+
+if __name__ == "__main__":
+    main()
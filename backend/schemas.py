@@ -1,15 +1,18 @@
 from pydantic import BaseModel, validator
-from typing import List, Optional
-from datetime import datetime
-from decimal import Decimal, ROUND_HALF_UP
-
-def round_currency(value: float) -> float:
-    """Round a monetary value to exactly 2 decimal places"""
-    if value is None:
-        return None
-    decimal_value = Decimal(str(value))
-    rounded_decimal = decimal_value.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-    return float(rounded_decimal)
+from typing import Any, Dict, List, Optional
+from datetime import date, datetime
+import re
+
+from money import round_currency
+
+CURRENCY_PATTERN = re.compile(r"^[A-Z]{3}$")
+
+def normalize_currency(value: str) -> str:
+    """Upper-case ISO 4217 currency code; raises ValueError for anything else"""
+    code = (value or "").strip().upper()
+    if not CURRENCY_PATTERN.match(code):
+        raise ValueError("currency must be a 3-letter ISO 4217 code")
+    return code
 
 # User schemas
 class UserBase(BaseModel):
@@ -37,6 +40,11 @@ class GroupBase(BaseModel):
 
 class GroupCreate(GroupBase):
     user_ids: List[int]
+    base_currency: Optional[str] = None  # DEFAULT_CURRENCY when omitted
+    
+    @validator('base_currency')
+    def check_base_currency(cls, v):
+        return normalize_currency(v) if v is not None else v
 
 class GroupUpdate(BaseModel):
     name: Optional[str] = None
@@ -48,6 +56,7 @@ class AddMembersRequest(BaseModel):
 
 class Group(GroupBase):
     id: int
+    base_currency: Optional[str] = None
     created_at: datetime
     members: List[User]
     
@@ -75,7 +84,7 @@ class ExpenseSplitCreate(ExpenseSplitBase):
     pass
 
 class ExpenseSplit(ExpenseSplitBase):
-    id: int
+    id: Optional[int] = None  # None for shares derived from an equal split
     user: User
     
     class Config:
@@ -93,9 +102,18 @@ class ExpenseBase(BaseModel):
 class ExpenseCreate(ExpenseBase):
     paid_by: int
     splits: List[ExpenseSplitCreate]
+    currency: Optional[str] = None  # currency of amount; the group's base currency when omitted
+    
+    @validator('currency')
+    def check_currency(cls, v):
+        return normalize_currency(v) if v is not None else v
 
 class Expense(ExpenseBase):
     id: int
+    # amount is in the group's base currency, converted from original_amount in currency
+    currency: Optional[str] = None
+    original_amount: Optional[float] = None
+    fx_rate: Optional[float] = None
     group_id: int
     paid_by: int
     paid_by_user: User
@@ -119,6 +137,193 @@ class Balance(BaseModel):
     def round_net_balance(cls, v):
         return round_currency(v)
 
+class PairwiseGroupAmount(BaseModel):
+    group_id: int
+    group_name: str
+    amount: float  # positive when the counterparty owes the user in this group
+
+class PairwiseBalance(BaseModel):
+    user_id: int  # the counterparty
+    user_name: str
+    currency: str  # base currency of the groups netted together
+    amount: float  # across those groups; positive when the counterparty owes the user
+    groups: List[PairwiseGroupAmount]
+    
+    @validator('amount')
+    def round_amount(cls, v):
+        return round_currency(v)
+
+# Dashboard schemas
+class DashboardGroup(BaseModel):
+    id: int
+    name: str
+    description: Optional[str] = None
+    base_currency: Optional[str] = None
+    created_at: datetime
+    member_count: int
+    total_expenses: float
+    net_balance: float  # The dashboard user's net balance in this group
+    
+    @validator('total_expenses', 'net_balance')
+    def round_amounts(cls, v):
+        return round_currency(v)
+
+class DashboardExpense(BaseModel):
+    id: int
+    description: str
+    amount: float
+    split_type: str
+    group_id: int
+    group_name: str
+    paid_by: int
+    paid_by_name: str
+    created_at: datetime
+
+class UserDashboard(BaseModel):
+    user: User
+    groups: List[DashboardGroup]
+    net_balance: Dict[str, float]  # per base currency of the user's groups
+    recent_expenses: List[DashboardExpense]
+    
+    @validator('net_balance')
+    def round_net_balance(cls, v):
+        return {currency: round_currency(amount) for currency, amount in v.items()}
+
+# Recurring expense schemas
+class RecurringExpenseCreate(BaseModel):
+    description: str
+    amount: float  # in currency, or the group's base currency when omitted
+    currency: Optional[str] = None
+    paid_by: int
+    split_type: str  # 'equal' or 'percentage'
+    splits: List[ExpenseSplitCreate] = []
+    schedule: str  # cron expression in UTC, e.g. "0 9 1 * *", or @daily, @weekly, @monthly, @yearly
+    start_at: Optional[datetime] = None  # first possible occurrence; now when omitted
+    
+    @validator('amount')
+    def round_amount(cls, v):
+        return round_currency(v)
+    
+    @validator('currency')
+    def check_currency(cls, v):
+        return normalize_currency(v) if v is not None else v
+
+class RecurringExpense(BaseModel):
+    id: int
+    group_id: int
+    description: str
+    amount: float
+    currency: Optional[str] = None
+    paid_by: int
+    split_type: str
+    splits: List[ExpenseSplitCreate]
+    schedule: str
+    next_run_at: datetime
+    last_run_at: Optional[datetime] = None
+    active: bool
+    last_error: Optional[str] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# Search schemas
+class ExpenseSearchHit(DashboardExpense):
+    rank: float
+    archived: bool = False
+
+class ExpenseSearchResults(BaseModel):
+    query: str
+    limit: int
+    offset: int
+    has_more: bool
+    fuzzy: bool = False  # no exact match, so these are typo-tolerant matches
+    results: List[ExpenseSearchHit]
+
+# Analytics schemas
+class MonthlySpending(BaseModel):
+    period: str  # YYYY-MM
+    currency: str  # base currency of the groups the amounts were spent in
+    paid: float
+    owed: float
+    expense_count: int
+    
+    @validator('paid', 'owed')
+    def round_amounts(cls, v):
+        return round_currency(v)
+
+class MemberSpending(BaseModel):
+    user_id: int
+    user_name: str
+    paid: float
+    owed: float
+    expenses_paid: int
+    expenses_shared: int
+    
+    @validator('paid', 'owed')
+    def round_amounts(cls, v):
+        return round_currency(v)
+
+class GroupStats(BaseModel):
+    group_id: int
+    group_name: str
+    start: Optional[str] = None
+    end: Optional[str] = None
+    total_expenses: float
+    expense_count: int
+    members: List[MemberSpending]  # Sorted by amount paid, highest first
+    months: List[MonthlySpending]
+    
+    @validator('total_expenses')
+    def round_total_expenses(cls, v):
+        return round_currency(v)
+
+class GroupSpending(BaseModel):
+    group_id: int
+    group_name: str
+    currency: str  # the group's base currency
+    paid: float
+    owed: float
+    expenses_paid: int
+    expenses_shared: int
+    
+    @validator('paid', 'owed')
+    def round_amounts(cls, v):
+        return round_currency(v)
+
+class UserStats(BaseModel):
+    user_id: int
+    user_name: str
+    start: Optional[str] = None
+    end: Optional[str] = None
+    # Amounts in different currencies are never added up: totals are per currency
+    total_paid: Dict[str, float]
+    total_owed: Dict[str, float]
+    expenses_paid: int
+    groups: List[GroupSpending]
+    months: List[MonthlySpending]  # one entry per month and currency
+    
+    @validator('total_paid', 'total_owed')
+    def round_totals(cls, v):
+        return {currency: round_currency(amount) for currency, amount in v.items()}
+
+# Natural-language query schemas
+class QueryRequest(BaseModel):
+    question: str
+    user_id: Optional[int] = None  # Who "I", "me" and "my" refer to
+    
+    @validator('question')
+    def question_not_empty(cls, v):
+        if not v.strip():
+            raise ValueError("question must not be empty")
+        return v
+
+class QueryResponse(BaseModel):
+    question: str
+    intent: Optional[str] = None  # None when no question template matched
+    answer: str
+    data: Optional[Any] = None  # The balances, expenses or stats the answer is based on
+
 # Settlement schemas
 class SettlementCreate(BaseModel):
     from_user_id: int
@@ -126,19 +331,73 @@ class SettlementCreate(BaseModel):
     amount: float
     group_id: int
     description: Optional[str] = "Settlement"
+    currency: Optional[str] = None  # currency of amount; the group's base currency when omitted
     
     @validator('amount')
     def round_amount(cls, v):
         return round_currency(v)
+    
+    @validator('currency')
+    def check_currency(cls, v):
+        return normalize_currency(v) if v is not None else v
 
 class Settlement(BaseModel):
     id: int
     from_user_id: int
     to_user_id: int
-    amount: float
+    amount: float  # in the group's base currency
+    currency: Optional[str] = None
+    original_amount: Optional[float] = None
+    fx_rate: Optional[float] = None
     group_id: int
     description: str
     created_at: datetime
     
     class Config:
         from_attributes = True
+
+class SettleAllRequest(BaseModel):
+    counterparty_id: Optional[int] = None  # settle with this user only; everyone when omitted
+
+class SettleAllResult(BaseModel):
+    user_id: int
+    balances: List[PairwiseBalance]  # what was settled, per counterparty
+    settlements: List[Settlement]
+
+# Exchange rate schemas
+class FxRateCreate(BaseModel):
+    currency: str
+    base_currency: str
+    effective_date: date
+    rate: float  # units of base_currency per unit of currency
+    
+    @validator('currency', 'base_currency')
+    def check_currency(cls, v):
+        return normalize_currency(v)
+    
+    @validator('rate')
+    def check_rate(cls, v):
+        if v <= 0:
+            raise ValueError("rate must be positive")
+        return v
+
+class FxRate(FxRateCreate):
+    class Config:
+        from_attributes = True
+
+# Admin schemas
+class SlowQuery(BaseModel):
+    id: int
+    at: datetime
+    duration_ms: float
+    route: Optional[str] = None  # None for background work
+    statement: str
+    parameters: Any = None  # parameter names and types, never values
+    explain: Optional[str] = None
+    error: Optional[str] = None
+
+class SlowQueryLog(BaseModel):
+    threshold_ms: float
+    capacity: int
+    recorded: int  # since the server started, including entries no longer kept
+    entries: List[SlowQuery]
@@ -0,0 +1,216 @@
+"""
+Ranked full-text search over expense descriptions.
+
+On PostgreSQL the query is matched against the GIN index on
+``to_tsvector('english', description)``: words are stemmed ("hotels" finds
+"hotel"), every query word must match, the last one as a prefix so results
+update while typing, and hits are ordered by ``ts_rank_cd``. Other backends
+fall back to a case-insensitive substring scan ranked by how closely the
+description matches the query. Archived expenses are searched too: the same
+match runs on ``expenses_archive`` and the two result sets are merged with
+UNION ALL before ranking and paging.
+
+When nothing matches, the search is retried with typo tolerance and the
+results are flagged ``fuzzy``: descriptions containing words similar to the
+query ("resturant" finds "restaurant") by pg_trgm's ``word_similarity``,
+through the ``<%`` operator and a GIN trigram index. On SQLite a Python
+implementation of the same measure is registered on the connection before
+the fallback runs. A query
+with no searchable words, e.g. punctuation or only stop words, matches
+nothing and returns an empty page without searching.
+
+Run ``python search.py`` once to build the indexes on an existing database;
+new databases get them with their tables. The hot table's indexes are built
+without blocking writes. The archive's are not, as PostgreSQL can't build an
+index on a partitioned table concurrently, but only archiving jobs write
+there.
+"""
+
+import re
+from typing import List, Optional
+
+from sqlalchemy import case, false, func, literal, literal_column, or_, select, text, true, union_all
+from sqlalchemy.orm import Session
+
+from models import (
+    User, Group, Expense, ExpenseSplit, ExpenseArchive, ExpenseSplitArchive, membership_snapshot_members,
+    EXPENSE_SEARCH_CONFIG, EXPENSE_SEARCH_INDEX_DDL, EXPENSE_TRIGRAM_INDEX_DDL, TRIGRAM_EXTENSION_DDL
+)
+from database import engine
+import schemas
+
+MAX_QUERY_TERMS = 8
+MAX_SEARCH_LIMIT = 100
+# Least word similarity of a fuzzy match; pg_trgm.word_similarity_threshold's default
+FUZZY_SIMILARITY_THRESHOLD = 0.6
+
+# Searched expense tables, with their split tables and whether they are archived
+HISTORY = (
+    (Expense, ExpenseSplit, False),
+    (ExpenseArchive, ExpenseSplitArchive, True),
+)
+
+TERM_PATTERN = re.compile(r"\w+")
+
+def query_terms(q: str) -> List[str]:
+    """Lowercased words of a search query, possibly none"""
+    return TERM_PATTERN.findall(q.lower())[:MAX_QUERY_TERMS]
+
+def _trigrams(word: str) -> set:
+    # Padded like pg_trgm: two spaces before the word and one after
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def word_similarity(query: Optional[str], description: Optional[str]) -> float:
+    """Share of the query's trigrams found in its closest words of the description
+
+    Each query word is compared with every description word, in the manner
+    of pg_trgm's ``word_similarity``; used where that extension is missing.
+    """
+    query_words = TERM_PATTERN.findall((query or "").lower())
+    description_words = [_trigrams(word) for word in TERM_PATTERN.findall((description or "").lower())]
+    if not query_words or not description_words:
+        return 0.0
+    found = total = 0
+    for word in query_words:
+        grams = _trigrams(word)
+        found += max(len(grams & candidate) for candidate in description_words)
+        total += len(grams)
+    return found / total
+
+def _register_word_similarity(db: Session):
+    """Make word_similarity callable from SQL on the session's SQLite connection"""
+    connection = db.connection().connection.driver_connection
+    connection.create_function("word_similarity", 2, word_similarity, deterministic=True)
+
+def _postgres_match(model, terms: List[str]):
+    # The configuration must be a literal for the planner to match the index expression
+    config = literal_column(f"'{EXPENSE_SEARCH_CONFIG}'")
+    vector = func.to_tsvector(config, model.description)
+    # Terms only contain word characters, so they can't inject tsquery operators
+    query = func.to_tsquery(config, " & ".join(terms[:-1] + [terms[-1] + ":*"]))
+    return [vector.op("@@")(query)], func.ts_rank_cd(vector, query)
+
+def _postgres_fuzzy_match(model, terms: List[str]):
+    phrase = literal(" ".join(terms))
+    # <% compares with pg_trgm.word_similarity_threshold and can use the trigram index
+    return [phrase.op("<%")(model.description)], func.word_similarity(phrase, model.description)
+
+def _fallback_fuzzy_match(model, terms: List[str]):
+    similarity = func.word_similarity(" ".join(terms), model.description)
+    return [similarity >= FUZZY_SIMILARITY_THRESHOLD], similarity
+
+def _fallback_match(model, terms: List[str]):
+    description = func.lower(model.description)
+    phrase = " ".join(terms)
+    condition = [description.contains(term, autoescape=True) for term in terms]
+    rank = case(
+        (description == phrase, 1.0),
+        (description.startswith(phrase, autoescape=True), 0.75),
+        (description.contains(phrase, autoescape=True), 0.5),
+        else_=0.25
+    )
+    return condition, rank
+
+def _matching_expenses(match, terms: List[str], group_id: Optional[int], user_id: Optional[int]):
+    """UNION ALL of the hot and archived expenses matching the terms, with their rank"""
+    selects = []
+    for model, split_model, archived in HISTORY:
+        conditions, rank = match(model, terms)
+
+        if group_id is not None:
+            conditions.append(model.group_id == group_id)
+        if user_id is not None:
+            # Expenses the user paid for or shares in
+            conditions.append(or_(
+                model.paid_by == user_id,
+                model.id.in_(select(split_model.expense_id).where(split_model.user_id == user_id)),
+                model.membership_snapshot_id.in_(
+                    select(membership_snapshot_members.c.snapshot_id).where(membership_snapshot_members.c.user_id == user_id)
+                )
+            ))
+
+        selects.append(
+            select(
+                model.id.label("id"), model.description.label("description"), model.amount.label("amount"),
+                model.split_type.label("split_type"), model.group_id.label("group_id"),
+                Group.name.label("group_name"), model.paid_by.label("paid_by"), User.name.label("paid_by_name"),
+                model.created_at.label("created_at"), rank.label("rank"),
+                (true() if archived else false()).label("archived")
+            )
+            .join(Group, Group.id == model.group_id)
+            .join(User, User.id == model.paid_by)
+            .where(*conditions)
+        )
+    return union_all(*selects).subquery()
+
+def _page(db: Session, hits, limit: int, offset: int):
+    # One extra row tells whether there is a next page without counting every match
+    return db.execute(
+        select(hits)
+        .order_by(hits.c.rank.desc(), hits.c.created_at.desc(), hits.c.id.desc())
+        .offset(offset)
+        .limit(limit + 1)
+    ).all()
+
+def _has_searchable_words(db: Session, terms: List[str]) -> bool:
+    """Whether the terms are more than stop words to the text search configuration"""
+    config = literal_column(f"'{EXPENSE_SEARCH_CONFIG}'")
+    return db.scalar(select(func.numnode(func.plainto_tsquery(config, " ".join(terms))))) > 0
+
+def search_expenses(
+    db: Session,
+    q: str,
+    group_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0
+) -> schemas.ExpenseSearchResults:
+    """Expenses, hot and archived, whose description matches q, best match first"""
+    terms = query_terms(q)
+    if not terms:
+        return schemas.ExpenseSearchResults(query=q, limit=limit, offset=offset, has_more=False, results=[])
+    postgres = db.get_bind().dialect.name == "postgresql"
+
+    hits = _matching_expenses(_postgres_match if postgres else _fallback_match, terms, group_id, user_id)
+    rows = _page(db, hits, limit, offset)
+    fuzzy = False
+    # Only when no page of the exact search has results, so paging stays on one kind of match
+    if not rows and (offset == 0 or db.execute(select(hits.c.id).limit(1)).first() is None):
+        if postgres and not _has_searchable_words(db, terms):
+            # Stop words only: to_tsquery dropped every term
+            return schemas.ExpenseSearchResults(query=q, limit=limit, offset=offset, has_more=False, results=[])
+        fuzzy = True
+        if not postgres:
+            _register_word_similarity(db)
+        hits = _matching_expenses(_postgres_fuzzy_match if postgres else _fallback_fuzzy_match, terms, group_id, user_id)
+        rows = _page(db, hits, limit, offset)
+
+    results = [
+        schemas.ExpenseSearchHit(
+            id=expense_id, description=description, amount=amount, split_type=split_type,
+            group_id=expense_group_id, group_name=group_name, paid_by=paid_by, paid_by_name=paid_by_name,
+            created_at=created_at, rank=score, archived=archived
+        )
+        for (expense_id, description, amount, split_type, expense_group_id, group_name,
+             paid_by, paid_by_name, created_at, score, archived) in rows[:limit]
+    ]
+    return schemas.ExpenseSearchResults(
+        query=q, limit=limit, offset=offset, has_more=len(rows) > limit, fuzzy=fuzzy, results=results
+    )
+
+def main():
+    if engine.dialect.name != "postgresql":
+        print("Full-text indexes are only used on PostgreSQL; other databases search without them")
+        return
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(TRIGRAM_EXTENSION_DDL))
+        for ddl in (EXPENSE_SEARCH_INDEX_DDL, EXPENSE_TRIGRAM_INDEX_DDL):
+            connection.execute(text(ddl.format(concurrently="CONCURRENTLY ", table="expenses")))
+            # Partitioned tables can't be indexed concurrently
+            connection.execute(text(ddl.format(concurrently="", table="expenses_archive")))
+    print("Created the expense description search indexes")
+
+if __name__ == "__main__":
+    main()
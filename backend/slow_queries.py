@@ -0,0 +1,163 @@
+"""
+In-memory log of slow SQL statements.
+
+Every statement the API's engines run is timed with cursor execute events.
+Those slower than ``SLOW_QUERY_THRESHOLD_MS`` - or cancelled by the statement
+timeout - go into a ring buffer holding the last ``SLOW_QUERY_LOG_SIZE``,
+with the route that ran them and the shape of their parameters (names and
+types, never values). With ``SLOW_QUERY_EXPLAIN`` on, slow SELECTs also get
+their plan: ``EXPLAIN ANALYZE`` on PostgreSQL, which runs the query a second
+time inside a savepoint, or ``EXPLAIN QUERY PLAN`` on SQLite.
+
+``GET /admin/slow-queries`` reads the buffer. Each server process keeps its
+own log, which starts empty on restart.
+"""
+
+from collections import deque
+from datetime import datetime, timezone
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import database
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+MAX_STATEMENT_LENGTH = 4000
+MAX_SHAPE_ITEMS = 50
+
+class SlowQueryLog:
+    """Bounded, thread-safe buffer of the most recent slow statements"""
+
+    def __init__(self, size: int = SLOW_QUERY_LOG_SIZE):
+        self.size = size
+        self.recorded = 0  # since start, including entries that fell out of the buffer
+        self._entries = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def record(self, entry: Dict):
+        with self._lock:
+            entry["id"] = next(self._ids)
+            self._entries.append(entry)
+            self.recorded += 1
+
+    def entries(self, limit: Optional[int] = None) -> List[Dict]:
+        """Newest first"""
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit is not None else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+slow_query_log = SlowQueryLog()
+
+def _value_shape(value):
+    return type(value).__name__
+
+def parameter_shape(parameters, executemany: bool = False):
+    """Names and types of a statement's parameters, without their values"""
+    if executemany:
+        rows = list(parameters or [])
+        return {"rows": len(rows), "row": parameter_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        items = list(parameters.items())
+        shape = {name: _value_shape(value) for name, value in items[:MAX_SHAPE_ITEMS]}
+        if len(items) > MAX_SHAPE_ITEMS:
+            shape["..."] = f"{len(items) - MAX_SHAPE_ITEMS} more"
+        return shape
+    if isinstance(parameters, (list, tuple)):
+        shape = [_value_shape(value) for value in parameters[:MAX_SHAPE_ITEMS]]
+        if len(parameters) > MAX_SHAPE_ITEMS:
+            shape.append(f"... {len(parameters) - MAX_SHAPE_ITEMS} more")
+        return shape
+    return None
+
+def _is_select(statement: str) -> bool:
+    words = statement.lstrip().split(None, 1)
+    return bool(words) and words[0].upper() == "SELECT"
+
+def explain(dialect_name: str, dbapi_connection, statement: str, parameters) -> Optional[str]:
+    """Plan of a SELECT, run on the connection (and in the transaction) that ran it"""
+    cursor = dbapi_connection.cursor()
+    try:
+        if dialect_name == "postgresql":
+            # EXPLAIN ANALYZE executes the query; a savepoint keeps a failure
+            # from aborting the request's transaction
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        if dialect_name == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return "\n".join(row[-1] for row in cursor.fetchall())
+        return None
+    finally:
+        cursor.close()
+
+def _record(conn, statement: str, parameters, executemany: bool, elapsed_ms: float, error: Optional[str] = None):
+    plan = None
+    if SLOW_QUERY_EXPLAIN and error is None and not executemany and _is_select(statement):
+        try:
+            plan = explain(conn.dialect.name, conn.connection.dbapi_connection, statement, parameters)
+        except Exception as e:
+            plan = f"EXPLAIN failed: {e}"
+    slow_query_log.record({
+        "at": datetime.now(timezone.utc),
+        "duration_ms": round(elapsed_ms, 1),
+        "route": database.current_route(),
+        "statement": statement[:MAX_STATEMENT_LENGTH],
+        "parameters": parameter_shape(parameters, executemany),
+        "explain": plan,
+        "error": error,
+    })
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["slow_query_started"].pop()) * 1000
+    if elapsed_ms >= SLOW_QUERY_THRESHOLD_MS:
+        _record(conn, statement, parameters, executemany, elapsed_ms)
+
+def _handle_error(exception_context):
+    # Statements that failed, such as ones cancelled by the statement timeout
+    conn = exception_context.connection
+    started = conn.info.get("slow_query_started") if conn is not None else None
+    if not started or exception_context.statement is None:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+    if elapsed_ms >= SLOW_QUERY_THRESHOLD_MS:
+        context = exception_context.execution_context
+        _record(
+            conn, exception_context.statement, exception_context.parameters,
+            bool(context is not None and context.executemany), elapsed_ms,
+            error=str(exception_context.original_exception).strip()
+        )
+
+def install(engine: Engine):
+    """Time every statement an engine runs"""
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+install(database.engine)
+install(database.replica_engine)
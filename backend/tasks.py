@@ -0,0 +1,108 @@
+"""
+In-process queue for work that can run after a write has committed.
+
+Write endpoints should return as soon as the primary rows are durable.
+Derived-data maintenance (change notifications, archival checks, rollups,
+search indexes) is handed to a bounded worker pool instead:
+
+* jobs with a coalescing key, e.g. ``("archive", group_id)``, are queued at
+  most once; a job that has not started yet already covers later writes
+  because it reads the committed state when it runs,
+* when ``WORK_QUEUE_SIZE`` jobs are pending the submitting request waits up
+  to ``WORK_QUEUE_FULL_TIMEOUT`` seconds and then runs the job itself, so
+  the queue applies backpressure instead of growing without bound,
+* ``drain`` stops accepting jobs and waits for the pending ones on shutdown.
+
+Jobs open their own database sessions; they must not use the request's.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+from typing import Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_WORKERS = int(os.getenv("WORK_QUEUE_WORKERS", "4"))
+WORK_QUEUE_SIZE = int(os.getenv("WORK_QUEUE_SIZE", "1000"))
+WORK_QUEUE_FULL_TIMEOUT = float(os.getenv("WORK_QUEUE_FULL_TIMEOUT", "0.5"))
+
+class WorkQueue:
+    """Bounded thread pool with per-key coalescing of pending jobs"""
+
+    def __init__(self, workers: int = WORK_QUEUE_WORKERS, max_pending: int = WORK_QUEUE_SIZE,
+                 full_timeout: float = WORK_QUEUE_FULL_TIMEOUT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="work-queue")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._full_timeout = full_timeout
+        self._lock = threading.Lock()
+        self._pending_keys = set()
+        self._accepting = True
+        self.stats = {"submitted": 0, "coalesced": 0, "ran_inline": 0, "failed": 0}
+
+    def submit(self, fn: Callable, *args, key: Optional[Hashable] = None) -> bool:
+        """Queue a job to run after the current request; returns False if it was coalesced"""
+        with self._lock:
+            if key is not None and key in self._pending_keys:
+                self.stats["coalesced"] += 1
+                return False
+            if not self._accepting:
+                run_inline = True
+            else:
+                run_inline = False
+                if key is not None:
+                    self._pending_keys.add(key)
+            self.stats["submitted"] += 1
+
+        if run_inline:
+            # Shutting down: do the work now rather than drop it
+            self._run(fn, args, None, release=False)
+            return True
+
+        if not self._slots.acquire(timeout=self._full_timeout):
+            # Queue full: the caller pays for the job itself
+            with self._lock:
+                self.stats["ran_inline"] += 1
+            self._run(fn, args, key, release=False)
+            return True
+
+        try:
+            self._executor.submit(self._run, fn, args, key, True)
+        except RuntimeError:
+            # The executor shut down between the checks above and now
+            self._slots.release()
+            self._run(fn, args, key, release=False)
+        return True
+
+    def _run(self, fn: Callable, args, key: Optional[Hashable], release: bool):
+        # Leave the pending set before running so writes committed while the
+        # job runs schedule a fresh run instead of being coalesced into this one
+        if key is not None:
+            with self._lock:
+                self._pending_keys.discard(key)
+        try:
+            fn(*args)
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += 1
+            logger.exception("Deferred job %s failed", getattr(fn, "__name__", fn))
+        finally:
+            if release:
+                self._slots.release()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending_keys)
+
+    def drain(self, wait: bool = True):
+        """Stop accepting jobs and finish the queued ones"""
+        with self._lock:
+            self._accepting = False
+        self._executor.shutdown(wait=wait)
+
+work_queue = WorkQueue()
+
+def defer(fn: Callable, *args, key: Optional[Hashable] = None) -> bool:
+    """Run ``fn(*args)`` on the post-commit work queue"""
+    return work_queue.submit(fn, *args, key=key)
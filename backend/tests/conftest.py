@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The backend modules read DATABASE_URL when they are imported
+DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix="splitwise-tests-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DATABASE_PATH}"
+os.environ.setdefault("RECURRING_SCHEDULER_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crud  # noqa: E402
+import fx  # noqa: E402
+import models  # noqa: E402
+import schemas  # noqa: E402
+from database import SessionLocal, engine  # noqa: E402
+
+@pytest.fixture
+def db():
+    """Session on an empty database"""
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    fx.rate_cache.invalidate()
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@pytest.fixture
+def group(db):
+    """A group of three users: Alice, Bob and Carol"""
+    users = [
+        crud.create_user(db, schemas.UserCreate(name=name, email=f"{name.lower()}@example.com"))
+        for name in ("Alice", "Bob", "Carol")
+    ]
+    return crud.create_group(db, schemas.GroupCreate(name="Flat", user_ids=[user.id for user in users]))
@@ -0,0 +1,47 @@
+from datetime import date
+
+import pytest
+
+import analytics
+import crud
+import fx
+import schemas
+
+@pytest.fixture
+def two_currency_groups(db, group):
+    """The Flat group in INR and a second group, in EUR, of Alice and Bob"""
+    alice, bob, _ = group.members
+    trip = crud.create_group(db, schemas.GroupCreate(name="Trip", user_ids=[alice.id, bob.id], base_currency="EUR"))
+    for group_id, amount in ((group.id, 300), (trip.id, 40)):
+        crud.create_expense(db, group_id, schemas.ExpenseCreate(
+            description="Dinner", amount=amount, paid_by=alice.id, split_type="equal", splits=[]
+        ))
+    return group, trip
+
+def test_user_stats_total_per_currency(db, two_currency_groups):
+    flat, trip = two_currency_groups
+    alice = flat.members[0]
+
+    stats = analytics.get_user_stats(db, alice)
+
+    assert stats.total_paid == {"INR": 300, "EUR": 40}
+    assert stats.total_owed == {"INR": 100, "EUR": 20}
+    assert {(entry.group_id, entry.currency) for entry in stats.groups} == {(flat.id, "INR"), (trip.id, "EUR")}
+    assert sorted((month.currency, month.paid) for month in stats.months) == [("EUR", 40), ("INR", 300)]
+
+def test_converted_expenses_count_in_the_group_currency(db, two_currency_groups):
+    _, trip = two_currency_groups
+    alice = trip.members[0]
+    fx.set_rates(db, [schemas.FxRateCreate(currency="USD", base_currency="EUR", effective_date=date(2000, 1, 1), rate=0.5)])
+    crud.create_expense(db, trip.id, schemas.ExpenseCreate(
+        description="Museum", amount=20, currency="USD", paid_by=alice.id, split_type="equal", splits=[]
+    ))
+
+    assert analytics.get_user_stats(db, alice).total_paid == {"INR": 300, "EUR": 50}
+
+def test_dashboard_net_balance_per_currency(db, two_currency_groups):
+    flat, _ = two_currency_groups
+    alice, bob, _ = flat.members
+
+    assert crud.get_user_dashboard(db, alice.id).net_balance == {"INR": 200, "EUR": 20}
+    assert crud.get_user_dashboard(db, bob.id).net_balance == {"INR": -100, "EUR": -20}
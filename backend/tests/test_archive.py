@@ -0,0 +1,47 @@
+from models import Expense, GroupBalance, GroupCheckpoint, GroupTotal
+import archive
+import crud
+import schemas
+
+def add_expense(db, group, amount, paid_by):
+    return crud.create_expense(db, group.id, schemas.ExpenseCreate(
+        description="Groceries", amount=amount, paid_by=paid_by, split_type="equal", splits=[]
+    ))
+
+def drop_ledger(db, group):
+    """Make the group look like one created before the ledger existed"""
+    db.query(GroupBalance).filter(GroupBalance.group_id == group.id).delete()
+    db.query(GroupTotal).filter(GroupTotal.group_id == group.id).delete()
+    db.commit()
+
+def test_settled_group_is_archived(db, group):
+    alice, bob, carol = group.members
+    add_expense(db, group, 30, alice.id)
+    for member in (bob, carol):
+        crud.create_settlement(db, schemas.SettlementCreate(
+            from_user_id=member.id, to_user_id=alice.id, amount=10, group_id=group.id
+        ))
+
+    checkpoint = archive.archive_if_settled(db, group.id, min_expenses=1)
+
+    assert (checkpoint.expense_count, checkpoint.settlement_count) == (1, 2)
+    assert db.query(Expense).filter(Expense.group_id == group.id).count() == 0
+
+def test_unsettled_group_is_not_archived(db, group):
+    add_expense(db, group, 30, group.members[0].id)
+
+    assert archive.archive_if_settled(db, group.id, min_expenses=1) is None
+    assert db.query(Expense).filter(Expense.group_id == group.id).count() == 1
+
+def test_group_without_ledger_gets_one_before_it_is_locked(db, group):
+    alice, bob, _ = group.members
+    add_expense(db, group, 30, alice.id)
+    drop_ledger(db, group)
+
+    assert archive.archive_if_settled(db, group.id, min_expenses=1) is None
+
+    total = db.get(GroupTotal, group.id)
+    assert (total.expense_count, total.total_expenses) == (1, 30)
+    balances = {balance.user_id: balance.net for balance in db.query(GroupBalance).filter(GroupBalance.group_id == group.id)}
+    assert balances[alice.id] == 20 and balances[bob.id] == -10
+    assert db.query(GroupCheckpoint).count() == 0
@@ -0,0 +1,55 @@
+import pytest
+
+import archive
+import balance_kernel
+import crud
+import schemas
+
+pytestmark = pytest.mark.skipif(not balance_kernel.is_available(), reason="NumPy is not installed")
+
+def add_expense(db, group, amount, paid_by, split_type="equal", splits=()):
+    return crud.create_expense(db, group.id, schemas.ExpenseCreate(
+        description="Expense", amount=amount, paid_by=paid_by, split_type=split_type, splits=list(splits)
+    ))
+
+def balances(db, group, monkeypatch, threshold):
+    monkeypatch.setattr(balance_kernel, "VECTORIZED_BALANCE_THRESHOLD", threshold)
+    assert balance_kernel.should_vectorize(db, group.id) == (threshold == 1)
+    return [balance.model_dump() for balance in crud.calculate_group_balances(db, group.id)]
+
+def test_kernel_matches_scalar_engine(db, group, monkeypatch):
+    alice, bob, carol = group.members
+    dave = crud.create_user(db, schemas.UserCreate(name="Dave", email="dave@example.com"))
+
+    # Sub-cent remainders in equal splits, over the three-member snapshot
+    add_expense(db, group, 100, alice.id)
+    add_expense(db, group, 0.05, bob.id)
+    add_expense(db, group, 33.33, carol.id, "percentage", [
+        schemas.ExpenseSplitCreate(user_id=alice.id, percentage=33.33),
+        schemas.ExpenseSplitCreate(user_id=bob.id, percentage=33.33),
+        schemas.ExpenseSplitCreate(user_id=carol.id, percentage=33.34),
+    ])
+    crud.create_settlement(db, schemas.SettlementCreate(
+        from_user_id=bob.id, to_user_id=alice.id, amount=12.34, group_id=group.id
+    ))
+    # Earlier history moves to the archive and is carried by a checkpoint
+    assert archive.archive_group_history(db, group.id) is not None
+    db.expire_all()
+
+    # A second snapshot, then a member who leaves with a balance
+    crud.add_members_to_group(db, group.id, [dave.id])
+    add_expense(db, group, 10.01, dave.id)
+    add_expense(db, group, 7, carol.id)
+    crud.remove_member_from_group(db, group.id, bob.id)
+    add_expense(db, group, 0.1, alice.id)
+    crud.create_settlement(db, schemas.SettlementCreate(
+        from_user_id=carol.id, to_user_id=dave.id, amount=1.99, group_id=group.id
+    ))
+    db.expire_all()
+
+    scalar = balances(db, group, monkeypatch, 10 ** 9)
+    vectorized = balances(db, group, monkeypatch, 1)
+
+    assert vectorized == scalar
+    assert [balance["user_id"] for balance in scalar] == [alice.id, carol.id, dave.id]
+    assert any(balance["net_balance"] for balance in scalar)
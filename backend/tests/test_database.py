@@ -0,0 +1,18 @@
+import pytest
+
+import database
+
+@pytest.mark.parametrize("value, expected", [
+    ("0/0", 0),
+    ("0/16B3748", 0x16B3748),
+    ("16/b374d848", (0x16 << 32) | 0xB374D848),
+])
+def test_parse_position(value, expected):
+    assert database.parse_position(value) == expected
+
+@pytest.mark.parametrize("value", [None, "", "16", "16/", "/1", "0/123456789", "x/1", "0/1; DROP TABLE users"])
+def test_parse_position_rejects_malformed_values(value):
+    assert database.parse_position(value) is None
+
+def test_positions_order_by_high_then_low_part():
+    assert database.parse_position("1/0") > database.parse_position("0/FFFFFFFF")
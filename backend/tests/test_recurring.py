@@ -0,0 +1,156 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+from models import Expense, GroupTotal, RecurringExpense
+import crud
+import fx
+import recurring
+import schemas
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+# Cron parser
+
+@pytest.mark.parametrize("expression, after, expected", [
+    ("@daily", utc(2024, 1, 1, 10, 30), utc(2024, 1, 2, 0, 0)),
+    ("@monthly", utc(2024, 1, 15), utc(2024, 2, 1)),
+    ("@yearly", utc(2024, 6, 1), utc(2025, 1, 1)),
+    # Strictly after: a time that matches is not its own next occurrence
+    ("0 * * * *", utc(2024, 1, 1, 10, 0), utc(2024, 1, 1, 11, 0)),
+    # Ranges, steps and lists
+    ("*/15 9-17 * * 1-5", utc(2024, 1, 5, 17, 50), utc(2024, 1, 8, 9, 0)),
+    ("0 8,20 * * *", utc(2024, 1, 1, 9, 0), utc(2024, 1, 1, 20, 0)),
+    ("30 6 1-31/10 * *", utc(2024, 1, 2), utc(2024, 1, 11, 6, 30)),
+    # 7 is Sunday, like 0
+    ("0 8 * * 7", utc(2024, 1, 1), utc(2024, 1, 7, 8, 0)),
+    # Both day fields restricted: either one matches
+    ("0 0 13 * 5", utc(2024, 1, 6), utc(2024, 1, 12, 0, 0)),
+    ("0 0 13 * 5", utc(2024, 1, 12, 0, 0), utc(2024, 1, 13, 0, 0)),
+    # The next 29 February is four years away
+    ("0 12 29 2 *", utc(2024, 3, 1), utc(2028, 2, 29, 12, 0)),
+])
+def test_schedule_next_after(expression, after, expected):
+    assert recurring.Schedule(expression).next_after(after) == expected
+
+def test_schedule_treats_naive_times_as_utc():
+    assert recurring.Schedule("@hourly").next_after(datetime(2024, 1, 1, 10, 15)) == utc(2024, 1, 1, 11, 0)
+
+@pytest.mark.parametrize("expression", [
+    "", "* * * *", "* * * * * *", "@fortnightly", "60 * * * *", "* 24 * * *", "* * 0 * *",
+    "* * * 13 *", "* * * * 8", "*/0 * * * *", "5-1 * * * *", "a * * * *",
+])
+def test_schedule_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        recurring.Schedule(expression)
+
+def test_schedule_that_never_runs():
+    with pytest.raises(ValueError, match="never runs"):
+        recurring.Schedule("0 0 30 2 *").next_after(utc(2024, 1, 1))
+
+# Posting
+
+def create_template(db, group, **fields) -> RecurringExpense:
+    values = dict(
+        description="Rent", amount=90, paid_by=group.members[0].id, split_type="equal",
+        schedule="0 9 * * *", start_at=utc(2024, 1, 1)
+    )
+    values.update(fields)
+    return recurring.create_template(db, group, schemas.RecurringExpenseCreate(**values))
+
+def posted(db, template):
+    return db.query(Expense).filter(Expense.recurring_expense_id == template.id).order_by(Expense.occurrence_at).all()
+
+def test_catch_up_posts_every_missed_occurrence_with_its_date(db, group):
+    template = create_template(db, group)
+
+    totals = recurring.post_due_expenses(db, now=utc(2024, 1, 4, 12, 0))
+
+    assert totals == {"templates": 1, "expenses": 4, "deactivated": 0}
+    expenses = posted(db, template)
+    assert [recurring.as_utc(expense.occurrence_at) for expense in expenses] == [
+        utc(2024, 1, day, 9, 0) for day in (1, 2, 3, 4)
+    ]
+    assert [recurring.as_utc(expense.created_at) for expense in expenses] == [
+        recurring.as_utc(expense.occurrence_at) for expense in expenses
+    ]
+    db.refresh(template)
+    assert recurring.as_utc(template.next_run_at) == utc(2024, 1, 5, 9, 0)
+
+    total = db.get(GroupTotal, group.id)
+    assert (total.expense_count, total.total_expenses) == (4, 360)
+    balances = {balance.user_id: balance.net_balance for balance in crud.calculate_group_balances(db, group.id)}
+    assert balances == {group.members[0].id: 240, group.members[1].id: -120, group.members[2].id: -120}
+
+def test_catch_up_never_posts_an_occurrence_twice(db, group):
+    template = create_template(db, group)
+    recurring.post_due_expenses(db, now=utc(2024, 1, 4, 12, 0))
+
+    # Running again posts nothing new
+    assert recurring.post_due_expenses(db, now=utc(2024, 1, 4, 12, 0))["expenses"] == 0
+    # Neither does a template whose next run was moved back over posted occurrences
+    template.next_run_at = utc(2024, 1, 1, 9, 0)
+    db.commit()
+    assert recurring.post_due_expenses(db, now=utc(2024, 1, 5, 12, 0))["expenses"] == 1
+
+    assert len(posted(db, template)) == 5
+    assert db.get(GroupTotal, group.id).expense_count == 5
+
+def test_catch_up_spans_several_batches(db, group):
+    templates = [create_template(db, group, description=f"Bill {number}") for number in range(3)]
+
+    totals = recurring.post_due_expenses(db, now=utc(2024, 1, 2, 12, 0), batch_size=1)
+
+    assert totals == {"templates": 3, "expenses": 6, "deactivated": 0}
+    assert [len(posted(db, template)) for template in templates] == [2, 2, 2]
+
+def test_percentage_template_posts_split_rows(db, group):
+    members = group.members
+    template = create_template(db, group, split_type="percentage", splits=[
+        {"user_id": members[0].id, "percentage": 50},
+        {"user_id": members[1].id, "percentage": 50},
+    ])
+
+    recurring.post_due_expenses(db, now=utc(2024, 1, 2, 12, 0))
+
+    for expense in posted(db, template):
+        assert sorted((split.user_id, split.amount) for split in expense.split_rows) == [
+            (members[0].id, 45), (members[1].id, 45)
+        ]
+
+def test_occurrences_are_converted_at_their_date(db, group):
+    fx.set_rates(db, [schemas.FxRateCreate(currency="USD", base_currency="INR", effective_date=date(2024, 1, 1), rate=83)])
+    template = create_template(db, group, amount=10, currency="USD")
+
+    recurring.post_due_expenses(db, now=utc(2024, 1, 1, 12, 0))
+
+    [expense] = posted(db, template)
+    assert (expense.amount, expense.currency, expense.original_amount, expense.fx_rate) == (830, "USD", 10, 83)
+
+def test_missing_exchange_rate_deactivates_the_template(db, group):
+    # The rate exists today, but not yet on the first occurrences
+    fx.set_rates(db, [schemas.FxRateCreate(currency="USD", base_currency="INR", effective_date=date(2024, 1, 3), rate=83)])
+    template = create_template(db, group, amount=10, currency="USD")
+
+    totals = recurring.post_due_expenses(db, now=utc(2024, 1, 4, 12, 0))
+
+    assert totals == {"templates": 1, "expenses": 0, "deactivated": 1}
+    db.refresh(template)
+    assert not template.active
+    assert "No exchange rate from USD to INR on 2024-01-01" in template.last_error
+    assert posted(db, template) == []
+    # A deactivated template is no longer due
+    assert recurring.post_due_expenses(db, now=utc(2024, 1, 10))["templates"] == 0
+    assert recurring.next_due_at(db) is None
+
+def test_template_whose_payer_left_is_deactivated(db, group):
+    template = create_template(db, group)
+    group.members.remove(group.members[0])
+    db.commit()
+
+    totals = recurring.post_due_expenses(db, now=utc(2024, 1, 2, 12, 0))
+
+    assert totals["deactivated"] == 1
+    db.refresh(template)
+    assert (template.active, template.last_error) == (False, "User who paid is not in the group")
@@ -0,0 +1,54 @@
+import pytest
+
+import crud
+import schemas
+import search
+
+@pytest.fixture
+def expenses(db, group):
+    payer = group.members[0].id
+    for description in ("Dinner at the restaurant", "Hotel booking", "Restaurant tip", "Taxi to the airport"):
+        crud.create_expense(db, group.id, schemas.ExpenseCreate(
+            description=description, amount=30, paid_by=payer, split_type="equal", splits=[]
+        ))
+
+def descriptions(results):
+    return [hit.description for hit in results.results]
+
+def test_exact_matches_are_not_fuzzy(db, expenses):
+    results = search.search_expenses(db, "restaurant")
+
+    assert not results.fuzzy
+    assert sorted(descriptions(results)) == ["Dinner at the restaurant", "Restaurant tip"]
+
+def test_misspelled_query_falls_back_to_similar_words(db, expenses):
+    results = search.search_expenses(db, "resturant")
+
+    assert results.fuzzy
+    assert sorted(descriptions(results)) == ["Dinner at the restaurant", "Restaurant tip"]
+    assert all(search.FUZZY_SIMILARITY_THRESHOLD <= hit.rank <= 1 for hit in results.results)
+
+def test_fuzzy_results_page_like_exact_ones(db, expenses):
+    first = search.search_expenses(db, "resturant", limit=1)
+    second = search.search_expenses(db, "resturant", limit=1, offset=1)
+
+    assert (first.fuzzy, first.has_more, second.fuzzy, second.has_more) == (True, True, True, False)
+    assert sorted(descriptions(first) + descriptions(second)) == ["Dinner at the restaurant", "Restaurant tip"]
+
+def test_unrelated_query_finds_nothing(db, expenses):
+    assert search.search_expenses(db, "groceries").results == []
+
+@pytest.mark.parametrize("q", ["", "   ", "?!", "--"])
+def test_query_without_words_returns_an_empty_page(db, expenses, q):
+    results = search.search_expenses(db, q)
+
+    assert (results.results, results.has_more, results.fuzzy) == ([], False, False)
+
+@pytest.mark.parametrize("query, description, expected", [
+    ("restaurant", "Dinner at the Restaurant", 1.0),
+    ("resturant", "restaurant", 0.8),
+    ("taxi", "Hotel booking", 0.0),
+    ("taxi", None, 0.0),
+])
+def test_word_similarity(query, description, expected):
+    assert search.word_similarity(query, description) == pytest.approx(expected)
@@ -25,6 +25,44 @@ const GroupDetail = () => {
     fetchGroupData();
   }, [groupId]);
 
+  useEffect(() => {
+    // Re-fetch only the resources affected by each change pushed by the server
+    let connected = false;
+    const unsubscribe = groupAPI.subscribeToGroupEvents(groupId, (event) => {
+      switch (event.type) {
+        case 'ready':
+          // Reconnects may have missed changes that could not be replayed
+          if (connected) {
+            fetchGroupData();
+          }
+          connected = true;
+          break;
+        case 'expense_created':
+          fetchGroupData();
+          break;
+        case 'settlement_created':
+          fetchBalances();
+          break;
+        case 'members_changed':
+          fetchGroup();
+          fetchBalances();
+          break;
+        case 'group_updated':
+          fetchGroup();
+          break;
+        case 'group_deleted':
+          setGroup(null);
+          break;
+        case 'resync':
+          fetchGroupData();
+          break;
+        default:
+          break;
+      }
+    });
+    return unsubscribe;
+  }, [groupId]);
+
   useEffect(() => {
     // Auto-open expense modal if URL contains /expenses
     if (location.pathname.includes('/expenses')) {
@@ -49,6 +87,24 @@ const GroupDetail = () => {
     }
   };
 
+  const fetchGroup = async () => {
+    try {
+      const response = await groupAPI.getGroup(groupId);
+      setGroup(response.data);
+    } catch (error) {
+      console.error('Error fetching group:', error);
+    }
+  };
+
+  const fetchBalances = async () => {
+    try {
+      const response = await groupAPI.getGroupBalances(groupId);
+      setBalances(response.data);
+    } catch (error) {
+      console.error('Error fetching balances:', error);
+    }
+  };
+
   const handleCreateExpense = async (e) => {
     e.preventDefault();
     try {
@@ -74,6 +130,8 @@ const GroupDetail = () => {
         split_type: 'equal',
         splits: []
       });
+      // Other viewers are updated by the expense_created event, which isn't
+      // delivered across server processes, so refresh this view directly
       fetchGroupData();
     } catch (error) {
       console.error('Error creating expense:', error);
@@ -2,13 +2,55 @@ import axios from 'axios';
 
 const API_BASE_URL = 'http://localhost:8000';
 
+// Stable per-browser id, so the API keeps this client's reads on the primary
+// right after its own writes
+const getClientId = () => {
+  let clientId = localStorage.getItem('clientId');
+  if (!clientId) {
+    clientId = window.crypto && window.crypto.randomUUID
+      ? window.crypto.randomUUID()
+      : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    localStorage.setItem('clientId', clientId);
+  }
+  return clientId;
+};
+
 const api = axios.create({
   baseURL: API_BASE_URL,
   headers: {
     'Content-Type': 'application/json',
+    'X-Client-Id': getClientId(),
   },
 });
 
+// Latest commit position ("high/low" in hex) seen in a write response or a
+// group event. Reads send it back so a lagging replica never serves them.
+let minPosition = null;
+
+const isAfter = (position, other) => {
+  const [high, low] = position.split('/').map((part) => parseInt(part, 16));
+  const [otherHigh, otherLow] = other.split('/').map((part) => parseInt(part, 16));
+  return high > otherHigh || (high === otherHigh && low > otherLow);
+};
+
+const notePosition = (position) => {
+  if (position && (!minPosition || isAfter(position, minPosition))) {
+    minPosition = position;
+  }
+};
+
+api.interceptors.request.use((config) => {
+  if (minPosition) {
+    config.headers['X-Min-Position'] = minPosition;
+  }
+  return config;
+});
+
+api.interceptors.response.use((response) => {
+  notePosition(response.headers['x-commit-position']);
+  return response;
+});
+
 // User API
 export const userAPI = {
   createUser: (userData) => api.post('/users/', userData),
@@ -17,6 +59,7 @@ export const userAPI = {
   updateUser: (userId, userData) => api.put(`/users/${userId}`, userData),
   deleteUser: (userId) => api.delete(`/users/${userId}`),
   getUserBalances: (userId) => api.get(`/users/${userId}/balances`),
+  getUserDashboard: (userId, recentLimit = 10) => api.get(`/users/${userId}/dashboard`, { params: { recent_limit: recentLimit } }),
 };
 
 // Group API
@@ -30,6 +73,28 @@ export const groupAPI = {
   getGroupExpenses: (groupId) => api.get(`/groups/${groupId}/expenses`),
   addMembersToGroup: (groupId, userIds) => api.post(`/groups/${groupId}/members`, { user_ids: userIds }),
   removeMemberFromGroup: (groupId, userId) => api.delete(`/groups/${groupId}/members/${userId}`),
+  // Server-Sent Events stream of changes to a group; returns an unsubscribe function
+  subscribeToGroupEvents: (groupId, onEvent) => {
+    const source = new EventSource(`${API_BASE_URL}/groups/${groupId}/events`);
+    const eventTypes = [
+      'ready',
+      'resync',
+      'expense_created',
+      'settlement_created',
+      'members_changed',
+      'group_updated',
+      'group_deleted',
+    ];
+    eventTypes.forEach((type) => {
+      source.addEventListener(type, (event) => {
+        const data = JSON.parse(event.data);
+        // Before the handler refetches, so the refetch includes this change
+        notePosition(data.position);
+        onEvent(data);
+      });
+    });
+    return () => source.close();
+  },
 };
 
 // Expense API
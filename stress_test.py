@@ -0,0 +1,157 @@
+"""
+Concurrent write stress test for Splitwise Clone
+Posts expenses and settlements to a single group from a thread pool, then
+checks that no update to the group's ledger was lost: over HTTP, and by
+auditing every stored net balance against the raw rows in the database the
+backend uses (its DATABASE_URL)
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_URL = "http://localhost:8000"
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+def setup_group(members):
+    """Create fresh users and a group for the run"""
+    run_id = uuid.uuid4().hex[:8]
+    users = []
+    for i in range(members):
+        response = requests.post(f"{BASE_URL}/users/", json={
+            "name": f"Stress User {i}",
+            "email": f"stress-{run_id}-{i}@example.com"
+        })
+        response.raise_for_status()
+        users.append(response.json())
+
+    response = requests.post(f"{BASE_URL}/groups/", json={
+        "name": f"Stress Test {run_id}",
+        "description": "Concurrent write stress test",
+        "user_ids": [user["id"] for user in users]
+    })
+    response.raise_for_status()
+    return users, response.json()
+
+def audit_group(group_id):
+    """Issues found by the ledger audit of one group, read from the primary"""
+    # Imported here: the backend modules read DATABASE_URL when imported
+    sys.path.insert(0, BACKEND_DIR)
+    import audit
+
+    # No tolerance: every group_balances net must equal the recomputed one to the cent
+    result = audit.audit_range(group_id, group_id, tolerance=0, use_primary=True)
+    return result["issues"].get(group_id, [])
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress concurrent writes to a single group")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--writes", type=int, default=50, help="writes per worker")
+    parser.add_argument("--members", type=int, default=8, help="users in the group")
+    args = parser.parse_args()
+
+    print("🏋️  Concurrent write stress test")
+    print("=" * 40)
+
+    users, group = setup_group(args.members)
+    group_id = group["id"]
+    user_ids = [user["id"] for user in users]
+    print(f"✅ Created group {group_id} with {len(users)} members")
+
+    lock = threading.Lock()
+    posted = {"expenses": 0, "expense_total": 0.0, "settlements": 0, "errors": 0}
+
+    def worker(worker_id):
+        session = requests.Session()
+        rng = random.Random(worker_id)
+        for _ in range(args.writes):
+            try:
+                if rng.random() < 0.8:
+                    amount = round(rng.uniform(1, 200), 2)
+                    response = session.post(f"{BASE_URL}/groups/{group_id}/expenses", json={
+                        "description": f"Stress expense from worker {worker_id}",
+                        "amount": amount,
+                        "paid_by": rng.choice(user_ids),
+                        "split_type": "equal",
+                        "splits": []
+                    })
+                    response.raise_for_status()
+                    with lock:
+                        posted["expenses"] += 1
+                        posted["expense_total"] += amount
+                else:
+                    from_user, to_user = rng.sample(user_ids, 2)
+                    response = session.post(f"{BASE_URL}/settlements/", json={
+                        "from_user_id": from_user,
+                        "to_user_id": to_user,
+                        "amount": round(rng.uniform(1, 50), 2),
+                        "group_id": group_id
+                    })
+                    response.raise_for_status()
+                    with lock:
+                        posted["settlements"] += 1
+            except requests.exceptions.RequestException as e:
+                with lock:
+                    posted["errors"] += 1
+                print(f"❌ Worker {worker_id} write failed: {e}")
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(worker, range(args.workers)))
+    elapsed = time.time() - start_time
+
+    writes = posted["expenses"] + posted["settlements"]
+    print(f"📝 {writes} writes ({posted['expenses']} expenses, {posted['settlements']} settlements) "
+          f"in {elapsed:.2f}s with {args.workers} workers")
+    print(f"⚡ {writes / elapsed:.1f} writes/second to a single group")
+
+    # Verify the ledger against what was posted and against the raw rows
+    group_detail = requests.get(f"{BASE_URL}/groups/{group_id}").json()
+    expenses = requests.get(f"{BASE_URL}/groups/{group_id}/expenses?include_archived=true").json()
+    balances = requests.get(f"{BASE_URL}/groups/{group_id}/balances").json()
+
+    expected_total = round(posted["expense_total"], 2)
+    raw_total = round(sum(expense["amount"] for expense in expenses), 2)
+    net_sum = round(sum(balance["net_balance"] for balance in balances), 2)
+
+    ok = True
+    if len(expenses) != posted["expenses"]:
+        print(f"❌ Expected {posted['expenses']} expenses, found {len(expenses)}")
+        ok = False
+    if abs(group_detail["total_expenses"] - expected_total) > 0.005:
+        print(f"❌ Lost updates: ledger total {group_detail['total_expenses']} != posted total {expected_total}")
+        ok = False
+    if abs(raw_total - expected_total) > 0.005:
+        print(f"❌ Stored expenses total {raw_total} != posted total {expected_total}")
+        ok = False
+    # Each member's balance is rounded to the cent, so allow a cent per member
+    if abs(net_sum) > 0.01 * len(balances):
+        print(f"❌ Balances do not sum to zero: {net_sum}")
+        ok = False
+    issues = audit_group(group_id)
+    for issue in issues:
+        details = ", ".join(f"{key}={value}" for key, value in issue.items() if key != "check")
+        print(f"❌ Audit {issue['check']}: {details}")
+    if issues:
+        ok = False
+    else:
+        print("✅ Audit: every stored net balance and total matches the raw rows")
+    if posted["errors"]:
+        print(f"❌ {posted['errors']} writes failed")
+        ok = False
+
+    print()
+    if ok:
+        print("🎉 No lost updates: ledger matches every posted write")
+    else:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()